@@ -326,8 +326,7 @@ def help_list_filters():
 
         nlindentstr = "\n%16s"%(""); # newline, followed by 16 whitespaces
         return ( "  %-13s " %(f) +
-                 nlindentstr.join(textwrap.wrap(factory.get_filter_class(f, filterpackage=fp)
-                                                .getHelpDescription(),
+                 nlindentstr.join(textwrap.wrap(factory.get_filter_description(f, filterpackage=fp),
                                                 (80-16) # 80 line width, -16 indent chars
                                                 ))
                  )
@@ -364,6 +363,35 @@ class opt_list_filters(argparse.Action):
 
 
 
+class opt_import_arxiv_metadata(argparse.Action):
+    def __init__(self, nargs=1, **kwargs):
+        if nargs != 1:
+            raise ValueError('nargs for opt_import_arxiv_metadata must be == 1')
+
+        argparse.Action.__init__(self, nargs=1, **kwargs);
+
+    def __call__(self, parser, namespace, values, option_string):
+
+        from bibolamazi.filters.util import arxivmetadata
+
+        dumpfname = values[0]
+        store = arxivmetadata.ArxivMetadataStore(arxivmetadata.default_store_fname())
+
+        logger.info("Importing arXiv metadata from `%s' into `%s' ...", dumpfname, store.fname)
+        try:
+            n = store.import_dump(dumpfname)
+        except (IOError, OSError) as e:
+            logger.error("Can't import arXiv metadata: %s", e)
+            parser.exit(9);
+        except butils.BibolamaziError as e:
+            logger.error(unicode(e))
+            parser.exit(9);
+        logger.info("Imported %d records.", n)
+
+        parser.exit();
+
+
+
 class opt_init_empty_template(argparse.Action):
     def __init__(self, nargs=1, **kwargs):
         if nargs != 1:
@@ -151,7 +151,106 @@ class BibFilter(object):
         The default implementation does nothing.
         """
         return
-    
+
+
+    def can_fuse_with_previous(self):
+        """
+        Return `True` if this filter may be run in the same pass over the entries as the
+        immediately preceding filter(s), when bibolamazi is asked to fuse consecutive
+        filters (see the ``--fuse-filters`` command-line option). This only makes sense
+        for filters with action :py:const:`BibFilter.BIB_FILTER_SINGLE_ENTRY`.
+
+        In a fused pass, the :py:meth:`prerun()` methods of all the fused filters are
+        called first, and then each entry is passed through all the fused filters in
+        turn before moving on to the next entry. Consequently, the :py:meth:`prerun()` of
+        this filter would be called *before* the preceding filters have processed the
+        entries.
+
+        The default implementation returns `True` if the filter does not reimplement
+        :py:meth:`prerun()`, and `False` otherwise. Subclasses which reimplement
+        :py:meth:`prerun()` may reimplement this function to return `True` if their
+        `prerun()` does not depend on the entries having been processed by the
+        preceding filters.
+        """
+        return (getattr(self.prerun, '__func__', None) is BibFilter.prerun.__func__)
+
+
+    def can_run_in_parallel(self):
+        """
+        Return `True` if :py:meth:`filter_bibentry()` may be called on different entries
+        simultaneously, in separate worker processes (see the ``--jobs`` command-line
+        option). This only makes sense for filters with action
+        :py:const:`BibFilter.BIB_FILTER_SINGLE_ENTRY`.
+
+        A filter may only declare itself parallel-safe if :py:meth:`filter_bibentry()`
+        does nothing else than modify the type, the fields and the persons of the given
+        entry, based only on the contents of that entry and on the filter's options. In
+        particular, any changes to the filter object itself, to other entries, to the
+        bibolamazi cache or to the entry's other attributes are lost, as they happen in
+        the worker process. The :py:meth:`prerun()` method is still called in the main
+        process before the entries are dispatched to the workers.
+
+        The default implementation returns `False`.
+        """
+        return False
+
+
+    def can_stream(self):
+        """
+        Return `True` if this filter may be run in streaming mode (see the ``--stream``
+        command-line option). In streaming mode, the entries are read from the sources,
+        passed through all the filters and written to the output file one at a time, and
+        the full bibliography database is never loaded into memory.
+
+        This requires the filter to have action
+        :py:const:`BibFilter.BIB_FILTER_SINGLE_ENTRY`, and :py:meth:`filter_bibentry()`
+        must not access the bibliography database or any other entries. Also, the
+        :py:meth:`prerun()` methods of all filters are called before any entry is read,
+        at which point :py:meth:`BibolamaziFile.bibliographyData()` is `None`.
+
+        The default implementation returns `True` if the filter acts on single entries
+        and does not reimplement :py:meth:`prerun()`, and `False` otherwise.
+        """
+        return (self.action() == BibFilter.BIB_FILTER_SINGLE_ENTRY and
+                getattr(self.prerun, '__func__', None) is BibFilter.prerun.__func__)
+
+
+    def wanted_entry_keys(self):
+        """
+        If this filter discards all entries except those of a set of keys which is known
+        before the sources are loaded (like the `only_used` filter, which keeps the
+        entries cited in a LaTeX document), then return that set of keys. Otherwise,
+        return `None`.
+
+        This function is called when the bibolamazi file loads its sources, before any
+        filter is run. If all the filters preceding this one can cope with missing
+        entries (see :py:meth:`can_skip_unwanted_entries()`), then only the entries with
+        these keys (and the entries they cross-reference) are loaded from the sources.
+        The filter must still discard the other entries itself, as some of them may be
+        loaded nonetheless.
+
+        The default implementation returns `None`.
+        """
+        return None
+
+
+    def can_skip_unwanted_entries(self):
+        """
+        Return `True` if this filter may be run on a database from which the entries
+        discarded by a later filter have been left out (see
+        :py:meth:`wanted_entry_keys()`).
+
+        A filter may only return `True` if it doesn't change the keys of the entries,
+        and if the way it processes an entry does not depend on the presence or contents
+        of any other entry (as the `duplicates` filter does, for example). Adding new
+        entries is fine.
+
+        The default implementation returns `True` if the filter acts on single entries
+        and does not reimplement :py:meth:`prerun()`, and `False` otherwise.
+        """
+        return (self.action() == BibFilter.BIB_FILTER_SINGLE_ENTRY and
+                getattr(self.prerun, '__func__', None) is BibFilter.prerun.__func__)
+
 
     def filter_bibentry(self, x):
         """
@@ -39,6 +39,7 @@ import traceback
 import bibolamazi.init
 from bibolamazi.core.argparseactions import store_key_val, store_key_const, store_key_bool
 from bibolamazi.core import butils
+from bibolamazi.core.bibfilter import filterregistry
 
 logger = logging.getLogger(__name__)
 
@@ -195,6 +196,24 @@ filterpath = PrependOrderedDict([
 _filter_list = None
 _filter_package_listings = None
 _filter_modules = {}
+# { filterpackname: OrderedDict({ filtername: info }) } -- see get_filter_info()
+_filter_infos = None
+
+_filter_registry = None
+
+def get_filter_registry():
+    """
+    Return the :py:class:`~filterregistry.FilterRegistry` in which the information about
+    the detected filters is stored, or `None` if the registry is disabled.
+    """
+    global _filter_registry
+
+    if _filter_registry is None:
+        fname = filterregistry.default_registry_fname()
+        if fname is None:
+            return None
+        _filter_registry = filterregistry.FilterRegistry(fname)
+    return _filter_registry
 
 # For pyinstaller: precompiled filter list
 
@@ -218,11 +237,13 @@ def reset_filters_cache():
     global _filter_list
     global _filter_package_listings
     global _filter_modules
+    global _filter_infos
     global _filter_precompiled_cache
 
     _filter_list = None
     _filter_package_listings = None
     _filter_modules = {}
+    _filter_infos = None
     # of course, don't reset the precompiled cache!!
 
 
@@ -412,8 +433,18 @@ _rxpysuffix = re.compile(r'\.py[co]?$')
 
 
 def detect_filters(force_redetect=False):
+    """
+    Detect the available filters in all the filter packages, and return the list of
+    their names.
+
+    Finding the filters of a filter package requires importing all of its modules. The
+    filters found are stored in the filter registry along with their help texts (see
+    :py:mod:`filterregistry`), so that as long as the filter package is not modified,
+    the next time the filters don't need to be imported.
+    """
     global _filter_list
     global _filter_package_listings
+    global _filter_infos
     global _filter_precompiled_cache
     global filterpath
 
@@ -473,13 +504,13 @@ def detect_filters(force_redetect=False):
             if modname not in _filter_package_listings[filterpackname]:
                 _filter_package_listings[filterpackname].append(modname)
 
-            if modname not in _filter_list:
-                _filter_list.append(modname)
-
     # ----
     
     _filter_list = []
     _filter_package_listings = OrderedDict()
+    _filter_infos = OrderedDict()
+
+    registry = get_filter_registry()
 
     logger.debug("Detecting filters ... filter path is %r", filterpath)
 
@@ -494,7 +525,33 @@ def detect_filters(force_redetect=False):
                 logger.warning("Can't import package %s for detecting filters: %s", filterpack, unicode(e))
                 continue
             #thisdir = os.path.realpath(os.path.dirname(filterpackage.__file__))
-            detect_filters_in_module(filterpackage, filterpack)
+
+            # the help texts also depend on the code in this directory
+            infos = None
+            signature = None
+            registry_key = filterpack + ('@'+filterdir if filterdir else '')
+            if registry is not None:
+                signature = filterregistry.package_signature(
+                    list(filterpackage.__path__) + [os.path.dirname(os.path.realpath(__file__))]
+                    )
+                if signature is not None:
+                    infos = registry.get_package(registry_key, signature)
+
+            if infos is not None:
+                logger.debug("Using the registered filters of package %s", filterpack)
+                _filter_package_listings[filterpack] = [ str(info['name']) for info in infos ]
+            else:
+                detect_filters_in_module(filterpackage, filterpack)
+                infos = [ _make_filter_info(fname, filterpack)
+                          for fname in _filter_package_listings[filterpack] ]
+                if signature is not None:
+                    registry.set_package(registry_key, signature, infos)
+
+            _filter_infos[filterpack] = OrderedDict([ (str(info['name']), info) for info in infos ])
+
+            for fname in _filter_package_listings[filterpack]:
+                if fname not in _filter_list:
+                    _filter_list.append(fname)
 
             if filterpack in _filter_precompiled_cache:
                 logger.longdebug("Loading precompiled filters from package %s...", filterpack)
@@ -508,6 +565,9 @@ def detect_filters(force_redetect=False):
         finally:
             sys.path = oldsyspath
 
+    if registry is not None:
+        registry.save()
+
     logger.debug('Filters detected.')
     logger.longdebug("_filter_list=%r, _filter_package_listings=%r", _filter_list, _filter_package_listings)
 
@@ -519,6 +579,79 @@ def detect_filter_package_listings():
     return _filter_package_listings
 
 
+def _make_filter_info(name, filterpackname):
+    """
+    Collect the information about the filter `name` of the filter package
+    `filterpackname` which is stored in the filter registry.
+    """
+    info = {
+        'name': name,
+        'module': filterpackname+'.'+name,
+        'description': None,
+        'help': None,
+        'options': None,
+        }
+    try:
+        fmodule = get_module(name, filterpackage=filterpackname)
+        fclass = fmodule.bibolamazi_filter_class()
+        info['description'] = fclass.getHelpDescription()
+        if (hasattr(fmodule, 'format_help')):
+            info['help'] = fmodule.format_help()
+        else:
+            fopts = DefaultFilterOptions(name, fclass=fclass)
+            info['help'] = fopts.format_filter_help()
+            info['options'] = [ list(x) for x in fopts.filterOptions() ]
+    except Exception as e:
+        # any error is reported when the filter is actually used
+        logger.debug("Can't get information about filter %s in package %s: %s",
+                     name, filterpackname, e)
+    return info
+
+
+def get_filter_info(name, filterpackage=None):
+    """
+    Return the information about the filter `name` stored in the filter registry,
+    without importing the filter module.
+
+    The information is a dictionary with keys 'name', 'module' (the full module name),
+    'description', 'help' (the text displayed by ``bibolamazi --help <filter>``) and
+    'options' (a list of `[argname, argtypename, doc]` for filters which use the default
+    option parser, see :py:class:`DefaultFilterOptions`). The values may be `None` if
+    they are not available.
+
+    Returns `None` if the filter is not registered (e.g. for precompiled filters). Use
+    :py:func:`get_filter_class()` etc. in that case.
+    """
+    name = str(name)
+    if ':' in name and filterpackage is None:
+        (filterpackage, name) = name.split(':', 1)
+
+    detect_filters()
+
+    if (filterpackage is not None):
+        if (isinstance(filterpackage, types.ModuleType)):
+            filterpackage = filterpackage.__name__
+        return _filter_infos.get(filterpackage, {}).get(name)
+
+    # the filter packages are listed in the order they are searched
+    for infos in _filter_infos.itervalues():
+        if name in infos:
+            return infos[name]
+    return None
+
+
+def get_filter_description(name, filterpackage=None):
+    """
+    Return the one-line description of the filter `name` (see
+    :py:meth:`BibFilter.getHelpDescription()`). The filter module is only imported if the
+    description is not in the filter registry.
+    """
+    info = get_filter_info(name, filterpackage=filterpackage)
+    if info is not None and info['description'] is not None:
+        return info['description']
+    return get_filter_class(name, filterpackage=filterpackage).getHelpDescription()
+
+
 def get_filter_class(name, filterpackage=None):
     
     fmodule = get_module(name, filterpackage=filterpackage);
@@ -1055,6 +1188,16 @@ class DefaultFilterOptions:
 
 
 def format_filter_help(filtname):
+    #
+    # Use the help text in the filter registry, if available (the usage line shows the
+    # filter name without the filter package)
+    #
+
+    if ':' not in filtname:
+        info = get_filter_info(filtname)
+        if info is not None and info['help'] is not None:
+            return info['help']
+
     #
     # Get the parser via the filter, and use its format_help()
     #
@@ -0,0 +1,171 @@
+################################################################################
+#                                                                              #
+#   This file is part of the Bibolamazi Project.                               #
+#   Copyright (C) 2015 by Philippe Faist                                       #
+#   philippe.faist@bluewin.ch                                                  #
+#                                                                              #
+#   Bibolamazi is free software: you can redistribute it and/or modify         #
+#   it under the terms of the GNU General Public License as published by       #
+#   the Free Software Foundation, either version 3 of the License, or          #
+#   (at your option) any later version.                                        #
+#                                                                              #
+#   Bibolamazi is distributed in the hope that it will be useful,              #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of             #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              #
+#   GNU General Public License for more details.                               #
+#                                                                              #
+#   You should have received a copy of the GNU General Public License          #
+#   along with Bibolamazi.  If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                              #
+################################################################################
+
+"""
+A registry of the available filters, stored on disk.
+
+Detecting the available filters requires importing all the modules of all filter
+packages, some of which import large external packages. The registry remembers, for
+each filter package, which filters it provides along with their description, help text
+and options, so that the filters may be listed and their help displayed without
+importing them.
+
+The information about a filter package is only used if none of the python source files
+of the package (or of the filter framework itself) have been modified since it was
+stored. The registry is stored in the file given by the environment variable
+``BIBOLAMAZI_FILTER_REGISTRY``, by default ``~/.bibolamazi/filter_registry.json``.
+Setting this variable to an empty string disables the registry.
+"""
+
+import sys
+import os
+import os.path
+import json
+import logging
+
+from bibolamazi.core import butils
+
+logger = logging.getLogger(__name__)
+
+
+# increase this if the layout of the registry file changes
+REGISTRY_VERSION = 1
+
+
+def default_registry_fname():
+    """
+    Return the file name of the filter registry, or `None` if the registry is disabled.
+    See the module documentation.
+    """
+    fname = os.environ.get('BIBOLAMAZI_FILTER_REGISTRY', None)
+    if fname is not None:
+        return fname or None
+    return os.path.join(os.path.expanduser('~'), '.bibolamazi', 'filter_registry.json')
+
+
+def package_signature(paths):
+    """
+    Return a list of `[path, mtime]` pairs for the given directories and all the
+    subdirectories and python source files they contain. If this changes, then the
+    filters provided by a package located in these directories may have changed.
+
+    Returns `None` if one of the `paths` is not a directory (e.g. if the package was
+    loaded from a zip file), in which case the package can't be registered.
+    """
+    signature = []
+    for path in paths:
+        if not os.path.isdir(path):
+            return None
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames.sort()
+            signature.append([dirpath, os.stat(dirpath).st_mtime])
+            for fn in sorted(filenames):
+                if fn.endswith('.py'):
+                    fpath = os.path.join(dirpath, fn)
+                    signature.append([fpath, os.stat(fpath).st_mtime])
+    # in the same form as when read back from the registry file
+    return json.loads(json.dumps(signature, encoding=sys.getfilesystemencoding() or 'utf-8'))
+
+
+class FilterRegistry(object):
+    """
+    The filter registry stored in the file `fname`.
+
+    The information about each filter package is stored under a key identifying the
+    package, along with its signature (see :py:func:`package_signature`). The
+    information itself is a list of dictionaries, one for each filter, which may
+    contain any data that can be stored as JSON.
+
+    The file is only read when information is first requested, and is written back by
+    :py:meth:`save` if anything changed. Errors reading or writing the file are ignored.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self._packages = None
+        self._dirty = False
+
+    def _load(self):
+        self._packages = {}
+        try:
+            with open(self.fname, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.debug("Filter registry `%s' nonexisting or not readable: %s", self.fname, e)
+            return
+        if (not isinstance(data, dict) or
+            data.get('version') != [REGISTRY_VERSION, butils.get_version()]):
+            logger.debug("Ignoring filter registry `%s' from another version", self.fname)
+            return
+        self._packages = data.get('packages', {})
+
+    def get_package(self, key, signature):
+        """
+        Return the list of filter information stored for the package `key`, or `None`
+        if the package is not in the registry or if its signature has changed.
+        """
+        if self._packages is None:
+            self._load()
+        pkg = self._packages.get(key)
+        if pkg is None or pkg.get('signature') != signature:
+            return None
+        return pkg['filters']
+
+    def set_package(self, key, signature, filters):
+        """
+        Store the list of filter information `filters` for the package `key`, which has
+        the given `signature`.
+        """
+        if self._packages is None:
+            self._load()
+        self._packages[key] = {
+            'signature': signature,
+            'filters': filters,
+            }
+        self._dirty = True
+
+    def save(self):
+        """
+        Write the registry to the file, if anything has changed. The file is replaced
+        atomically, so that concurrent runs of bibolamazi never see a partial registry.
+        """
+        if not self._dirty:
+            return
+        tmpfname = self.fname + '.tmp%d' %(os.getpid())
+        try:
+            dirname = os.path.dirname(self.fname)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmpfname, 'w') as f:
+                json.dump({
+                    'version': [REGISTRY_VERSION, butils.get_version()],
+                    'packages': self._packages,
+                    }, f)
+            if (sys.platform.startswith('win') and os.path.exists(self.fname)):
+                # os.rename() doesn't replace existing files on windows
+                os.remove(self.fname)
+            os.rename(tmpfname, self.fname)
+        except (IOError, OSError) as e:
+            logger.debug("Couldn't save filter registry to `%s': %s", self.fname, e)
+            if os.path.exists(tmpfname):
+                os.remove(tmpfname)
+            return
+        logger.debug("Saved filter registry to `%s'", self.fname)
+        self._dirty = False
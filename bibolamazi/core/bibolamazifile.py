@@ -34,20 +34,23 @@ import os.path
 import codecs
 import shlex
 import urllib
+import hashlib
+import json
+import itertools
+import shutil
+import time
+import threading
+import Queue
 import cPickle as pickle
 from datetime import datetime
 import logging
 
 import bibolamazi.init
 
-import pybtex.database
-import pybtex.database.input.bibtex as inputbibtex
-import pybtex.database.output.bibtex as outputbibtex
-from pybtex.utils import OrderedCaseInsensitiveDict
-
 from bibolamazi.core import butils
 from bibolamazi.core.butils import BibolamaziError
 from bibolamazi.core.bibusercache import BibUserCache, BibUserCacheDic, BibUserCacheList
+from bibolamazi.core.bibusercache import tokencheckers
 from bibolamazi.core.bibfilter import factory
 
 logger = logging.getLogger(__name__)
@@ -192,6 +195,14 @@ sources loaded. See doc for :py:class:`BibolamaziFile`.
 """
 
 
+SOURCE_LISTS_MAX_THREADS = 8
+"""
+The maximum number of source lists which are read at the same time, in separate threads,
+when loading the sources of a bibolamazi file. Set this to 1 to read them one after the
+other.
+"""
+
+
 
 _key_duplsuffix = '.dupl.'
 _rx_repl_key_duplsuffix = re.compile(r'($|'+re.escape(_key_duplsuffix)+r'(?P<num>\d+)$)',
@@ -240,7 +251,8 @@ class BibolamaziFile(object):
     def __init__(self, fname=None, create=False,
                  load_to_state=BIBOLAMAZIFILE_LOADED,
                  use_cache=True,
-                 default_cache_invalidation_time=None):
+                 default_cache_invalidation_time=None,
+                 default_cache_max_age=None):
         """
         Create a BibolamaziFile object.
 
@@ -262,7 +274,9 @@ class BibolamaziFile(object):
         `False`, then cache will still be *written* when calling :py:meth:`saveToFile()`.
 
         If `default_cache_invalidation_time` is given, then the default cache invalidation
-        time is set before loading the cache.
+        time is set before loading the cache. Similarly, `default_cache_max_age` sets the
+        default maximum age of cached data which is kept until it can be refreshed (see
+        :py:meth:`setDefaultCacheMaxAge`).
         """
         
         logger.debug("Opening bibolamazi file `%s'" %(fname))
@@ -281,6 +295,8 @@ class BibolamaziFile(object):
             # all the data and cache.
             if default_cache_invalidation_time is not None:
                 self.setDefaultCacheInvalidationTime(default_cache_invalidation_time)
+            if default_cache_max_age is not None:
+                self.setDefaultCacheMaxAge(default_cache_max_age)
             # now load the data, if required.
             if (load_to_state > BIBOLAMAZIFILE_PARSED):
                 self.load(to_state=load_to_state)
@@ -348,7 +364,17 @@ class BibolamaziFile(object):
             self._filters = []
             self._cache_accessors = {} # dict { class-type: class-instance }
             self._bibliographydata = None
+            self._num_source_entries = 0
+            self._entry_fingerprint_index = None
             self._user_cache = BibUserCache(cache_version=butils.get_version())
+            self._manifest_sources = []
+            self._manifest_dependencies = []
+            self._manifest_volatile = False
+            self._manifest_incomplete = []
+            self._manifest_expires = None
+            self._source_cache = None
+            self._source_cache_used = {}
+            self._source_cache_dirty = False
             
         if (to_state >= BIBOLAMAZIFILE_READ  and  self._load_state < BIBOLAMAZIFILE_READ):
             try:
@@ -526,6 +552,30 @@ class BibolamaziFile(object):
         """
         return self._filters
 
+    def wantedEntryKeys(self):
+        """
+        Return the set of keys of the entries which need to be loaded from the sources,
+        or `None` if all entries are needed.
+
+        If one of the filters only keeps a set of entries known in advance (see
+        :py:meth:`BibFilter.wanted_entry_keys()`), and if all the filters before it can
+        cope with the other entries being left out (see
+        :py:meth:`BibFilter.can_skip_unwanted_entries()`), then this is the set of keys
+        returned by that filter. Only those entries, along with the entries they
+        cross-reference, are loaded into :py:meth:`bibliographyData()`.
+
+        This function may be called in the state :py:const:`BIBOLAMAZIFILE_PARSED`.
+        """
+        for filterinstance in self._filters:
+            keys = filterinstance.wanted_entry_keys()
+            if keys is not None:
+                logger.debug("Filter %s only needs %d entries, not loading the others",
+                             filterinstance.name(), len(keys))
+                return keys
+            if not filterinstance.can_skip_unwanted_entries():
+                return None
+        return None
+
     def bibliographyData(self):
         """
         Return the `pybtex.database.BibliographyData` object which stores all the
@@ -534,9 +584,22 @@ class BibolamaziFile(object):
         This object is only instanciated and initialized once in the
         :py:const:`BIBOLAMAZIFILE_LOADED` state. If ``getLoadState() != BIBOLAMAZIFILE_LOADED``,
         then this function returns `None`.
+
+        Note that entries which would be discarded by the filters anyway may not have been
+        loaded, see :py:meth:`wantedEntryKeys()`.
         """
         return self._bibliographydata
 
+    def numSourceEntries(self):
+        """
+        Return the number of entries which were found in the sources, including those
+        which were not loaded into :py:meth:`bibliographyData()` because the filters
+        don't need them (see :py:meth:`wantedEntryKeys()`).
+
+        Only meaningful in the :py:const:`BIBOLAMAZIFILE_LOADED` state.
+        """
+        return self._num_source_entries
+
     def bibliographydata(self):
         """
         .. deprecated:: 2.0
@@ -556,6 +619,136 @@ class BibolamaziFile(object):
         return self._fname + '.bibolamazicache'
         
 
+    def sourceCacheFileName(self):
+        """
+        The file name where the parsed contents of the source files are cached. You don't
+        need to access this directly, the cache will be loaded and saved automatically.
+
+        This cache spares us from parsing sources which haven't changed since the last
+        run. Each source is stored along with its size, its modification time and a hash
+        of its contents, and is parsed again if any of these has changed.
+        """
+        return self._fname + '.bibolamazisourcecache'
+
+
+    def manifestFileName(self):
+        """
+        The file name where the run manifest is stored. The manifest records fingerprints
+        of everything the output depended on during the last run, so that we can tell
+        whether the output is still up to date (see :py:meth:`isUpToDate()`). You don't
+        need to access this directly, it is written automatically by
+        :py:meth:`saveToFile()`, unless the bibliography data wasn't loaded (in which
+        case the output has no entries, and the manifest is removed instead).
+        """
+        return self._fname + '.bibolamazimanifest'
+
+
+    def registerDependencyFile(self, fname):
+        """
+        Inform this object that the output depends on the file `fname`, which is not a
+        source (for example, a LaTeX ``.aux`` file that a filter inspected).
+
+        The file is fingerprinted when the output is saved, and is recorded in the run
+        manifest (see :py:meth:`manifestFileName()`). A later run will then only be
+        skipped if this file hasn't changed. It is fine to register files which do not
+        exist: in that case, the run is not skipped if the file appears later on.
+        """
+        fname = os.path.abspath(fname)
+        if fname not in self._manifest_dependencies:
+            self._manifest_dependencies.append(fname)
+
+    def registerIncompleteOutput(self, reason):
+        """
+        Inform this object that the output is incomplete, for example because some
+        information couldn't be fetched from an online service, or because information
+        which should have been refreshed had to be used instead. `reason` is a short
+        description of what is missing, which is recorded in the run manifest (see
+        :py:meth:`manifestFileName()`).
+
+        A later run is then never skipped, even if nothing else has changed, so that the
+        missing information is obtained as soon as possible.
+        """
+        if reason not in self._manifest_incomplete:
+            self._manifest_incomplete.append(reason)
+
+    def registerExpiryTime(self, when):
+        """
+        Inform this object that the output depends on information which should be
+        refreshed from the date and time `when` (a :py:class:`datetime.datetime`), for
+        example because some cached information expires then, or because a request which
+        failed should be tried again then.
+
+        The earliest of these times is recorded in the run manifest (see
+        :py:meth:`manifestFileName()`), and a later run is not skipped once it has passed.
+        """
+        if when is None:
+            return
+        t = time.mktime(when.timetuple()) + when.microsecond * 1e-6
+        if self._manifest_expires is None or t < self._manifest_expires:
+            self._manifest_expires = t
+
+
+    def isUpToDate(self):
+        """
+        Returns `True` if the output of this bibolamazi file is up to date, i.e., if
+        nothing has changed since the last time the output was saved: the config section,
+        the source files, the dependency files registered by the filters (see
+        :py:meth:`registerDependencyFile()`) and the output itself are checked against the
+        run manifest (see :py:meth:`manifestFileName()`).
+
+        Returns `False` if anything has changed, if there is no manifest or if the
+        bibolamazi file has a source which is an URL (we can't know whether it has
+        changed). Also returns `False` if the last output was incomplete (see
+        :py:meth:`registerIncompleteOutput()`), or if some of the information it used
+        should now be refreshed (see :py:meth:`registerExpiryTime()`).
+
+        This may be called in the state :py:const:`BIBOLAMAZIFILE_READ`.
+        """
+        manifestfname = self.manifestFileName()
+        try:
+            with open(manifestfname, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.debug("Can't read manifest file `%s': %s", manifestfname, e)
+            return False
+
+        def changed(what):
+            logger.debug("Output of `%s' is out of date: %s", self._fname, what)
+            return False
+
+        if (manifest.get('manifest_version') != _MANIFEST_VERSION or
+            manifest.get('bibolamazi_version') != butils.get_version()):
+            return changed("manifest is for another bibolamazi version")
+
+        if manifest.get('volatile', True):
+            return changed("some sources can't be checked for changes")
+
+        if manifest.get('incomplete'):
+            return changed("the output was incomplete (%s)" %(", ".join(manifest['incomplete'])))
+
+        if (manifest.get('expires') is not None and time.time() >= manifest['expires']):
+            return changed("some information used for the output should be refreshed")
+
+        if (manifest.get('fdir') != self._dir or
+            manifest.get('config_hash') != self._config_hash()):
+            return changed("config changed")
+
+        if not _fingerprint_matches(self._fname, manifest.get('output')):
+            return changed("output file changed")
+
+        for (src, path, fp) in manifest.get('sources', []):
+            if (self.resolveSourcePath(src) != path):
+                return changed("source %s resolves to a different file" %(src))
+            if not _fingerprint_matches(path, fp):
+                return changed("source %s changed" %(path))
+
+        for (path, fp) in manifest.get('dependencies', []):
+            if not _fingerprint_matches(path, fp):
+                return changed("file %s changed" %(path))
+
+        return True
+
+
     def cacheAccessor(self, klass):
         """
         Returns the cache accessor instance corresponding to the given class.
@@ -566,7 +759,24 @@ class BibolamaziFile(object):
         If the cache accessor was not loaded, then `None` is returned.
         """
         return self._cache_accessors.get(klass, None)
-        
+
+    def entryFingerprintIndex(self):
+        """
+        Returns the :py:class:`~core.bibusercache.tokencheckers.EntryFingerprintIndex`
+        for the entries of :py:meth:`bibliographyData`. Cache accessors should pass it
+        to the :py:class:`~core.bibusercache.tokencheckers.EntryFieldsTokenChecker`'s
+        they create, so that the digests of the entries' fields are computed only once
+        for all caches.
+
+        If the bibliography data is not loaded, then `None` is returned.
+        """
+        if self._bibliographydata is None:
+            return None
+        if (self._entry_fingerprint_index is None or
+            self._entry_fingerprint_index.bibdata is not self._bibliographydata):
+            self._entry_fingerprint_index = tokencheckers.EntryFingerprintIndex(self._bibliographydata)
+        return self._entry_fingerprint_index
+
 
     def setDefaultCacheInvalidationTime(self, time_delta):
         """
@@ -592,6 +802,23 @@ class BibolamaziFile(object):
 
         self._user_cache.setDefaultInvalidationTime(time_delta)
 
+    def setDefaultCacheMaxAge(self, time_delta):
+        """
+        A timedelta object giving the maximum age of cached data which is still used after
+        the cache invalidation time, while it can't be refreshed (this is the case of
+        information fetched from online services, such as the arXiv API). Older data is
+        discarded and fetched again.
+
+        As for :py:meth:`setDefaultCacheInvalidationTime`, this function should be called
+        BEFORE the data is loaded, or you may use the option `default_cache_max_age` in
+        the constructor.
+        """
+        if not self._user_cache:
+            logger.warning('BibolamaziFile.setDefaultCacheMaxAge(): Invalid cache object')
+            return
+
+        self._user_cache.setDefaultMaxAge(time_delta)
+
     def setConfigData(self, configdata):
         """
         Store the given data `configdata` in memory as the configuration section of this file.
@@ -659,6 +886,8 @@ class BibolamaziFile(object):
 
     def _init_empty_template(self):
 
+        import pybtex.database
+
         # provide us an initialized instance
         self.load(None, to_state=BIBOLAMAZIFILE_INIT)
 
@@ -725,10 +954,12 @@ class BibolamaziFile(object):
 
         state = ST_HEADER
 
+        # collect lines in lists and join them at the end; repeatedly concatenating
+        # unicode strings is quadratic, which hurts with a large generated bibliography.
         content = {
-            ST_HEADER: u"",
-            ST_CONFIG: u"",
-            ST_REST: u""
+            ST_HEADER: [],
+            ST_CONFIG: [],
+            ST_REST: []
             }
         config_block_lines = []
 
@@ -740,12 +971,12 @@ class BibolamaziFile(object):
             
             if (state == ST_HEADER and line.startswith(CONFIG_BEGIN_TAG)):
                 state = ST_CONFIG
-                content[ST_CONFIG] += line
+                content[ST_CONFIG].append(line)
                 self._startconfigdatalineno = lineno
                 continue
 
             if (state == ST_CONFIG and line.startswith(CONFIG_END_TAG)):
-                content[ST_CONFIG] += line
+                content[ST_CONFIG].append(line)
                 state = ST_REST
                 continue
 
@@ -757,7 +988,7 @@ class BibolamaziFile(object):
                     cline = cline[:-1]
                 config_block_lines.append(cline)
 
-            content[state] += line
+            content[state].append(line)
 
         if (state != ST_REST):
             # file is not a bibolamazi file--no config section found.
@@ -768,10 +999,10 @@ class BibolamaziFile(object):
         config_block = "\n".join(config_block_lines)
 
         # save the splitted data into these data structures.
-        self._header = content[ST_HEADER]
-        self._config = content[ST_CONFIG]
+        self._header = u"".join(content[ST_HEADER])
+        self._config = u"".join(content[ST_CONFIG])
         self._config_data = self._config_data_from_input_lines(config_block)
-        self._rest = content[ST_REST]
+        self._rest = u"".join(content[ST_REST])
 
         logger.longdebug(("Parsed general bibolamazifile structure: len(header)=%d"+
                       "; len(config)=%d; len(config_data)=%d; len(rest)=%d") %
@@ -923,32 +1154,45 @@ class BibolamaziFile(object):
         # ----------------
 
         self._bibliographydata = None
+        self._num_source_entries = 0
 
         if (not len(self._source_lists)):
             logger.warning("File `%s': No source files specified. You need source files to provide bib entries!"
                            %(self._fname))
 
-        # now, populate all bibliographydata.
-        for k in range(len(self._source_lists)):
-            srclist = self._source_lists[k]
-            src = self._populate_from_srclist(srclist)
+        # only load the entries which the filters need
+        wanted_keys = self.wantedEntryKeys()
+
+        # now, populate all bibliographydata. The sources are read concurrently, but they
+        # are parsed and merged in the order of the source lists, so that the result
+        # doesn't depend on which source happened to be read first.
+        for (k, tried) in self._iter_read_srclists(wanted_keys):
+            src = self._populate_from_srclist(self._source_lists[k], tried, wanted_keys)
             self._sources[k] = src
 
+        self._load_user_cache()
+
+        self._load_state = BIBOLAMAZIFILE_LOADED
+
+        logger.longdebug('done with _load_contents!')
+        return True
+
+
+    def _load_user_cache(self):
+        """
+        Load the cache, and initialize the cache accessors.
+        """
+
+        # Set up the cache store
+        # ----------------------
 
-        # Now, try to load the cache
-        # --------------------------
+        # The individual caches are only loaded from the file when they are requested.
+        cachefname = self.cacheFileName()
         if self._use_cache:
-            # then, try to load the cache if possible
-            cachefname = self.cacheFileName()
-            try:
-                with open(cachefname, 'rb') as f:
-                    logger.longdebug("Reading cache file %s" %(cachefname))
-                    self._user_cache.loadCache(f)
-            except (IOError, EOFError,):
-                logger.debug("Cache file `%s' nonexisting or not readable." %(cachefname))
-                pass
+            logger.longdebug("Using cache file %s" %(cachefname))
         else:
-            logger.debug("As requested, I have not attempted to load any existing cache file.")
+            logger.debug("As requested, I will not use any existing cache file.")
+        self._user_cache.loadCacheStore(cachefname, use_existing=self._use_cache)
 
         # Finally, initialize the cache.
         # ------------------------------
@@ -973,68 +1217,206 @@ class BibolamaziFile(object):
             cacheaccessorinstance.initialize(self._user_cache)
 
 
-        self._load_state = BIBOLAMAZIFILE_LOADED
+    def _iter_read_srclists(self, wanted_keys=None):
+        """
+        Read the sources of all the source lists, and yield tuples `(k, tried)` in the
+        order of the source lists, where `k` is the index of the source list and `tried`
+        is what :py:meth:`_read_srclist()` returned for it.
 
-        logger.longdebug('done with _load_contents!')
-        return True
+        Reading the sources is mostly waiting for the disk, for network file systems or
+        for remote servers, so the source lists are read at the same time in separate
+        threads (at most :py:data:`SOURCE_LISTS_MAX_THREADS` of them). Each source list
+        may be used as soon as it has been read, while the next ones are still being
+        read.
+        """
+        num = len(self._source_lists)
+        num_threads = min(num, SOURCE_LISTS_MAX_THREADS)
+        if (num_threads <= 1):
+            for k in range(num):
+                yield (k, self._read_srclist(self._source_lists[k], wanted_keys))
+            return
 
+        # load the parsed sources cache now, rather than from several threads at once
+        if (self._source_cache is None):
+            self._load_source_cache()
 
-    def _populate_from_srclist(self, srclist):
-        for src in srclist:
-            # try to populate from this source
-            ok = self._populate_from_src(src)
-            if ok:
-                return src
-        logger.warning("Ignoring nonexisting source list: %s" %(", ".join(srclist)))
-        return None
+        results = [ None ] * num
+        done = [ threading.Event() for k in range(num) ]
+        todo = Queue.Queue()
+        for k in range(num):
+            todo.put(k)
 
-    def _populate_from_src(self, src):
-        bib_data = None
+        def worker():
+            while True:
+                try:
+                    k = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[k] = (self._read_srclist(self._source_lists[k], wanted_keys), None)
+                except Exception:
+                    # re-raised in the main thread, when we get to this source list
+                    results[k] = (None, sys.exc_info())
+                done[k].set()
+
+        threads = [ threading.Thread(target=worker, name='bibolamazi-read-sources-%d'%(n))
+                    for n in range(num_threads) ]
+        try:
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for k in range(num):
+                # wait with a timeout, so that a KeyboardInterrupt isn't blocked
+                while not done[k].wait(0.5):
+                    pass
+                (tried, exc_info) = results[k]
+                results[k] = None
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield (k, tried)
+        finally:
+            # don't start reading any further source lists if we stopped early
+            while True:
+                try:
+                    todo.get_nowait()
+                except Queue.Empty:
+                    break
+
+    def _read_srclist(self, srclist, wanted_keys=None):
+        """
+        Read the first source of the source list `srclist` which can be read. Returns a
+        list of what :py:meth:`_read_src()` returned for each of the sources which were
+        tried; if a source could be read, it is the last one in this list.
+
+        This doesn't modify this object, so that several source lists may be read at
+        the same time in different threads. The data is used by
+        :py:meth:`_populate_from_srclist()`.
+        """
+        tried = []
+        for src in srclist:
+            srcinfo = self._read_src(src, wanted_keys)
+            tried.append(srcinfo)
+            if srcinfo['found']:
+                break
+        return tried
+
+    def _read_src(self, src, wanted_keys=None):
+        """
+        Read the source `src`, or get its parsed data from the parsed sources cache.
+        Returns a dictionary with the information needed by
+        :py:meth:`_populate_from_src()`, in which `found` is `False` if the source could
+        not be read.
+        """
+        srcinfo = {
+            'src': src,
+            'path': src,
+            'is_url': False,
+            'found': False,
+            'data': None,
+            'bib_data': None,
+            'fp': None,
+            'cache_entry': None,
+            'cache_refreshed': False,
+            }
 
-        is_url = False
         if (re.match('^[A-Za-z0-9+_-]+://.*', src)):
-            is_url = True
-        
-        if (not is_url):
-            src = self.resolveSourcePath(src)
+            srcinfo['is_url'] = True
+        else:
+            srcinfo['path'] = self.resolveSourcePath(src)
+
+        path = srcinfo['path']
 
         # read data, decode it in the right charset
-        data = None
-        if is_url:
-            logger.debug("Opening URL %r", src)
+        if srcinfo['is_url']:
+            logger.debug("Opening URL %r", path)
             try:
-                f = urllib.urlopen(src)
+                # use a separate opener, as the one of urllib.urlopen() is shared with
+                # the other threads
+                f = urllib.FancyURLopener().open(path)
                 if (f is None):
-                    return None
-                data = butils.guess_encoding_decode(f.read())
-                logger.longdebug(" ... successfully read %d chars from URL resouce." % len(data))
+                    return srcinfo
+                srcinfo['data'] = butils.guess_encoding_decode(f.read())
+                logger.longdebug(" ... successfully read %d chars from URL resouce." % len(srcinfo['data']))
                 f.close()
             except IOError:
                 # ignore source, will have to try next in list
-                return None
+                return srcinfo
         else:
-            logger.debug("Opening file %r", src)
-            try:
-                with open(src, 'r') as f:
-                    data = butils.guess_encoding_decode(f.read())
-            except IOError:
-                # ignore source, will have to try next in list
-                return None
+            logger.debug("Opening file %r", path)
+            (bib_data, cache_entry, cache_refreshed) = self._parsed_source_from_cache(path, wanted_keys)
+            if bib_data is not None:
+                srcinfo['bib_data'] = bib_data
+                srcinfo['cache_entry'] = cache_entry
+                srcinfo['cache_refreshed'] = cache_refreshed
+            else:
+                # fingerprint the file before reading it, so that we don't miss any later
+                # modifications
+                srcinfo['fp'] = _file_fingerprint(path)
+                try:
+                    with open(path, 'r') as f:
+                        srcinfo['data'] = butils.guess_encoding_decode(f.read())
+                except IOError:
+                    # ignore source, will have to try next in list
+                    return srcinfo
+
+        srcinfo['found'] = True
+        return srcinfo
+
+    def _populate_from_srclist(self, srclist, tried, wanted_keys=None):
+        """
+        Populate the bibliography data from the source list `srclist`, which was read by
+        :py:meth:`_read_srclist()`, and which returned `tried`.
+        """
+        for srcinfo in tried:
+            if (not srcinfo['is_url']):
+                # remember we tried this source, even if it doesn't exist: the outcome
+                # would be different if it is created later on.
+                self._manifest_sources.append( (srcinfo['src'], srcinfo['path']) )
+            else:
+                # we can't tell when a remote source changes
+                self._manifest_volatile = True
+            if srcinfo['found']:
+                self._populate_from_src(srcinfo, wanted_keys)
+                return srcinfo['src']
+        logger.warning("Ignoring nonexisting source list: %s" %(", ".join(srclist)))
+        return None
+
+    def _populate_from_src(self, srcinfo, wanted_keys=None):
+        import pybtex.database
+
+        src = srcinfo['path']
+        is_url = srcinfo['is_url']
+        data = srcinfo['data']
+        bib_data = srcinfo['bib_data']
+        src_fp = srcinfo['fp']
+
+        if (srcinfo['cache_entry'] is not None):
+            num_entries = srcinfo['cache_entry'][3]
+            self._source_cache_used[src] = srcinfo['cache_entry']
+            if srcinfo['cache_refreshed']:
+                self._source_cache_dirty = True
 
         logger.info("Found Source: %s" %(src))
 
         try:
-            # parse bibtex
-            parser = inputbibtex.Parser()
-            bib_data = None
-            with io.StringIO(data) as stream:
+            if (bib_data is None):
+                # parse bibtex
                 try:
-                    bib_data = parser.parse_stream(stream)
+                    (bib_data, loaded_keys, num_entries) = self._parse_bibtex_source(data, wanted_keys)
                 except Exception as e:
                     # We don't skip to next source, because we've encountered an error in the
                     # BibTeX data itself: the file itself was properly found. So raise an error.
                     raise BibolamaziBibtexSourceError(unicode(e), fname=src)
 
+                if (not is_url and src_fp is not None):
+                    # remember the parsed data. Pickle it right away, as the entries will be
+                    # modified by the filters.
+                    self._source_cache_used[src] = (src_fp, pickle.dumps(bib_data, pickle.HIGHEST_PROTOCOL),
+                                                    loaded_keys, num_entries)
+                    self._source_cache_dirty = True
+
+            self._num_source_entries += num_entries
+
             if (self._bibliographydata is None):
                 # initialize bibliography data
                 self._bibliographydata = pybtex.database.BibliographyData()
@@ -1066,6 +1448,235 @@ class BibolamaziFile(object):
         return True
 
 
+    def _parse_bibtex_source(self, data, wanted_keys):
+        """
+        Parse the BibTeX data `data` (a unicode string). Returns a tuple `(bib_data,
+        loaded_keys, num_entries)`, where `loaded_keys` is `None` if all entries were
+        loaded, or else a set of the lower-case keys of the entries which were looked for,
+        and where `num_entries` is the number of entries in the data, loaded or not.
+
+        If `wanted_keys` is not `None`, then only the entries with those keys and the
+        entries they cross-reference are loaded. The other entries are still scanned
+        for syntax errors, but no `Entry` or `Person` objects are built for them.
+        """
+        # pybtex's parser is slow to import, only import it when we need it
+        import pybtex.database.input.bibtex as inputbibtex
+        from pybtex.utils import CaseInsensitiveSet
+
+        if wanted_keys is None:
+            with io.StringIO(data) as stream:
+                bib_data = inputbibtex.Parser().parse_stream(stream)
+            return (bib_data, None, len(bib_data.entries))
+
+        loaded_keys = set(k.lower() for k in wanted_keys)
+        while True:
+            parser = inputbibtex.Parser(wanted_entries=loaded_keys)
+            # keep the keys as they appear in the source; otherwise pybtex would spell
+            # them as in the set of wanted keys
+            parser.data.citations = CaseInsensitiveSet()
+            # keep track of all the entries in the source, including those we skip
+            source_keys = set()
+            def want_entry(key, want_entry=parser.data.want_entry):
+                source_keys.add(key.lower())
+                return want_entry(key)
+            parser.data.want_entry = want_entry
+            with io.StringIO(data) as stream:
+                bib_data = parser.parse_stream(stream)
+            del bib_data.want_entry
+            # Cross-referenced entries are added to the wanted entries as they are
+            # encountered; parse again if some of them came before the referencing entry.
+            missing = set(k.lower() for k in bib_data.wanted_entries
+                          if k.lower() not in loaded_keys and k not in bib_data.entries)
+            loaded_keys |= set(k.lower() for k in bib_data.wanted_entries)
+            if not missing:
+                return (bib_data, loaded_keys, len(source_keys))
+            logger.debug("Parsing again to get cross-referenced entries %r", list(missing))
+
+    def loadStreaming(self):
+        """
+        Prepare this object to process the bibliography entries in streaming mode.
+
+        In streaming mode, the entries are not loaded into :py:meth:`bibliographyData()`.
+        Rather, they are read one by one from the sources with :py:meth:`streamEntries()`,
+        and written out one by one with :py:meth:`saveToFile()`, so that only the entry
+        currently being processed needs to be held in memory.
+
+        This object must be in the state :py:const:`BIBOLAMAZIFILE_PARSED`. This function
+        loads the cache and initializes the cache accessors as when loading the file to
+        the state :py:const:`BIBOLAMAZIFILE_LOADED`, but the load state is left unchanged
+        and :py:meth:`bibliographyData()` remains `None`.
+        """
+        if (self._load_state != BIBOLAMAZIFILE_PARSED):
+            raise BibolamaziError(u"loadStreaming(): bibolamazi file `%s' must be in PARSED state"
+                                  %(self._fname))
+
+        self._bibliographydata = None
+
+        if (not len(self._source_lists)):
+            logger.warning("File `%s': No source files specified. You need source files to provide bib entries!"
+                           %(self._fname))
+
+        self._load_user_cache()
+
+
+    def streamEntries(self):
+        """
+        Iterate over the entries of all the sources, reading them incrementally.
+
+        This generator yields `(key, entry)` pairs in the same order and with the same
+        handling of repeated entries as when loading the sources into
+        :py:meth:`bibliographyData()`, but without storing them. Source files are parsed
+        piece by piece, so that memory use is bounded by the size of the largest entry
+        rather than by the size of the sources. See :py:meth:`loadStreaming()`.
+
+        :py:meth:`sources()` is updated as the sources are opened.
+        """
+        seen_keys = set()
+        for k in range(len(self._source_lists)):
+            srclist = self._source_lists[k]
+            self._sources[k] = None
+            entries = None
+            for src in srclist:
+                entries = self._stream_src(src)
+                if entries is not None:
+                    self._sources[k] = src
+                    break
+            if entries is None:
+                logger.warning("Ignoring nonexisting source list: %s" %(", ".join(srclist)))
+                continue
+
+            for key, entry in entries:
+                if (key.lower() in seen_keys):
+                    logger.warn('Repeated bibliography entry in other file: %s. Keeping first encountered entry.', key)
+                    continue
+                seen_keys.add(key.lower())
+                yield (key, entry)
+
+    def _stream_src(self, src):
+        """
+        Open the source `src` for streaming. Returns `None` if the source can't be read, or
+        an iterator over its `(key, entry)` pairs.
+        """
+        is_url = False
+        if (re.match('^[A-Za-z0-9+_-]+://.*', src)):
+            is_url = True
+
+        if (not is_url):
+            resolvedsrc = self.resolveSourcePath(src)
+            self._manifest_sources.append( (src, resolvedsrc) )
+            src = resolvedsrc
+        else:
+            self._manifest_volatile = True
+
+        if is_url:
+            logger.debug("Opening URL %r", src)
+            try:
+                f = urllib.urlopen(src)
+                if (f is None):
+                    return None
+                # we need all the data to guess its encoding anyway
+                stream = io.StringIO(butils.guess_encoding_decode(f.read()))
+                f.close()
+            except IOError:
+                return None
+        else:
+            logger.debug("Opening file %r", src)
+            try:
+                stream = io.open(src, 'r', encoding=_guess_file_encoding(src), newline='')
+            except IOError:
+                return None
+
+        logger.info("Found Source: %s" %(src))
+
+        return self._iter_bibtex_stream(stream, src)
+
+    def _iter_bibtex_stream(self, stream, src):
+        """
+        Parse the BibTeX data from the unicode text `stream` (which is closed when done),
+        and yield its `(key, entry)` pairs one by one. The results are the same as if
+        the whole data was parsed at once.
+
+        The data is split into chunks at lines starting with ``@``, and each chunk is
+        parsed separately, sharing the same macros. If a chunk ends in the middle of a
+        command (e.g. a field value contains a line starting with ``@``), it is extended
+        up to the next such line and parsed again.
+        """
+        import pybtex.database
+        import pybtex.database.input.bibtex as inputbibtex
+        from pybtex.scanner import PrematureEOF
+        from pybtex.errors import report_error
+
+        parser = inputbibtex.Parser()
+        parser.unnamed_entry_counter = 1
+
+        def handle_error(error):
+            if isinstance(error, PrematureEOF):
+                # maybe the chunk was just cut too early
+                raise error
+            parser.handle_error(error)
+
+        keys = set()
+        chunk = []
+        lineno = 1
+        try:
+            with stream:
+                for line in itertools.chain(stream, [None]):
+                    if (line is not None and (not chunk or not line.lstrip().startswith(u'@'))):
+                        chunk.append(line)
+                        continue
+
+                    text = u"".join(chunk)
+                    try:
+                        entries = self._parse_bibtex_chunk(parser, text, lineno, handle_error)
+                    except PrematureEOF as e:
+                        if (line is not None):
+                            chunk.append(line)
+                            continue
+                        # really the end of the file
+                        parser.handle_error(e)
+                        entries = []
+
+                    for key, entry in entries:
+                        if (key.lower() in keys):
+                            report_error(pybtex.database.BibliographyDataError(
+                                'repeated bibliograhpy entry: %s' % key))
+                            continue
+                        keys.add(key.lower())
+                        yield (key, entry)
+
+                    lineno += text.count(u'\n') + text.count(u'\r')
+                    chunk = [line]
+        except Exception as e:
+            # We don't skip to next source, because we've encountered an error in the
+            # BibTeX data itself: the file itself was properly found. So raise an error.
+            raise BibolamaziBibtexSourceError(unicode(e), fname=src)
+
+    def _parse_bibtex_chunk(self, parser, text, lineno, handle_error):
+        import pybtex.database
+        from bibolamazi.core.bibtexscanner import FastBibTeXEntryIterator
+
+        # same as parser.parse_stream(), but with fresh data for each chunk
+        parser.data = pybtex.database.BibliographyData()
+        entry_iterator = FastBibTeXEntryIterator(
+            text,
+            keyless_entries=parser.keyless_entries,
+            handle_error=handle_error,
+            want_entry=parser.data.want_entry,
+            macros=parser.macros,
+            start_lineno=lineno,
+        )
+        for entry in entry_iterator:
+            entry_type = entry[0]
+            entry_type_lower = entry_type.lower()
+            if entry_type_lower == 'string':
+                pass
+            elif entry_type_lower == 'preamble':
+                parser.process_preamble(*entry[1])
+            else:
+                parser.process_entry(entry_type, *entry[1])
+        return parser.data.entries.items()
+
+
 
     def setBibliographyData(self, bibliographydata):
         """
@@ -1100,6 +1711,7 @@ class BibolamaziFile(object):
         to the `bibliographyData()` object, the reference is still valid after
         calling this function.)
         """
+        from pybtex.utils import OrderedCaseInsensitiveDict
 
         # NOTE: Don't just set _bibliographydata to a new object, see warning in
         # doc of setBibliographyData().
@@ -1109,7 +1721,7 @@ class BibolamaziFile(object):
 
 
 
-    def saveToFile(self):
+    def saveToFile(self, entries=None):
         """
         Save the current bibolamazi file object to disk.
 
@@ -1126,44 +1738,325 @@ class BibolamaziFile(object):
         file was automatically generated.
 
         As the file `fname` is expected to already exist, it is always silently
-        overwritten (so be careful).
-        """
-        with codecs.open(self._fname, 'w', BIBOLAMAZI_FILE_ENCODING) as f:
-            f.write(self._header)
-            f.write(self._config)
-            f.write(_repl(AFTER_CONFIG_TEXT, {
-                r'__BIBOLAMAZI_VERSION__': butils.get_version(),
-                r'__DATETIME_NOW__': datetime.now().isoformat()
-                }))
+        overwritten (so be careful). The output is first written to a temporary file,
+        which then replaces `fname`. However, if the new contents is the same as that of
+        `fname` (apart from the time stamp in the warning message), then `fname` is left
+        untouched, so that its modification time doesn't change (which would, e.g.,
+        cause LaTeX documents using it to be needlessly recompiled).
+
+        If `entries` is given, it should be an iterable of `(key, entry)` pairs, which are
+        written instead of the contents of :py:meth:`bibliographyData`. Each entry is
+        written as soon as it is obtained, so `entries` may be a generator which reads and
+        filters the entries one by one (see :py:meth:`streamEntries()`). The file `fname`
+        is only replaced if all the entries were obtained without error.
+        """
+        import pybtex.database
+        from bibolamazi.core.bibtexwriter import FastBibTeXWriter
+
+        # if the file is a symlink, replace the file it points to
+        fname = os.path.realpath(self._fname)
+        tmpfname = fname + '.bibolamazitmp'
+        try:
+            with codecs.open(tmpfname, 'w', BIBOLAMAZI_FILE_ENCODING) as f:
+                self._write_header(f)
+                w = FastBibTeXWriter()
+
+                if (entries is not None):
+                    for key, entry in entries:
+                        # see comment below about entry.original_type
+                        entry.original_type = entry.type
+                        single = pybtex.database.BibliographyData()
+                        single.entries[key] = entry
+                        w.write_stream(single, f)
+
+                elif (self._bibliographydata):
+                    #
+                    # Pybtex 0.18: bibtex writer uses entry.original_type instead of
+                    # entry.type. (Why?? no idea)
+                    #
+                    # So if any filters changed entry.type, reflect that in
+                    # entry.original_type.
+                    for key, entry in self._bibliographydata.entries.iteritems():
+                        entry.original_type = entry.type
+
+                    #
+                    # Write to bibtex output
+                    #
+                    w.write_stream(self._bibliographydata, f)
+
+            if (_output_file_hash(tmpfname) == _output_file_hash(fname)):
+                os.remove(tmpfname)
+                logger.info("Output file `"+self._fname+"' is unchanged.")
+            else:
+                _replace_file(tmpfname, fname)
+                logger.info("Updated output file `"+self._fname+"'.")
+        except:
+            exc_info = sys.exc_info()
+            try:
+                os.remove(tmpfname)
+            except OSError:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        # the manifest only describes the output if we actually wrote the bibliography:
+        # if the file was only read (e.g. to save a new configuration), the output now
+        # has no entries and the next run must not be skipped.
+        self._save_caches(output_complete=(entries is not None or
+                                           self._load_state >= BIBOLAMAZIFILE_LOADED))
+
+
+    def _write_header(self, f):
+        f.write(self._header)
+        f.write(self._config)
+        f.write(_repl(AFTER_CONFIG_TEXT, {
+            r'__BIBOLAMAZI_VERSION__': butils.get_version(),
+            r'__DATETIME_NOW__': datetime.now().isoformat()
+            }))
+
+    def _save_caches(self, output_complete=True):
+        # write back the caches which have changed
+        if (self._user_cache):
+            self._user_cache.saveCacheStore()
+
+        if (self._source_cache_dirty or
+            (self._source_cache is not None and
+             set(self._source_cache.keys()) != set(self._source_cache_used.keys()))):
+            sourcecachefname = self.sourceCacheFileName()
+            try:
+                if _write_file_if_changed(sourcecachefname, pickle.dumps({
+                        'version': (_SOURCE_CACHE_VERSION, butils.get_version()),
+                        'sources': self._source_cache_used,
+                        }, pickle.HIGHEST_PROTOCOL)):
+                    logger.debug("Wrote parsed sources cache to file %s" %(sourcecachefname))
+            except (IOError, OSError) as e:
+                logger.debug("Couldn't save parsed sources cache to file `%s'." %(sourcecachefname))
+                pass
 
-            if (self._bibliographydata):
-                #
-                # Pybtex 0.18: bibtex writer uses entry.original_type instead of
-                # entry.type. (Why?? no idea)
-                #
-                # So if any filters changed entry.type, reflect that in
-                # entry.original_type.
-                for key, entry in self._bibliographydata.entries.iteritems():
-                    entry.original_type = entry.type
+        if (output_complete):
+            self._save_manifest()
+        else:
+            self._remove_manifest()
 
-                #
-                # Write to bibtex output
-                #
-                w = outputbibtex.Writer()
-                w.write_stream(self._bibliographydata, f)
-            
-            logger.info("Updated output file `"+self._fname+"'.")
 
-        # if we have cache to save, save it
-        if (self._user_cache and self._user_cache.hasCache()):
-            cachefname = self.cacheFileName()
-            try:
-                with open(cachefname, 'wb') as f:
-                    logger.debug("Writing cache to file %s" %(cachefname))
-                    self._user_cache.saveCache(f)
-            except IOError as e:
-                logger.debug("Couldn't save cache to file `%s'." %(cachefname))
-                pass
+    def _load_source_cache(self):
+        self._source_cache = {}
+        if not self._use_cache:
+            return
+        sourcecachefname = self.sourceCacheFileName()
+        try:
+            with open(sourcecachefname, 'rb') as f:
+                logger.longdebug("Reading parsed sources cache file %s" %(sourcecachefname))
+                data = pickle.load(f)
+        except Exception as e:
+            # IOError, EOFError, or some unpickling error...
+            logger.debug("Parsed sources cache file `%s' nonexisting or not readable: %s"
+                         %(sourcecachefname, e))
+            return
+        if (not isinstance(data, dict) or
+            data.get('version') != (_SOURCE_CACHE_VERSION, butils.get_version())):
+            logger.debug("Ignoring parsed sources cache file `%s' from another version."
+                         %(sourcecachefname))
+            return
+        self._source_cache = data['sources']
+
+    def _parsed_source_from_cache(self, path, wanted_keys=None):
+        """
+        Return a tuple `(bib_data, cache_entry, refreshed)`, where `bib_data` is the
+        parsed data of the source file `path` if it can be taken from the parsed sources
+        cache, or `None`. `cache_entry` is what should be stored in the cache for this
+        source, and `refreshed` is `True` if it differs from what is stored now.
+
+        This doesn't modify this object, except for loading the cache if needed.
+        """
+        if (self._source_cache is None):
+            self._load_source_cache()
+        if (path not in self._source_cache):
+            return (None, None, False)
+        (fp, pickled, loaded_keys, num_entries) = self._source_cache[path]
+        refreshed = False
+        if (loaded_keys is not None and
+            (wanted_keys is None or not loaded_keys.issuperset(k.lower() for k in wanted_keys))):
+            logger.debug("Source %s was only partially parsed, parsing it again", path)
+            return (None, None, False)
+        if not _fingerprint_matches(path, fp):
+            logger.debug("Source %s has changed, parsing it again", path)
+            return (None, None, False)
+        try:
+            bib_data = pickle.loads(pickled)
+        except Exception as e:
+            logger.debug("Can't load parsed source %s from cache: %s", path, e)
+            return (None, None, False)
+        try:
+            if (os.stat(path).st_mtime != fp['mtime']):
+                # the file was touched but is unchanged. Remember the new modification
+                # time, so that we don't need to hash the contents again next time.
+                fp = _file_fingerprint(path)
+                refreshed = True
+        except OSError:
+            pass
+        logger.debug("Loaded parsed source %s from cache", path)
+        return (bib_data, (fp, pickled, loaded_keys, num_entries), refreshed)
+
+
+    def _config_hash(self):
+        return hashlib.sha1((self._header + self._config).encode('utf-8')).hexdigest()
+
+    def _save_manifest(self):
+        manifest = {
+            'manifest_version': _MANIFEST_VERSION,
+            'bibolamazi_version': butils.get_version(),
+            'volatile': self._manifest_volatile,
+            'incomplete': self._manifest_incomplete,
+            'expires': self._manifest_expires,
+            'fdir': self._dir,
+            'config_hash': self._config_hash(),
+            'output': _file_fingerprint(self._fname),
+            'sources': [ (src, path, _file_fingerprint(path))
+                         for (src, path) in self._manifest_sources ],
+            'dependencies': [ (path, _file_fingerprint(path))
+                              for path in self._manifest_dependencies ],
+            }
+        manifestfname = self.manifestFileName()
+        try:
+            if _write_file_if_changed(manifestfname, json.dumps(manifest, indent=1, sort_keys=True)):
+                logger.debug("Wrote manifest to file %s" %(manifestfname))
+        except (IOError, OSError) as e:
+            logger.debug("Couldn't save manifest to file `%s'." %(manifestfname))
+            pass
+
+    def _remove_manifest(self):
+        manifestfname = self.manifestFileName()
+        try:
+            os.remove(manifestfname)
+            logger.debug("Removed manifest file %s" %(manifestfname))
+        except OSError:
+            pass
+
+
+
+_MANIFEST_VERSION = 2
+
+_SOURCE_CACHE_VERSION = 3
+
+def _file_sha1(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def _guess_file_encoding(fname):
+    """
+    Returns the encoding with which :py:func:`butils.guess_encoding_decode()` would decode
+    the contents of the file `fname`, without reading the whole file into memory.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(fname, 'rb') as f:
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                decoder.decode(data)
+            decoder.decode('', final=True)
+        except UnicodeDecodeError:
+            return 'latin1'
+    return 'utf-8'
+
+def _replace_file(fname, destfname):
+    """
+    Rename the file `fname` to `destfname`, replacing the latter if it exists. The new
+    file gets the permissions of the file it replaces.
+    """
+    if os.path.exists(destfname):
+        try:
+            shutil.copymode(destfname, fname)
+        except OSError:
+            pass
+        if sys.platform.startswith('win'):
+            # os.rename() doesn't replace existing files on windows
+            os.remove(destfname)
+    os.rename(fname, destfname)
+
+def _write_file_if_changed(fname, data):
+    """
+    Write the byte string `data` to the file `fname`, unless the file already has
+    exactly this contents. The file is replaced at once (see :py:func:`_replace_file()`),
+    so that it can never be seen half-written. Returns `True` if the file was written.
+    """
+    try:
+        if (os.path.getsize(fname) == len(data) and
+            _file_sha1(fname) == hashlib.sha1(data).hexdigest()):
+            return False
+    except (IOError, OSError):
+        pass
+    tmpfname = fname + '.bibolamazitmp'
+    try:
+        with open(tmpfname, 'wb') as f:
+            f.write(data)
+        _replace_file(tmpfname, fname)
+    except:
+        exc_info = sys.exc_info()
+        try:
+            os.remove(tmpfname)
+        except OSError:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return True
+
+# the line of AFTER_CONFIG_TEXT with the time stamp
+_rx_output_timestamp = re.compile(r'^(% This file was generated by BIBOLAMAZI \S+ on )(.*)$',
+                                  flags=re.MULTILINE)
+
+def _output_file_hash(fname):
+    """
+    Returns a hash of the contents of the bibolamazi file `fname`, ignoring the time
+    stamp which is included after the config section when the file is saved (see
+    :py:data:`AFTER_CONFIG_TEXT`). Returns `None` if the file can't be read.
+    """
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    m = _rx_output_timestamp.search(data, max(data.find(CONFIG_END_TAG), 0))
+    if m is not None:
+        data = data[:m.start(2)] + data[m.end(2):]
+    return hashlib.sha1(data).hexdigest()
+
+def _file_fingerprint(fname):
+    """
+    Returns a fingerprint of the given file as a dictionary with keys 'size', 'mtime' and
+    'sha1', or `None` if the file doesn't exist.
+    """
+    try:
+        st = os.stat(fname)
+        return { 'size': st.st_size, 'mtime': st.st_mtime, 'sha1': _file_sha1(fname) }
+    except (IOError, OSError):
+        return None
+
+def _fingerprint_matches(fname, fp):
+    """
+    Check that the file `fname` still matches the fingerprint `fp` (as returned by
+    :py:func:`_file_fingerprint()`). The contents is only hashed if the size matches
+    but the modification time doesn't, e.g. for a file which was rewritten with the
+    same contents.
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return (fp is None)
+    if (fp is None or st.st_size != fp['size']):
+        return False
+    if (st.st_mtime == fp['mtime']):
+        return True
+    try:
+        return (_file_sha1(fname) == fp['sha1'])
+    except IOError:
+        return False
 
         
 
@@ -0,0 +1,131 @@
+################################################################################
+#                                                                              #
+#   This file is part of the Bibolamazi Project.                               #
+#   Copyright (C) 2015 by Philippe Faist                                       #
+#   philippe.faist@bluewin.ch                                                  #
+#                                                                              #
+#   Bibolamazi is free software: you can redistribute it and/or modify         #
+#   it under the terms of the GNU General Public License as published by       #
+#   the Free Software Foundation, either version 3 of the License, or          #
+#   (at your option) any later version.                                        #
+#                                                                              #
+#   Bibolamazi is distributed in the hope that it will be useful,              #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of             #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              #
+#   GNU General Public License for more details.                               #
+#                                                                              #
+#   You should have received a copy of the GNU General Public License          #
+#   along with Bibolamazi.  If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                              #
+################################################################################
+
+"""
+A faster BibTeX writer.
+
+pybtex's :py:class:`pybtex.database.output.bibtex.Writer` checks that each value it
+writes has balanced braces by building a tree of
+:py:class:`pybtex.bibtex.utils.BibTeXString` objects, one character at a time, and it
+writes each field with a separate call to the output stream's `write()` method (which
+is costly when the stream is a `codecs` writer). This is most of the time spent writing
+large bibliographies.
+
+The :py:class:`FastBibTeXWriter` defined here is a drop-in replacement for pybtex's
+`Writer`, with the same API and exactly the same output and error messages. It is used
+by :py:meth:`BibolamaziFile.saveToFile()
+<bibolamazi.core.bibolamazifile.BibolamaziFile.saveToFile>`.
+"""
+
+import re
+
+import bibolamazi.init
+
+from pybtex.bibtex.exceptions import BibTeXError
+from pybtex.database.output.bibtex import Writer
+
+
+_rx_braces = re.compile(ur'[{}]')
+
+# the output is written to the stream in chunks of about this many pieces of text
+WRITE_CHUNK_SIZE = 4096
+
+
+class FastBibTeXWriter(Writer):
+    """
+    A :py:class:`pybtex.database.output.bibtex.Writer` which is faster:
+
+    - The braces in a value are checked by looking only at the brace characters, and
+      not at all at values without any opening brace;
+
+    - The text of the entries is collected, and written to the stream in large chunks.
+    """
+
+    def check_braces(self, s):
+        """
+        Raise a :py:exc:`BibTeXError` if the given string has unmatched braces, in
+        exactly the same cases as pybtex's `Writer`.
+
+        As for pybtex, a closing brace which doesn't close anything is an ordinary
+        character. A last group of braces which isn't closed is also accepted if it
+        starts with a backslash, as pybtex considers it to be a "special character".
+        """
+        if '{' not in s:
+            return
+        level = 0
+        group_start = None
+        for m in _rx_braces.finditer(s):
+            if m.group() == u'{':
+                if level == 0:
+                    group_start = m.end()
+                level += 1
+            elif level > 0:
+                level -= 1
+        if level != 0 and not s.startswith('\\', group_start):
+            raise BibTeXError('String has unmatched braces: %s' % s)
+
+    def format_name(self, person):
+        """
+        Return the name of the given :py:class:`pybtex.database.Person` as it is written
+        to the BibTeX output, i.e. "von Last, Jr, First Middle".
+        """
+        def join(l):
+            return ' '.join([name for name in l if name])
+        last = person.get_part_as_text('last')
+        lineage = person.get_part_as_text('lineage')
+        first = person.get_part_as_text('first')
+        middle = person.get_part_as_text('middle')
+        s = ''
+        if last:
+            s += join([person.get_part_as_text('prelast'), last])
+        if lineage:
+            s += ', %s' % lineage
+        if first or middle:
+            s += ', '
+            s += join([first, middle])
+        return s
+
+    def write_stream(self, bib_data, stream):
+        quote = self.quote
+        format_name = self.format_name
+
+        chunk = []
+
+        preamble = bib_data.get_preamble()
+        if preamble:
+            chunk.append(u'@preamble{%s}\n\n' % quote(preamble))
+
+        for key, entry in bib_data.entries.iteritems():
+            chunk.append(u'@%s{%s' % (entry.original_type, key))
+            for role, persons in entry.persons.iteritems():
+                if persons:
+                    chunk.append(u',\n    %s = %s' % (role, quote(u' and '.join([format_name(person)
+                                                                                  for person in persons]))))
+            for type, value in entry.fields.iteritems():
+                chunk.append(u',\n    %s = %s' % (type, quote(value)))
+            chunk.append(u'\n}\n\n')
+
+            if len(chunk) >= WRITE_CHUNK_SIZE:
+                stream.write(u''.join(chunk))
+                chunk = []
+
+        if chunk:
+            stream.write(u''.join(chunk))
@@ -19,34 +19,42 @@
 #                                                                              #
 ################################################################################
 
+import os.path
 import collections
+import contextlib
 import inspect
-import pickle
+import cPickle as pickle
+import sqlite3
 import traceback
 import logging
 
 import bibolamazi.init
-from pybtex.database import Entry, Person
 from bibolamazi.core.butils import call_with_args, BibolamaziError
 from bibolamazi.core.bibusercache import tokencheckers
+from bibolamazi.core.bibusercache import store
 
 logger = logging.getLogger(__name__)
 
 
 
 
-def _to_bibusercacheobj(obj, parent):
+def _to_bibusercacheobj(obj, parent, key=None):
     if (isinstance(obj, BibUserCacheDic) or isinstance(obj, BibUserCacheList)):
         # make sure we don't make copies of these objects, but keep references
         # to the original instance. Especially important for the on_set_bind_to
         # feature.
-        obj.set_parent(parent)
+        obj.set_parent(parent, key)
         return obj
+    # Build the new object before attaching it to the parent: the parent needs to be
+    # notified only once the object is stored in it.
     if (isinstance(obj, dict)):
-        return BibUserCacheDic(obj, parent=parent)
-    if (isinstance(obj, list)):
-        return BibUserCacheList(obj, parent=parent)
-    return obj
+        newobj = BibUserCacheDic(obj)
+    elif (isinstance(obj, list)):
+        newobj = BibUserCacheList(obj)
+    else:
+        return obj
+    newobj.set_parent(parent, key)
+    return newobj
 
 
 
@@ -66,6 +74,12 @@ class BibUserCacheDic(collections.MutableMapping):
     invalid or not. For example, the value could be `datetime` corresponding to the time
     when the entry was created, and the rule for validating the cache might be to check
     that the entry is not more than e.g. 3 days old.
+
+    Each child :py:class:`BibUserCacheDic` or :py:class:`BibUserCacheList` keeps a
+    reference to its parent and to the key(s) under which it is stored there, so that
+    changes are propagated to the parent (updating the parent's token for that item) in
+    constant time. When making many changes at once, consider grouping them with
+    :py:meth:`batch_changes`.
     """
     def __init__(self, *args, **kwargs):
         self._init_empty(on_set_bind_to_key=kwargs.pop('on_set_bind_to_key', None),
@@ -82,15 +96,47 @@ class BibUserCacheDic(collections.MutableMapping):
         self.tokenchecker = None
         self._on_set_bind_to_key = on_set_bind_to_key
         self.parent = parent
+        # the keys under which we are stored in self.parent
+        self._parent_keys = set()
+        # see batch_changes()
+        self._batch_level = 0
+        self._batch_keys = set()
+        self._batch_changed = False
+        # see set_validation(lazy=True): keys which haven't been validated yet
+        self._unvalidated_keys = None
+        # see validation_stats()
+        self._num_validated = 0
+        self._num_invalidated = 0
 
     def _guess_name_for_dbg(self):
-        if not self.parent:
+        if self.parent is None:
             return "<root>"
-        return next( (key for key, val in self.parent.iteritems()
-                      if val is self),
-                     "<unknown>")
-
-    def set_validation(self, tokenchecker, validate=True):
+        return next(iter(self._parent_keys), "<unknown>")
+
+    def _path_for_dbg(self):
+        names = []
+        obj = self
+        while isinstance(obj.parent, BibUserCacheDic):
+            names.insert(0, obj._guess_name_for_dbg())
+            obj = obj.parent
+        return "/".join(names)
+
+    def _keys_in_parent(self):
+        # the keys under which we are (still) stored in our parent
+        if not isinstance(self.parent, BibUserCacheDic):
+            return []
+        return [ key for key in self._parent_keys if self.parent.dic.get(key) is self ]
+
+    def _forget_child(self, key):
+        # the item `key` is about to be removed or replaced
+        val = self.dic.get(key)
+        if ((isinstance(val, BibUserCacheDic) or isinstance(val, BibUserCacheList))
+            and val.parent is self):
+            val._parent_keys.discard(key)
+        if self._batch_level:
+            self._batch_keys.discard(key)
+
+    def set_validation(self, tokenchecker, validate=True, lazy=False):
         """
         Set a function that will calculate the `token' for a given entry, for cache
         validation. The function `fn` shall compute a value based on a key (and possibly
@@ -99,6 +145,13 @@ class BibUserCacheDic(collections.MutableMapping):
         :py:mod:`tokencheckers` modules for more information about cache validation.
 
         If `validate` is `True`, then we immediately validate the contents of the cache.
+
+        If `lazy` is `True`, then each item is instead validated the first time it is
+        accessed (with `dic[key]` or `key in dic`). This avoids computing tokens for all
+        items when only a few of them are needed. Iterating over the dictionary, or
+        querying its length, validates all remaining items. Items which are never
+        accessed are kept as they are in the cache (they will be validated when they are
+        accessed in a later run). See also :py:meth:`validation_stats`.
         """
 
         if self.tokenchecker is tokenchecker:
@@ -111,9 +164,38 @@ class BibUserCacheDic(collections.MutableMapping):
         # this counts as a change, so save it
         self._do_pending_bind()
 
-        if validate:
+        if lazy:
+            self._unvalidated_keys = set(self.dic.keys())
+            root = self
+            while root.parent is not None:
+                root = root.parent
+            if isinstance(root, _BibUserCacheRootDic):
+                root.lazily_validated.append(self)
+        elif validate:
             self.validate()
 
+    def validation_stats(self):
+        """
+        Returns a dictionary with the number of items of this dictionary which were found
+        to be valid (`'validated'`) or invalid (`'invalidated'`) by
+        :py:meth:`validate_item` in this run, and the number of items which haven't been
+        validated because they were never accessed (`'untouched'`, see
+        :py:meth:`set_validation`).
+        """
+        return {
+            'validated': self._num_validated,
+            'invalidated': self._num_invalidated,
+            'untouched': len(self._unvalidated_keys) if self._unvalidated_keys else 0,
+            }
+
+    def _validate_on_access(self, key):
+        if self._unvalidated_keys and key in self._unvalidated_keys:
+            self.validate_item(key)
+
+    def _validate_remaining(self):
+        while self._unvalidated_keys:
+            self.validate_item(self._unvalidated_keys.pop())
+
     def validate(self):
         """
         Validate this whole dictionary, i.e. make sure that each entry is still valid.
@@ -121,6 +203,13 @@ class BibUserCacheDic(collections.MutableMapping):
         This calls `validate_item()` for each item in the dictionary.
         """
 
+        if self._unvalidated_keys:
+            self._unvalidated_keys.clear()
+
+        if not self.tokenchecker:
+            # every item is valid (see validate_item()); don't go through all of them
+            return
+
         keylist = self.dic.keys()
 
         for key in keylist:
@@ -137,6 +226,9 @@ class BibUserCacheDic(collections.MutableMapping):
 
         Returns `True` if have valid item, otherwise `False`.
         """
+        if self._unvalidated_keys:
+            self._unvalidated_keys.discard(key)
+
         if not key in self.dic:
             # not valid anyway.
             logger.longdebug("validate_item(): %s: no such key %s", self._guess_name_for_dbg(), key)
@@ -164,17 +256,59 @@ class BibUserCacheDic(collections.MutableMapping):
                 # still return True independently of what happens in val.validate(),
                 # because this dictionary is still valid.
             logger.longdebug("Cache item `%s' is valid; keeping", key)
+            self._num_validated += 1
             return True
 
         # otherwise, invalidate the cache. Don't just set to None or {} or [] because we
         # don't know what type the value is. This way is safe, because if getitem is
         # called, automatically an empty dic will be created.
         logger.longdebug("Cache item `%s' is NO LONGER VALID; trashing.", key)
+        self._num_invalidated += 1
+        self._forget_child(key)
         del self.dic[key]
         if key in self.tokens:
             del self.tokens[key]
         return False
 
+    def get_token(self, key):
+        """
+        Returns the validation token which is currently stored for the item `key`, or
+        `None` if there is no such item or if no token was computed for it.
+
+        The token identifies the state of the data from which the cached value was
+        computed (e.g., with a :py:class:`~tokencheckers.EntryFieldsTokenChecker`, a
+        hash of the relevant fields of the bibliography entry).
+        """
+        return self.tokens.get(key, None)
+
+    def is_stale(self, key):
+        """
+        Returns `True` if the item `key` is still valid, but should be refreshed when
+        possible, according to the token checker of this dictionary (see
+        :py:meth:`tokencheckers.TokenChecker.is_stale` and
+        :py:class:`tokencheckers.TokenCheckerStaleDate`). Returns `False` if there is no
+        such item or if no validation is set.
+        """
+        self._validate_on_access(key)
+        if not self.tokenchecker or key not in self.dic:
+            return False
+        return self.tokenchecker.is_stale(key=key, value=self.dic[key],
+                                          token=self.tokens.get(key, None))
+
+    def refresh_time(self, key):
+        """
+        Returns the date and time (a :py:class:`datetime.datetime`) from which the item
+        `key` should be refreshed, because it will have become stale or invalid according
+        to the token checker of this dictionary (see
+        :py:meth:`tokencheckers.TokenChecker.refresh_time`). Returns `None` if this
+        doesn't depend on time, if there is no such item or if no validation is set.
+        """
+        self._validate_on_access(key)
+        if not self.tokenchecker or key not in self.dic:
+            return None
+        return self.tokenchecker.refresh_time(key=key, value=self.dic[key],
+                                              token=self.tokens.get(key, None))
+
     def new_value_set(self, key=None):
         """
         Informs the dic that the value for `key` has been updated, and a new validation
@@ -186,65 +320,149 @@ class BibUserCacheDic(collections.MutableMapping):
         self._do_pending_bind()
 
         if key is None:
-            if not self.parent:
+            if self.parent is None:
                 logger.warning("BibUserCacheDic.new_value_set(): No parent set!")
-            try:
-                self.parent.new_value_set(next( (k for k,v in self.parent.iteritems()
-                                                 if v is self) ))
-            except StopIteration:
+            keys = self._keys_in_parent()
+            if not keys:
                 logger.warning("BibUserCacheDic.new_value_set(): Can't find ourselves in parent!")
+            for k in keys:
+                self.parent.new_value_set(k)
+
+        if self._batch_level:
+            # token will be computed at the end of the batch
+            self._batch_keys.add(key)
+            self._batch_changed = True
+            return
 
         if self.tokenchecker:
             self.tokens[key] = self.tokenchecker.new_token(key=key, value=self.dic.get(key))
             logger.longdebug("value changed in cache (key=%s), new value=%r, new token=%r", key, self.dic.get(key), self.tokens[key])
-        if self.parent:
+        if self.parent is not None:
             self.parent.child_notify_changed(self)
                 
 
+    @contextlib.contextmanager
+    def batch_changes(self):
+        """
+        Context manager which groups several changes to this dictionary (or to its
+        children), for example::
+
+            with entriesdic.batch_changes():
+                for key in keys:
+                    entriesdic[key] = ...
+                    entriesdic[key]['field'] = ...
+
+        Within the `with` block, validation tokens are not recomputed, and the parent
+        dictionary is not notified of changes. At the end of the block, the token of each
+        item which was changed is computed (once) from its final value, and the parent is
+        notified (once). The resulting tokens are the same as without batching, as long
+        as the token checker only depends on the key and the value of each item (and on
+        data which isn't changed during the batch, such as bibliography entries).
+
+        Batches may be nested; the tokens are computed at the end of the outermost batch.
+        """
+        self._batch_level += 1
+        try:
+            yield self
+        finally:
+            self._batch_level -= 1
+            if not self._batch_level:
+                self._end_batch()
+
+    def _end_batch(self):
+        keys = self._batch_keys
+        changed = self._batch_changed
+        self._batch_keys = set()
+        self._batch_changed = False
+        if self.tokenchecker:
+            for key in keys:
+                self.tokens[key] = self.tokenchecker.new_token(key=key, value=self.dic.get(key))
+        if changed and self.parent is not None:
+            self.parent.child_notify_changed(self)
+
     def __getitem__(self, key):
-        return self.dic.get(key, BibUserCacheDic({}, parent=self, on_set_bind_to_key=key))
+        self._validate_on_access(key)
+        try:
+            return self.dic[key]
+        except KeyError:
+            return BibUserCacheDic({}, parent=self, on_set_bind_to_key=key)
 
     def __setitem__(self, key, val):
-        self.dic[key] = _to_bibusercacheobj(val, parent=self)
+        if self._unvalidated_keys:
+            # the new value is up-to-date
+            self._unvalidated_keys.discard(key)
+        if key in self.dic and self.dic[key] is not val:
+            self._forget_child(key)
+        self.dic[key] = _to_bibusercacheobj(val, parent=self, key=key)
         self._do_pending_bind()
         # assume that we __setitem__ is called, the value is up-to-date, ie. update the
         # corresponding token.
         self.new_value_set(key)
 
     def __delitem__(self, key):
+        if self._unvalidated_keys:
+            self._unvalidated_keys.discard(key)
+        self._forget_child(key)
         del self.dic[key]
         if key in self.tokens:
             del self.tokens[key]
-        if self.parent:
+        if self._batch_level:
+            self._batch_changed = True
+            return
+        if self.parent is not None:
             self.parent.child_notify_changed(self)
 
     def iteritems(self):
+        self._validate_remaining()
         return self.dic.iteritems()
 
     def __iter__(self):
+        self._validate_remaining()
         return iter(self.dic)
 
     def __len__(self):
+        self._validate_remaining()
         return len(self.dic)
 
     def __contains__(self, key):
+        self._validate_on_access(key)
         return key in self.dic
 
+    def clear(self):
+        # no need to validate the items we are removing
+        if self._unvalidated_keys:
+            self._unvalidated_keys.clear()
+        super(BibUserCacheDic, self).clear()
+
 
     def child_notify_changed(self, obj):
+        # the keys under which obj is stored (it could be that the same object is pointed
+        # to by different keys)
+        keys = [ key for key in obj._parent_keys if self.dic.get(key) is obj ]
+
+        if self._batch_level:
+            self._batch_keys.update(keys)
+            self._batch_changed = True
+            return
+
         # update cache validation tokens for this object
         if self.tokenchecker:
-            for key, val in self.dic.iteritems():
-                if val is obj:
-                    self.tokens[key] = self.tokenchecker.new_token(key=key, value=val)
-                    # don't break, as it could be that the same object is pointed to by
-                    # different keys... so complete the for loop
+            for key in keys:
+                self.tokens[key] = self.tokenchecker.new_token(key=key, value=obj)
         
-        if self.parent:
+        if self.parent is not None:
             self.parent.child_notify_changed(self)
 
-    def set_parent(self, parent):
+    def set_parent(self, parent, key=None):
+        """
+        Set the parent of this object. If `key` is given, it is the key under which this
+        object is stored in `parent`.
+        """
+        if parent is not self.parent:
+            self._parent_keys = set()
         self.parent = parent
+        if key is not None:
+            self._parent_keys.add(key)
 
     def _do_pending_bind(self):
         if (self._on_set_bind_to_key is not None and
@@ -270,10 +488,12 @@ class BibUserCacheDic(collections.MutableMapping):
         self.dic = state['cache']
         self.tokens = state['tokens']
 
+        _restore_parent_keys(self)
+
 
     def __getstate__(self):
         state = {
-            'parent': self.parent,
+            'parent': _pickled_parent(self),
             'cache': self.dic,
             'tokens': self.tokens,
             }
@@ -281,13 +501,130 @@ class BibUserCacheDic(collections.MutableMapping):
 
 
 
+class _BibUserCacheRootDic(BibUserCacheDic):
+    """
+    The root dictionary of a :py:class:`BibUserCache`. In addition to what a
+    :py:class:`BibUserCacheDic` does, this keeps track of which sub-caches have changed
+    (in `changed_keys`), so that only those need to be saved.
+    """
+    def _init_empty(self, *args, **kwargs):
+        super(_BibUserCacheRootDic, self)._init_empty(*args, **kwargs)
+        self.changed_keys = set()
+        # dictionaries in this cache which are validated lazily, see set_validation()
+        self.lazily_validated = []
+
+    def new_value_set(self, key=None):
+        super(_BibUserCacheRootDic, self).new_value_set(key)
+        if key is not None:
+            self.changed_keys.add(key)
+
+    def child_notify_changed(self, obj):
+        super(_BibUserCacheRootDic, self).child_notify_changed(obj)
+        self.changed_keys.update([ key for key in obj._parent_keys if self.dic.get(key) is obj ])
+
+    def __delitem__(self, key):
+        super(_BibUserCacheRootDic, self).__delitem__(key)
+        self.changed_keys.add(key)
+
+    @classmethod
+    def from_dic(cls, dic):
+        """
+        Return a root dictionary with the same contents and tokens as the
+        :py:class:`BibUserCacheDic` `dic` (e.g. as loaded from an older cache file).
+        """
+        root = cls({})
+        root.dic = dic.dic
+        root.tokens = dic.tokens
+        for key, val in root.dic.iteritems():
+            if (isinstance(val, BibUserCacheDic) or isinstance(val, BibUserCacheList)):
+                val.set_parent(root, key)
+        return root
+
+
+
+def _restore_parent_keys(obj):
+    """
+    Restore the references to their keys in their parent (see
+    :py:meth:`BibUserCacheDic.set_parent`) of the unpickled object `obj` and of its
+    children.
+    """
+    # Depending on the order in which the objects are unpickled, either the children of
+    # obj are already restored ...
+    if isinstance(obj, BibUserCacheDic):
+        children = obj.dic.iteritems()
+    else:
+        children = [ (None, val) for val in obj.lst ]
+    for key, val in children:
+        if ((isinstance(val, BibUserCacheDic) or isinstance(val, BibUserCacheList))
+            and hasattr(val, 'parent')):
+            if val.parent is None:
+                # was stored without its parent, see _pickled_parent()
+                val.parent = obj
+            if val.parent is obj and key is not None:
+                val._parent_keys.add(key)
+    # ... or the parent of obj is.
+    parent = obj.parent
+    if isinstance(parent, BibUserCacheDic) and hasattr(parent, 'dic'):
+        for key, val in parent.dic.iteritems():
+            if val is obj:
+                obj._parent_keys.add(key)
+
+
+
+# the sub-cache dictionary which BibUserCache.saveCacheStore() is currently pickling
+_pickling_shard = None
+
+def _pickled_parent(obj):
+    """
+    Return the parent of `obj` which should be pickled along with it.
+
+    While a sub-cache is being pickled on its own (see
+    :py:meth:`BibUserCache.saveCacheStore`), objects which belong to another sub-cache
+    (e.g. because a filter stored in its cache an object obtained from another cache)
+    are stored without their parent, so that the rest of the cache isn't pickled along
+    with them. When unpickled, such an object becomes a child of the object which
+    contains it.
+    """
+    parent = obj.parent
+    if _pickling_shard is None:
+        return parent
+    p = parent
+    while p is not None:
+        if p is _pickling_shard:
+            return parent
+        p = getattr(p, 'parent', None)
+    return None
+
+
 class BibUserCacheList(collections.MutableSequence):
     def __init__(self, *args, **kwargs):
         self.lst = []
         self.parent = kwargs.pop('parent', None)
+        self._parent_keys = set()
         for x in list(*args, **kwargs):
             self.append(x)
 
+    def set_parent(self, parent, key=None):
+        """
+        Set the parent of this object, see :py:meth:`BibUserCacheDic.set_parent`.
+        """
+        if parent is not self.parent:
+            self._parent_keys = set()
+        self.parent = parent
+        if key is not None:
+            self._parent_keys.add(key)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._parent_keys = set()
+        _restore_parent_keys(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_parent_keys', None)
+        state['parent'] = _pickled_parent(self)
+        return state
+
     def __getitem__(self, index):
         return self.lst[index]
 
@@ -313,7 +650,7 @@ class BibUserCacheList(collections.MutableSequence):
 
     def _do_changing_operation(self, val, fn):
         ret = fn(None if val is None else _to_bibusercacheobj(val, parent=self))
-        if self.parent:
+        if self.parent is not None:
             self.parent.child_notify_changed(self)
         return ret
     
@@ -330,10 +667,15 @@ class BibUserCache(object):
     :py:meth:`cacheFor`.)
 
     (Internally, the caches are stored in one root :py:class:`BibUserCacheDic`.)
+
+    The cache is stored on disk in a *cache store* (see :py:mod:`.store`), in which each
+    cache dictionary is a separate shard: it is only loaded when it is first requested
+    with :py:meth:`cacheFor`, and only written back if it has changed. See
+    :py:meth:`loadCacheStore` and :py:meth:`saveCacheStore`.
     """
     def __init__(self, cache_version=None):
         logger.longdebug("BibUserCache: Constructor!")
-        self.cachedic = BibUserCacheDic({})
+        self.cachedic = _BibUserCacheRootDic({})
         self.entry_validation_checker = tokencheckers.TokenCheckerPerEntry()
         self.comb_validation_checker = tokencheckers.TokenCheckerCombine(
             tokencheckers.VersionTokenChecker(cache_version),
@@ -343,6 +685,14 @@ class BibUserCache(object):
         # an instance of an expiry_checker that several entries might share in
         # self.entry_validation_checker.
         self.expiry_checker = tokencheckers.TokenCheckerDate()
+        # same, for caches which keep serving expired (stale) entries for a while, see
+        # cacheStaleExpirationTokenChecker()
+        self.stale_expiry_checker = tokencheckers.TokenCheckerStaleDate()
+        # the cache store, see loadCacheStore()
+        self._store = None
+        self._store_use_existing = False
+        self._store_clear = False
+        self._shards_tried = set()
 
     def setDefaultInvalidationTime(self, time_delta):
         """
@@ -350,6 +700,15 @@ class BibUserCache(object):
         valid (by default).
         """
         self.expiry_checker.set_time_valid(time_delta)
+        self.stale_expiry_checker.set_time_valid(time_delta)
+
+    def setDefaultMaxAge(self, time_delta):
+        """
+        A timedelta object giving the maximum age of data in caches which keep using
+        expired data until it can be refreshed (see
+        :py:meth:`cacheStaleExpirationTokenChecker`). Older data is discarded.
+        """
+        self.stale_expiry_checker.set_max_age(time_delta)
 
 
     def cacheFor(self, cache_name):
@@ -357,6 +716,8 @@ class BibUserCache(object):
         Returns the cache dictionary object for the given cache name. If the cache
         dictionary does not exist, it is created.
         """
+        self._load_shard(cache_name)
+
         if not cache_name in self.cachedic:
             self.cachedic[cache_name] = {}
 
@@ -375,6 +736,21 @@ class BibUserCache(object):
         general validator to your full cache; this is generally what you might want.
         """
         return self.expiry_checker
+
+    def cacheStaleExpirationTokenChecker(self):
+        """
+        Returns a cache expiration token checker validator implementing a
+        *stale-while-revalidate* policy (see
+        :py:class:`~tokencheckers.TokenCheckerStaleDate`), configured with the default
+        cache invalidation time and maximum age.
+
+        This may be used as a token checker for sub-caches storing information fetched
+        from online services: expired entries are not discarded, but are reported as
+        stale by :py:meth:`BibUserCacheDic.is_stale`, so that they may be used while they
+        are being refreshed. They are only discarded once they reach the maximum age (see
+        :py:meth:`setDefaultMaxAge`).
+        """
+        return self.stale_expiry_checker
     
 
     def installCacheExpirationChecker(self, cache_name):
@@ -405,6 +781,8 @@ class BibUserCache(object):
         :py:meth:`~core.bibusercache.BibUserCacheDic.set_validation` to install a
         specific validator instance.
         """
+        self._load_shard(cache_name)
+
         if not cache_name in self.cachedic:
             raise ValueError("Invalid cache name: %s"%(cache_name))
         
@@ -439,11 +817,11 @@ class BibUserCache(object):
         """
         try:
             data = pickle.load(cachefobj);
-            self.cachedic = data['cachedic']
+            self.cachedic = _BibUserCacheRootDic.from_dic(data['cachedic'])
         except Exception as e:
             logger.longdebug("EXCEPTION IN pickle.load():\n%s", traceback.format_exc())
             logger.debug("IGNORING EXCEPTION IN pickle.load(): %s.", e)
-            self.cachedic = BibUserCacheDic({})
+            self.cachedic = _BibUserCacheRootDic({})
             pass
         
         self.cachedic.set_validation(self.comb_validation_checker)
@@ -464,6 +842,135 @@ class BibUserCache(object):
         logger.longdebug("Saving cache. Cache keys are: %r", self.cachedic.dic.keys())
         pickle.dump(data, cachefobj, protocol=2);
 
+    def loadCacheStore(self, fname, use_existing=True):
+        """
+        Use the cache store file `fname` to load and save the cache (see :py:mod:`.store`).
+
+        The cache dictionaries are not loaded right away: each one is loaded (and
+        validated) when it is first requested with :py:meth:`cacheFor`. Cache
+        dictionaries which are not requested are kept unchanged in the file.
+
+        If `use_existing` is `False`, then the existing contents of the file is ignored,
+        and it is replaced when the cache is saved.
+
+        If `fname` is a cache file in the older format (a single pickle, see
+        :py:meth:`loadCache`), then it is loaded right away, and it is converted to a
+        cache store when the cache is saved.
+        """
+        self._store = store.ShardedCacheStore(fname)
+        self._store_use_existing = use_existing
+        self._store_clear = not use_existing
+        self._shards_tried = set()
+
+        if (use_existing and os.path.exists(fname) and not store.is_store_file(fname)):
+            logger.debug("Loading cache file `%s' in old format", fname)
+            try:
+                with open(fname, 'rb') as f:
+                    self.loadCache(f)
+            except IOError as e:
+                logger.debug("Can't read cache file `%s': %s", fname, e)
+            # everything is loaded now; write it all to the new store
+            self.cachedic.changed_keys.update(self.cachedic.keys())
+            self._store_use_existing = False
+            self._store_clear = True
+
+    def saveCacheStore(self, names=None):
+        """
+        Write back the cache dictionaries which have changed to the cache store file given
+        to :py:meth:`loadCacheStore`. Does nothing if no cache store was set.
+
+        If `names` is not `None`, only the given cache dictionaries are written (if they
+        have changed). This may be used by cache accessors to save information which was
+        expensive to obtain as soon as possible, e.g. in case the run is interrupted.
+
+        If the cache can't be saved, the error is logged and ignored (the cache will
+        simply be regenerated next time).
+        """
+        global _pickling_shard
+        if self._store is None:
+            return
+        if names is not None:
+            if self._store_clear:
+                # the whole store needs to be written anyway
+                return self.saveCacheStore()
+            names = self.cachedic.changed_keys & set(names)
+            if not names:
+                return
+        else:
+            for dic in self.cachedic.lazily_validated:
+                stats = dic.validation_stats()
+                logger.debug("Cache `%s': %d item(s) validated, %d invalidated, %d untouched",
+                             dic._path_for_dbg(), stats['validated'], stats['invalidated'],
+                             stats['untouched'])
+            if self._store_clear:
+                names = set(self.cachedic.keys()) | self.cachedic.changed_keys
+            else:
+                names = set(self.cachedic.changed_keys)
+        if not names and not self._store_clear:
+            logger.debug("No changes in cache, not saving it")
+            return
+
+        shards = {}
+        for name in names:
+            dic = self.cachedic.dic.get(name, None)
+            if dic is None:
+                # remove from store
+                shards[name] = None
+                continue
+            # don't pickle the root dictionary or other sub-caches along with this one
+            _pickling_shard = dic
+            try:
+                shards[name] = (pickle.dumps(self.cachedic.tokens.get(name, None), 2),
+                                pickle.dumps(dic, 2))
+            finally:
+                _pickling_shard = None
+
+        logger.debug("Saving cache dictionaries %s to `%s'", ", ".join(sorted(shards.keys())),
+                     self._store.fname)
+        try:
+            self._store.save_shards(shards, clear=self._store_clear)
+        except (sqlite3.Error, IOError, OSError) as e:
+            logger.debug("Couldn't save cache to file `%s': %s", self._store.fname, e)
+            return
+
+        self.cachedic.changed_keys -= set(shards.keys())
+        self._store_clear = False
+
+    def _load_shard(self, cache_name):
+        """
+        Load the cache dictionary `cache_name` from the cache store, if it hasn't been
+        loaded yet.
+        """
+        if (self._store is None or not self._store_use_existing or
+            cache_name in self._shards_tried):
+            return
+        self._shards_tried.add(cache_name)
+        if cache_name in self.cachedic:
+            # e.g. from a cache file in the old format
+            return
+
+        try:
+            shard = self._store.load_shard(cache_name)
+            if shard is None:
+                return
+            token = pickle.loads(shard[0])
+            dic = pickle.loads(shard[1])
+        except Exception as e:
+            logger.debug("Ignoring cache `%s', which can't be loaded: %s", cache_name, e)
+            return
+        if not isinstance(dic, BibUserCacheDic):
+            logger.debug("Ignoring invalid cache `%s'", cache_name)
+            return
+
+        logger.longdebug("Loaded cache `%s' from the cache store", cache_name)
+        dic.set_parent(self.cachedic, cache_name)
+        self.cachedic.dic[cache_name] = dic
+        if token is not None:
+            self.cachedic.tokens[cache_name] = token
+        if not self.cachedic.validate_item(cache_name):
+            # so that it is also removed from the store
+            self.cachedic.changed_keys.add(cache_name)
+
 
 
 
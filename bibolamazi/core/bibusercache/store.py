@@ -0,0 +1,162 @@
+################################################################################
+#                                                                              #
+#   This file is part of the Bibolamazi Project.                               #
+#   Copyright (C) 2014 by Philippe Faist                                       #
+#   philippe.faist@bluewin.ch                                                  #
+#                                                                              #
+#   Bibolamazi is free software: you can redistribute it and/or modify         #
+#   it under the terms of the GNU General Public License as published by       #
+#   the Free Software Foundation, either version 3 of the License, or          #
+#   (at your option) any later version.                                        #
+#                                                                              #
+#   Bibolamazi is distributed in the hope that it will be useful,              #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of             #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              #
+#   GNU General Public License for more details.                               #
+#                                                                              #
+#   You should have received a copy of the GNU General Public License          #
+#   along with Bibolamazi.  If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                              #
+################################################################################
+
+"""
+Storage of the bibolamazi cache on disk.
+
+The cache file is an SQLite database in which each sub-cache (see
+:py:meth:`~core.bibusercache.BibUserCache.cacheFor`) is stored separately as a *shard*,
+along with its validation token in the root cache dictionary. This way, only the
+sub-caches which are actually used need to be loaded, and only those which have changed
+need to be written back.
+"""
+
+import os
+import os.path
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# the first bytes of any SQLite 3 database file
+_SQLITE_HEADER = 'SQLite format 3\x00'
+
+# increase this if the layout of the database changes
+STORE_VERSION = 1
+
+
+def is_store_file(fname):
+    """
+    Returns `True` if the file `fname` exists and is an SQLite database (as opposed to,
+    e.g., a cache file in the older pickle format).
+    """
+    try:
+        with open(fname, 'rb') as f:
+            return (f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER)
+    except IOError:
+        return False
+
+
+class ShardedCacheStore(object):
+    """
+    An SQLite database file storing cache shards.
+
+    Each shard is identified by its name, and consists of a pickled token and pickled
+    data (this class only deals with the pickled strings). A new database connection is
+    opened for each operation, so that the object may safely be kept across forks of
+    the process.
+
+    Errors are reported as :py:exc:`sqlite3.Error` (or :py:exc:`IOError`) exceptions.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def _connect(self):
+        conn = sqlite3.connect(self.fname)
+        conn.text_factory = str
+        return conn
+
+    def _check_version(self, conn):
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.OperationalError:
+            # no such table
+            return False
+        return (row is not None and row[0] == str(STORE_VERSION))
+
+    def load_shard(self, name):
+        """
+        Returns the tuple `(pickled_token, pickled_data)` stored for the shard `name`, or
+        `None` if there is no such shard (or if the database is from another version).
+        """
+        if not os.path.exists(self.fname):
+            return None
+        conn = self._connect()
+        try:
+            if not self._check_version(conn):
+                logger.debug("Cache store `%s' is from another version, ignoring it", self.fname)
+                return None
+            row = conn.execute("SELECT token, data FROM shards WHERE name = ?", (name,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return (str(row[0]), str(row[1]))
+
+    def _shard_is_stored(self, conn, name, shard):
+        row = conn.execute("SELECT token, data FROM shards WHERE name = ?", (name,)).fetchone()
+        if shard is None:
+            return (row is None)
+        return (row is not None and (str(row[0]), str(row[1])) == shard)
+
+    def save_shards(self, shards, clear=False):
+        """
+        Write the given shards to the database, in a single transaction.
+
+        `shards` is a dictionary of `{ name: (pickled_token, pickled_data) }`. A value of
+        `None` removes the shard from the database. The other shards in the database are
+        left untouched, unless `clear` is `True`, in which case they are all removed.
+        Shards which are already stored with the same contents are not written again; if
+        this applies to all the shards, the file isn't modified at all.
+
+        If the file exists but isn't a valid store of the current version, it is
+        replaced.
+        """
+        if os.path.exists(self.fname):
+            valid = False
+            if is_store_file(self.fname):
+                conn = self._connect()
+                try:
+                    valid = self._check_version(conn)
+                    if valid and not clear:
+                        # don't rewrite the shards which are stored with the same contents
+                        shards = dict( (name, shard) for (name, shard) in shards.iteritems()
+                                       if not self._shard_is_stored(conn, name, shard) )
+                finally:
+                    conn.close()
+            if not valid:
+                logger.debug("Replacing cache file `%s' by a new cache store", self.fname)
+                os.remove(self.fname)
+            elif not shards and not clear:
+                # nothing actually changed, don't touch the file
+                logger.debug("Cache store `%s' is already up to date", self.fname)
+                return
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS shards "
+                             "(name TEXT PRIMARY KEY, token BLOB, data BLOB)")
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                             (str(STORE_VERSION),))
+                if clear:
+                    conn.execute("DELETE FROM shards")
+                for (name, shard) in shards.iteritems():
+                    if shard is None:
+                        conn.execute("DELETE FROM shards WHERE name = ?", (name,))
+                        continue
+                    (token, data) = shard
+                    conn.execute("INSERT OR REPLACE INTO shards (name, token, data) VALUES (?, ?, ?)",
+                                 (name, sqlite3.Binary(token), sqlite3.Binary(data)))
+        finally:
+            conn.close()
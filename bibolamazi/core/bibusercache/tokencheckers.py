@@ -54,7 +54,6 @@ import hashlib
 import logging
 
 import bibolamazi.init
-from pybtex.database import Entry, Person
 
 logger = logging.getLogger(__name__)
 
@@ -125,6 +124,28 @@ class TokenChecker(object):
             logger.debug("Got exception in TokenChecker.cmp_tokens: ignoring and invalidating: %s", e)
             return False
 
+    def is_stale(self, key, value, token, **kwargs):
+        """
+        Checks to see if the dictionary entry `(key, value)`, which is still valid
+        according to :py:meth:`cmp_tokens`, should nevertheless be refreshed when possible
+        (see :py:class:`TokenCheckerStaleDate`). The current token of the entry is given
+        in `token`.
+
+        The default implementation returns `False`.
+        """
+        return False
+
+    def refresh_time(self, key, value, token, **kwargs):
+        """
+        Returns the date and time (a :py:class:`datetime.datetime`) from which the
+        dictionary entry `(key, value)` should be refreshed, because it will have become
+        stale or invalid, or `None` if this doesn't depend on time. The current token of
+        the entry is given in `token`.
+
+        The default implementation returns `None`.
+        """
+        return None
+
 
 class TokenCheckerDate(TokenChecker):
     """
@@ -158,6 +179,59 @@ class TokenCheckerDate(TokenChecker):
     def new_token(self, **kwargs):
         return datetime.datetime.now()
 
+    def refresh_time(self, key, value, token, **kwargs):
+        # this is when the entry is invalidated, or when it becomes stale for a
+        # TokenCheckerStaleDate
+        try:
+            return token + self.time_valid
+        except Exception as e:
+            logger.debug("Got exception in TokenCheckerDate.refresh_time, probably not a datetime "
+                         "object: %s", e)
+            return None
+
+
+class TokenCheckerStaleDate(TokenCheckerDate):
+    """
+    A :py:class:`TokenCheckerDate` which implements a *stale-while-revalidate* policy.
+
+    Entries which are older than `time_valid` are not invalidated, but are only deemed to
+    be *stale* (see :py:meth:`is_stale`): they may still be used, but should be refreshed
+    when possible (e.g. the next time we query the online service they come from).
+    Entries are only invalidated once they are older than `max_age` (or `time_valid`, if
+    that is longer).
+
+    This avoids having all entries which were fetched at the same time expire at once,
+    forcing them all to be fetched again in a single run.
+    """
+    def __init__(self, time_valid=datetime.timedelta(days=5), max_age=datetime.timedelta(days=30),
+                 **kwargs):
+        super(TokenCheckerStaleDate, self).__init__(time_valid=time_valid, **kwargs)
+        self.max_age = max_age
+
+    def set_max_age(self, max_age):
+        self.max_age = max_age
+
+    def cmp_tokens(self, key, value, oldtoken, **kwargs):
+        now = datetime.datetime.now()
+        if oldtoken is None:
+            return False
+        try:
+            return ((now - oldtoken) < max(self.max_age, self.time_valid))
+        except Exception as e:
+            logger.debug("Got exception in TokenCheckerStaleDate.cmp_tokens, probably not a datetime "
+                         "object: ignoring and invalidating: %s", e)
+            return False
+
+    def is_stale(self, key, value, token, **kwargs):
+        if token is None:
+            return True
+        try:
+            return ((datetime.datetime.now() - token) >= self.time_valid)
+        except Exception as e:
+            logger.debug("Got exception in TokenCheckerStaleDate.is_stale, probably not a datetime "
+                         "object: %s", e)
+            return True
+
 
 class TokenCheckerCombine(TokenChecker):
     """
@@ -198,6 +272,27 @@ class TokenCheckerCombine(TokenChecker):
     def new_token(self, key, value, **kwargs):
         return  tuple( (chk.new_token(key=key, value=value, **kwargs) for chk in self.subcheckers) )
 
+    def is_stale(self, key, value, token, **kwargs):
+        try:
+            for k in range(len(self.subcheckers)):
+                if self.subcheckers[k].is_stale(key=key, value=value, token=token[k], **kwargs):
+                    return True
+            return False
+        except Exception as e:
+            logger.debug("Got exception in TokenCheckerCombine.is_stale: %s", e)
+            return True
+
+    def refresh_time(self, key, value, token, **kwargs):
+        # the earliest refresh time of all the checkers
+        try:
+            times = [ self.subcheckers[k].refresh_time(key=key, value=value, token=token[k], **kwargs)
+                      for k in range(len(self.subcheckers)) ]
+        except Exception as e:
+            logger.debug("Got exception in TokenCheckerCombine.refresh_time: %s", e)
+            return None
+        times = [ t for t in times if t is not None ]
+        return min(times) if times else None
+
 
 class TokenCheckerPerEntry(TokenChecker):
     """
@@ -273,14 +368,116 @@ class TokenCheckerPerEntry(TokenChecker):
 
 
 
+class EntryFingerprintIndex(object):
+    """
+    Digests of the individual fields of the entries of a bibliography database, which
+    can be shared between several :py:class:`EntryFieldsTokenChecker` instances checking
+    the same entries.
+
+    The digest of a field (or of the entry type, or of the names of the persons with a
+    given role) is computed the first time it is needed, and is only computed again if
+    the entry has changed in the meantime. A field's digest is reused as long as the
+    entry refers to the same (immutable) string object for that field, so that changes
+    made by filters are always detected. Persons are compared by their formatted names,
+    since :py:class:`pybtex.database.Person` objects may be modified in place.
+
+    The :py:class:`~core.bibolamazifile.BibolamaziFile` provides an instance for the
+    current run, see
+    :py:meth:`~core.bibolamazifile.BibolamaziFile.entryFingerprintIndex`.
+    """
+    def __init__(self, bibdata):
+        self.bibdata = bibdata
+        # { key: (field_digests, type_digest, persons_digests) }, where field_digests is
+        # { field: (value, digest) }, type_digest is [ (type, digest) ] and
+        # persons_digests is { role: (names, digest) }
+        self._digests = {}
+
+    def invalidate(self, key=None):
+        """
+        Forget the digests stored for the entry `key`, or for all entries if `key` is
+        `None`. This is not necessary when an entry is changed (this is detected
+        automatically), but may be used to free some memory.
+        """
+        if key is None:
+            self._digests = {}
+        else:
+            self._digests.pop(key, None)
+
+    def fingerprint(self, key, fields=[], store_type=False, store_persons=[]):
+        """
+        Return a digest of the given `fields` of the entry `key` (and of its type if
+        `store_type` is `True`, and of the persons with the roles `store_persons`). See
+        :py:class:`EntryFieldsTokenChecker`.
+
+        A missing entry is treated like an empty '@misc' entry.
+        """
+        entry = self.bibdata.entries.get(key, None)
+        if entry is None:
+            entry = _get_empty_entry()
+        try:
+            (field_digests, type_digest, persons_digests) = self._digests[key]
+        except KeyError:
+            (field_digests, type_digest, persons_digests) = self._digests[key] = ({}, [None], {})
+
+        digests = []
+
+        entryfields = entry.fields
+        # pybtex's FieldDict keeps the fields in a dictionary with lowercase keys. Look
+        # them up there directly, which is much faster. A field which isn't set is looked
+        # up by the FieldDict in the entry's persons and in the crossref'd entry, so only
+        # go through the FieldDict if it can find something there.
+        fieldvalues = getattr(entryfields, '_dict', None)
+        if fieldvalues is None or 'crossref' in fieldvalues:
+            lookup_missing = None # all of them
+        else:
+            lookup_missing = set(role.lower() for role in entry.persons)
+        for fld in fields:
+            value = fieldvalues.get(fld.lower(), None) if fieldvalues is not None else None
+            if value is None and (lookup_missing is None or fld.lower() in lookup_missing):
+                try:
+                    value = entryfields[fld]
+                except KeyError:
+                    pass
+            d = field_digests.get(fld, None)
+            if d is None or d[0] is not value:
+                d = field_digests[fld] = (value, hashlib.md5((value or u'').encode('utf-8')).digest())
+            digests.append(d[1])
+
+        if store_type:
+            d = type_digest[0]
+            if d is None or d[0] is not entry.type:
+                d = type_digest[0] = (entry.type, hashlib.md5(entry.type.encode('utf-8')).digest())
+            digests.append(d[1])
+
+        for role in store_persons:
+            names = u";".join([unicode(pers) for pers in entry.persons.get(role, [])])
+            d = persons_digests.get(role, None)
+            if d is None or d[0] != names:
+                d = persons_digests[role] = (names, hashlib.md5(names.encode('utf-8')).digest())
+            digests.append(d[1])
+
+        return hashlib.md5("".join(digests)).digest()
+
+_empty_entry = None
+
+def _get_empty_entry():
+    global _empty_entry
+    if _empty_entry is None:
+        from pybtex.database import Entry
+        _empty_entry = Entry('misc')
+    return _empty_entry
+
+
 class EntryFieldsTokenChecker(TokenChecker):
     """
     A :py:class:`TokenChecker` implementation that checks whether some fields of a
     bibliography entry have changed.
 
-    This works by calculating a MD5 hash of the contents of the given fields.
+    This works by calculating a MD5 hash of the digests of the contents of the given
+    fields, which are computed by an :py:class:`EntryFingerprintIndex`.
     """
-    def __init__(self, bibdata, fields=[], store_type=False, store_persons=[], **kwargs):
+    def __init__(self, bibdata, fields=[], store_type=False, store_persons=[],
+                 fingerprint_index=None, **kwargs):
         """
         Constructs a token checker that will invalidate an entry if any of its fields
         given here have changed.
@@ -299,30 +496,32 @@ class EntryFieldsTokenChecker(TokenChecker):
         roles in :py:class:`pybtex.database.Entry` : this is either 'author' or 'editor'). 
         Specify for example 'author' here instead of in the `fields` argument. This is
         because `pybtex` treats the 'author' and 'editor' fields specially.
+
+        `fingerprint_index` is the :py:class:`EntryFingerprintIndex` from which the
+        digests of the fields are obtained; usually you should pass the one returned by
+        :py:meth:`~core.bibolamazifile.BibolamaziFile.entryFingerprintIndex`, so that
+        the digests are shared with the other caches. If `None` (or if it refers to
+        another bibliography database than `bibdata`), a new index is created for this
+        token checker.
         """
         self.bibdata = bibdata
         self.fields = fields
         self.store_type = store_type
         if (isinstance(store_persons, bool)):
+            from pybtex.database import Person
             self.store_persons = Person.valid_roles
         else:
             self.store_persons = [x for x in store_persons]
+        if fingerprint_index is None or fingerprint_index.bibdata is not bibdata:
+            fingerprint_index = EntryFingerprintIndex(bibdata)
+        self.fingerprint_index = fingerprint_index
 
         super(EntryFieldsTokenChecker, self).__init__(**kwargs)
 
     def new_token(self, key, value, **kwargs):
-        entry = self.bibdata.entries.get(key,Entry('misc'))
-
-        data = "\n\n".join( (entry.fields.get(fld, '').encode('utf-8')
-                         for fld in self.fields) )
-        if self.store_type:
-            data += "\n\n" + entry.type.encode('utf-8')
-        if self.store_persons:
-            data += "".join([
-                ("\n\n"+p+":"+";".join([unicode(pers) for pers in entry.persons.get(p, [])]))
-                for p in self.store_persons ]).encode('utf-8')
-        
-        return hashlib.md5(data).digest()
+        return self.fingerprint_index.fingerprint(key, fields=self.fields,
+                                                  store_type=self.store_type,
+                                                  store_persons=self.store_persons)
 
 
 
@@ -33,6 +33,7 @@ import sys
 import argparse
 import textwrap
 import types
+import traceback
 from collections import namedtuple
 import logging
 
@@ -44,8 +45,8 @@ import bibolamazi.init
 # rest of the modules
 from . import blogger
 from . import version
-from .bibolamazifile import BibolamaziFile
-from .bibfilter import BibFilter
+from .bibolamazifile import BibolamaziFile, BIBOLAMAZIFILE_READ, BIBOLAMAZIFILE_PARSED, BIBOLAMAZIFILE_LOADED
+from .bibfilter import BibFilter, BibFilterError
 from . import argparseactions
 from . import butils
 from .butils import BibolamaziError
@@ -146,6 +147,12 @@ def get_args_parser():
                         help="Create a new bibolamazi file with a template configuration.");
     parser.add_argument('-F', '--list-filters', action=argparseactions.opt_list_filters, dest='list_filters',
                         help="Show a list of available filters along with their description, and exit.");
+    parser.add_argument('--import-arxiv-metadata', action=argparseactions.opt_import_arxiv_metadata,
+                        nargs=1, metavar='DUMPFILE',
+                        help="Import a bulk arXiv metadata dump (JSON lines or OAI-PMH XML, possibly "
+                        "gzipped) into the local arXiv metadata store, which is consulted before "
+                        "querying the arXiv API, and exit. The store is located at "
+                        "$BIBOLAMAZI_ARXIV_METADATA (default: ~/.bibolamazi/arxiv_metadata.db).");
     parser.add_argument('-C', '--no-cache', action='store_false', dest='use_cache', default=True,
                         help="Bypass and ignore any existing cache file, and regenerate the cache. If "
                         "the cache file exists, it will be overwritten.");
@@ -153,6 +160,31 @@ def get_args_parser():
                         default=None,
                         help="The default timeout after which to consider items in cache to be invalid. "
                         "Not all cache items honor this. Format: '<N><unit>' with unit=w/d/m/s");
+    parser.add_argument('--cache-max-age', dest='cache_max_age', type=butils.parse_timedelta,
+                        default=None,
+                        help="The maximum age of information fetched from online services (e.g. the "
+                        "arXiv API) which is still used after the cache timeout, until it is "
+                        "refreshed; older information is fetched again (default: 30d). "
+                        "Format: '<N><unit>' with unit=w/d/m/s");
+    parser.add_argument('--fuse-filters', action='store_true', dest='fuse_filters', default=False,
+                        help="Run consecutive filters which act on individual entries in a single pass "
+                        "over the entries, passing each entry through all these filters before moving "
+                        "on to the next entry.");
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, metavar='N',
+                        help="Run filters which act on individual entries, and which support it, in "
+                        "N parallel worker processes.");
+    parser.add_argument('--stream', action='store_true', dest='stream', default=False,
+                        help="Read, filter and write the entries one at a time, without loading "
+                        "the whole bibliography into memory. This is only possible if all filters "
+                        "act on individual entries independently; otherwise, the entries are "
+                        "processed normally.");
+    parser.add_argument('--force', action='store_true', dest='force', default=False,
+                        help="Run the filters and rewrite the bibolamazi file even if nothing has "
+                        "changed since the last run.");
+    parser.add_argument('--check', action='store_true', dest='check', default=False,
+                        help="Don't run anything, only check whether the bibolamazi file is up to "
+                        "date. Exits with a nonzero status if the sources, the configuration or any "
+                        "other file the filters read have changed since the last run.");
 
     parser.add_argument('--help', '-h', action=argparseactions.opt_action_help, nargs='?',
                         metavar='filter',
@@ -198,7 +230,8 @@ def get_args_parser():
 
 
 
-ArgsStruct = namedtuple('ArgsStruct', ('bibolamazifile', 'use_cache', 'cache_timeout'));
+ArgsStruct = namedtuple('ArgsStruct', ('bibolamazifile', 'use_cache', 'cache_timeout', 'cache_max_age',
+                                       'fuse_filters', 'jobs', 'force', 'check', 'stream'));
 
 
 
@@ -207,7 +240,9 @@ def main(argv=sys.argv[1:]):
     try:
 
         # run main program
-        _main_helper(argv)
+        exitstatus = _main_helper(argv)
+        if exitstatus:
+            sys.exit(exitstatus)
         
     except SystemExit:
         raise
@@ -265,11 +300,156 @@ def _main_helper(argv):
 
 
 
+def get_filter_stages(filters, fuse=False):
+    """
+    Split the list of filter instances `filters` into a list of *stages*, which are run
+    one after the other. Each stage is a list of filters.
+
+    If `fuse` is `False`, then each stage consists of a single filter. Otherwise,
+    consecutive filters with action :py:const:`BibFilter.BIB_FILTER_SINGLE_ENTRY` are
+    grouped into a single stage, as long as each of them agrees to be fused with the
+    preceding ones (see :py:meth:`BibFilter.can_fuse_with_previous()`). The entries are
+    then passed through all the filters of such a stage in a single pass.
+    """
+    stages = []
+    for filtr in filters:
+        if (fuse and stages and
+            filtr.action() == BibFilter.BIB_FILTER_SINGLE_ENTRY and
+            stages[-1][0].action() == BibFilter.BIB_FILTER_SINGLE_ENTRY and
+            filtr.can_fuse_with_previous()):
+            stages[-1].append(filtr)
+            continue
+        stages.append([filtr])
+    return stages
+
+
+# state of the filter stage being run in parallel. Worker processes are forked after this is
+# set, so that they inherit the filters and the bibliography data without having to pickle
+# them.
+_parallel_stage = None
+
+def _run_filter_stage_on_keys(keys):
+    (stage, bibdata) = _parallel_stage
+    results = []
+    try:
+        for k in keys:
+            entry = bibdata.entries[k]
+            for filtr in stage:
+                filtr.filter_bibentry(entry)
+            results.append((entry.type, entry.original_type, entry.fields.items(),
+                            [(role, list(perslist)) for (role, perslist) in entry.persons.iteritems()]))
+    except BibFilterError as e:
+        return ('filtererror', e.filtername, e.message)
+    except Exception:
+        return ('error', traceback.format_exc())
+    return ('ok', results)
+
+
+def run_filter_stage_parallel(stage, bibdata, jobs):
+    """
+    Pass all the entries of `bibdata` through the filters of `stage` (a list of filters,
+    see :py:func:`get_filter_stages()`), using `jobs` worker processes.
+
+    The entries are split into chunks which are processed in the workers, and the
+    resulting type, fields and persons of each entry are set back on the original entry
+    objects, so that the :py:class:`pybtex.database.BibliographyData` object and its
+    entries remain the same objects as before. All filters in `stage` must be
+    parallel-safe (see :py:meth:`BibFilter.can_run_in_parallel()`).
+
+    On platforms which cannot fork worker processes (Windows), the filters are simply run
+    serially.
+    """
+    global _parallel_stage
+
+    keys = list(bibdata.entries.keys())
+
+    if (sys.platform.startswith('win') or len(keys) < 2):
+        if (len(keys) >= 2):
+            logger.debug("Can't run filters in parallel on this platform, running them serially.")
+        for k in keys:
+            for filtr in stage:
+                filtr.filter_bibentry(bibdata.entries[k])
+        return
+
+    # a few chunks per worker, to balance the load
+    nchunks = min(len(keys), 4*jobs)
+    chunks = [ keys[(i*len(keys))//nchunks : ((i+1)*len(keys))//nchunks] for i in range(nchunks) ]
+
+    logger.debug("Running %d entries through %d worker processes", len(keys), jobs)
+
+    import multiprocessing
+    from pybtex.database import FieldDict
+    from pybtex.utils import OrderedCaseInsensitiveDict
+
+    _parallel_stage = (stage, bibdata)
+    try:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            chunkresults = pool.map(_run_filter_stage_on_keys, chunks)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _parallel_stage = None
+
+    for (chunk, res) in zip(chunks, chunkresults):
+        if (res[0] == 'filtererror'):
+            raise BibFilterError(res[1], res[2])
+        if (res[0] == 'error'):
+            raise BibolamaziError(u"Internal error in filter worker process:\n%s" %(res[1]))
+        for (k, (type_, original_type, fields, persons)) in zip(chunk, res[1]):
+            # update the original entry object in place
+            entry = bibdata.entries[k]
+            entry.type = type_
+            entry.original_type = original_type
+            entry.fields = FieldDict(entry, fields)
+            entry.persons = OrderedCaseInsensitiveDict(persons)
+
+
+def run_filters_streaming(bfile):
+    """
+    Run all the filters of the bibolamazi file object `bfile` in streaming mode: each
+    entry is read from the sources, passed through all the filters and written to the
+    output file before the next entry is read. All the filters must support this (see
+    :py:meth:`BibFilter.can_stream()`), and `bfile` must be in the state
+    :py:const:`BIBOLAMAZIFILE_PARSED`.
+
+    The original output file is only replaced once all entries have been successfully
+    processed.
+    """
+    filters = bfile.filters()
+
+    bfile.loadStreaming()
+
+    for filtr in filters:
+        logger.info("Filter: %s" %(filtr.getRunningMessage()));
+        filtr.prerun(bfile)
+
+    def filtered_entries():
+        n = 0
+        for (key, entry) in bfile.streamEntries():
+            for filtr in filters:
+                filtr.filter_bibentry(entry)
+            n += 1
+            yield (key, entry)
+        if not n:
+            logger.critical("No source entries found. Stopping before we overwrite the bibolamazi file.");
+            raise BibolamaziNoSourceEntriesError()
+
+    bfile.saveToFile(entries=filtered_entries())
+
+
 def run_bibolamazi(bibolamazifile, **kwargs):
     # defaults
     kwargs2 = {
         'use_cache': True,
         'cache_timeout': None,
+        'cache_max_age': None,
+        'fuse_filters': False,
+        'jobs': 1,
+        'force': False,
+        'check': False,
+        'stream': False,
         }
     kwargs2.update(kwargs);
     args = ArgsStruct(bibolamazifile, **kwargs2)
@@ -303,15 +483,46 @@ def run_bibolamazi_args(args):
     if args.cache_timeout is not None:
         logger.debug("default cache timeout: %r", args.cache_timeout)
         kwargs['default_cache_invalidation_time'] = args.cache_timeout
+    if args.cache_max_age is not None:
+        logger.debug("default cache max age: %r", args.cache_max_age)
+        kwargs['default_cache_max_age'] = args.cache_max_age
     
 
-    # open the bibolamazi file and create the BibolamaziFile object. This will parse the rules
-    # and the entries, as well as keep some information on how to re-write to the file.
-    bfile = BibolamaziFile(args.bibolamazifile, **kwargs)
+    # open the bibolamazi file and create the BibolamaziFile object. At first, only read
+    # it, so that we can quickly check whether anything changed since the last run.
+    bfile = BibolamaziFile(args.bibolamazifile, load_to_state=BIBOLAMAZIFILE_READ,
+                           **kwargs)
+
+    if args.check:
+        if bfile.isUpToDate():
+            logger.info("Bibolamazi file `%s' is up to date." %(args.bibolamazifile))
+            return 0
+        logger.info("Bibolamazi file `%s' is out of date." %(args.bibolamazifile))
+        return 1
+
+    if (not args.force and args.use_cache and bfile.isUpToDate()):
+        logger.info("Nothing changed since last run, bibolamazi file `%s' is up to date."
+                    %(args.bibolamazifile))
+        return 0
+
+    if args.stream:
+        bfile.load(to_state=BIBOLAMAZIFILE_PARSED)
+        nostream = [ filtr.name() for filtr in bfile.filters() if not filtr.can_stream() ]
+        if not nostream:
+            run_filters_streaming(bfile)
+            logger.debug('Done.');
+            return None
+        logger.warning("Can't use streaming mode, because the following filter(s) need the full "
+                       "bibliography database: %s" %(", ".join(nostream)))
+
+    # This will parse the rules and the entries, as well as keep some information on how
+    # to re-write to the file.
+    bfile.load(to_state=BIBOLAMAZIFILE_LOADED)
 
 
     bibdata = bfile.bibliographyData();
-    if (bibdata is None or not len(bibdata.entries)):
+    # (not all entries may have been loaded, see BibolamaziFile.wantedEntryKeys())
+    if (bibdata is None or not bfile.numSourceEntries()):
         logger.critical("No source entries found. Stopping before we overwrite the bibolamazi file.");
         raise BibolamaziNoSourceEntriesError()
 
@@ -319,7 +530,7 @@ def run_bibolamazi_args(args):
     # now, run the selected filters in the corresponding order.
     # ---------------------------------------------------------
 
-    for filtr in bfile.filters():
+    for stage in get_filter_stages(bfile.filters(), fuse=args.fuse_filters):
         #
         # For debugging: dump the library at each filter step on level longdebug()
         #
@@ -335,36 +546,44 @@ def run_bibolamazi_args(args):
         # full list of entries (possibly adding/deleting entries etc.), or it can act on a single
         # entry.
         #
-        action = filtr.action();
+        action = stage[0].action();
 
-        logger.info("Filter: %s" %(filtr.getRunningMessage()));
+        for filtr in stage:
+            logger.info("Filter: %s" %(filtr.getRunningMessage()));
 
-        filtr.prerun(bfile)
+            filtr.prerun(bfile)
 
         #
         # pass the whole bibolamazifile to the filter. the filter can actually do
         # whatever it wants with it (!!)
         #
         if (action == BibFilter.BIB_FILTER_BIBOLAMAZIFILE):
+            filtr = stage[0]
             filtr.filter_bibolamazifile(bfile);
 
             logger.debug('filter '+filtr.name()+' filtered the full bibolamazifile.');
             continue
 
         #
-        # filter all the bibentries one by one throught the filter. The filter can only
-        # process a single bibentry at a time.
+        # filter all the bibentries one by one throught the filter(s). The filter can only
+        # process a single bibentry at a time. If several filters were fused into this
+        # stage, each entry goes through all of them before we move on to the next entry.
         #
         if (action == BibFilter.BIB_FILTER_SINGLE_ENTRY):
 
             bibdata = bfile.bibliographyData();
 
-            for (k, entry) in bibdata.entries.iteritems():
-                filtr.filter_bibentry(entry);
+            if (args.jobs > 1 and all([filtr.can_run_in_parallel() for filtr in stage])):
+                run_filter_stage_parallel(stage, bibdata, args.jobs)
+            else:
+                for (k, entry) in bibdata.entries.iteritems():
+                    for filtr in stage:
+                        filtr.filter_bibentry(entry);
 
             bfile.setBibliographyData(bibdata);
 
-            logger.debug('filter '+filtr.name()+' filtered each of the the bibentries one by one.');
+            logger.debug('filter(s) '+", ".join([filtr.name() for filtr in stage])
+                         +' filtered each of the the bibentries one by one.');
             continue
 
         raise ValueError("Bad value for BibFilter.action(): "+repr(action));
@@ -257,6 +257,16 @@ class ArxivNormalizeFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_SINGLE_ENTRY;
 
+    def can_skip_unwanted_entries(self):
+        # prerun() only fetches and revalidates the arxiv info of each entry separately
+        return True
+
+    def can_fuse_with_previous(self):
+        # the arxiv info fetched in prerun() only depends on the arXiv-related fields
+        # of the entries, so it may be fetched before the preceding filters have been
+        # run in the fused pass
+        return True
+
     def requested_cache_accessors(self):
         return [
             arxivutil.ArxivInfoCacheAccessor,
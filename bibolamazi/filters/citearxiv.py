@@ -28,7 +28,6 @@ import logging
 logger = logging.getLogger(__name__)
 
 from pybtex.database import BibliographyData;
-import pybtex.database.input.bibtex as inputbibtex;
 
 from bibolamazi.core.bibfilter import BibFilter, BibFilterError
 from bibolamazi.core.bibfilter.argtypes import CommaStrList
@@ -36,6 +35,7 @@ from bibolamazi.core.butils import getbool;
 
 import arxiv2bib
 from .util import arxivutil
+from .util import bibrecord
 
 from .util import auxfile
 
@@ -116,6 +116,10 @@ class CiteArxivFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_BIBOLAMAZIFILE;
 
+    def can_skip_unwanted_entries(self):
+        # we only add entries, for the arxiv IDs which are cited
+        return True
+
     def requested_cache_accessors(self):
         return [
             arxivutil.ArxivFetchedAPIInfoCacheAccessor
@@ -174,26 +178,19 @@ class CiteArxivFilter(BibFilter):
         addprefix = self.prefix+":" if self.prefix else ""
 
         for arxivid in citearxiv_uselist:
-            dat = arxiv_api_accessor.getArxivApiInfo(arxivid)
-            if (dat is None):
+            # get the entries, already parsed from the bibtex code generated by arxiv2bib
+            new_entries = arxiv_api_accessor.getArxivApiEntries(arxivid)
+            if (new_entries is None):
                 errref = arxiv2bib.ReferenceErrorInfo("ArXiv info for `%s' not in cache"%(arxivid),
                                                       arxivid)
-                dat = {
-                    'reference': errref,
-                    'bibtex': errref.bibtex(),
-                    }
-
-            # parse bibtex
-            parser = inputbibtex.Parser();
-            new_bib_data = None;
-            with io.StringIO(unicode(dat['bibtex'])) as stream:
-                new_bib_data = parser.parse_stream(stream);
-            
+                new_entries = [ (key, bibrecord.record_to_entry(rec))
+                                for (key, rec) in bibrecord.bibtex_to_records(errref.bibtex()) ]
+
             # and add them to the main list
-            if (len(new_bib_data.entries.keys()) != 1):
+            if (len(new_entries) != 1):
                 logger.warning("Got more than one bibtex entry when retreiving `%s'!" %(arxivid))
 
-            for val in new_bib_data.entries.values():
+            for (key, val) in new_entries:
                 if (not self.journal_ref_in_note and 'note' in val.fields):
                     del val.fields['note'];
                 thebibdata.add_entry(addprefix+arxivid, val);
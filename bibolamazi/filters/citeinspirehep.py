@@ -23,28 +23,74 @@ import re
 import os
 import os.path
 import io
+import time
+import socket
 import logging
 logger = logging.getLogger(__name__)
 
-import requests
-from bs4 import BeautifulSoup
-
 from pybtex.database import BibliographyData
-import pybtex.database.input.bibtex as inputbibtex
+from pybtex.exceptions import PybtexError
 import arxiv2bib # arxiv id regex'es
 
 from bibolamazi.core.bibfilter import BibFilter, BibFilterError
 from bibolamazi.core.bibfilter.argtypes import CommaStrList
 from bibolamazi.core.bibusercache import BibUserCacheAccessor
+from bibolamazi.core.bibusercache import tokencheckers
 from bibolamazi.core.butils import getbool
 
 from .util import auxfile
+from .util import bibrecord
+from .util import fetchutil
 
 
 
 # ---- API info ------
 
 
+# The URL used to query InspireHEP. May be changed with an environment variable, e.g. to
+# test against a local server.
+INSPIREHEP_API_URL = os.environ.get('BIBOLAMAZI_INSPIREHEP_URL', 'https://inspirehep.net/search')
+
+# How many requests may be sent simultaneously
+INSPIREHEP_API_MAX_WORKERS = 4
+# Timeout for each request, in seconds
+INSPIREHEP_API_TIMEOUT = 30
+# How many times we try a request which fails with a connection error or a server error,
+# waiting a little longer after each failure
+INSPIREHEP_API_MAX_TRIES = 5
+INSPIREHEP_API_RETRY_BASE_DELAY = 1.0
+# How many keys are combined into a single query (see fetchInspireHEPApiInfo())
+INSPIREHEP_API_BATCH_SIZE = 20
+# Entries which are older than the cache timeout are still used, and are refreshed along
+# with the next query for missing entries. If there isn't any, at most this number of
+# them are refreshed in each run, so that they don't all have to be fetched again at once
+INSPIREHEP_API_STALE_REFRESH_MAX = INSPIREHEP_API_BATCH_SIZE
+
+# Reference types for which several keys may be combined into a single query, because we
+# can tell from the returned bibtex entries which entry corresponds to which key
+_batchable_ref_types = ('eprint', 'doi', 'texkey')
+
+# HTTP status codes for which it is worth trying again
+_retry_status_codes = (429, 500, 502, 503, 504)
+
+
+def _normalize_eprint(x):
+    return re.sub(r'v\d+$', '', re.sub(r'^arxiv:', '', x.strip().lower()))
+
+def _record_matches_key(pk, entrykey, record):
+    # whether the bibtex entry `record` returned by a combined query is the entry for
+    # the parsed key `pk`
+    fields = dict([ (fld.lower(), val) for (fld, val) in record[1] ])
+    if pk['ref_type'] == 'texkey':
+        return (entrykey.lower() == pk['key'].lower())
+    if pk['ref_type'] == 'eprint':
+        return ('eprint' in fields and
+                _normalize_eprint(fields['eprint']) == _normalize_eprint(pk['key']))
+    if pk['ref_type'] == 'doi':
+        return ('doi' in fields and fields['doi'].strip().lower() == pk['key'].lower())
+    return False
+
+
 
 class InspireHEPFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
     """
@@ -68,8 +114,14 @@ class InspireHEPFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
                      cache_obj.cacheExpirationTokenChecker().time_valid)
 
         # validate each entry with an expiration checker. Do this per entry, rather than
-        # globally on the full cache. (So don't use installCacheExpirationChecker())
-        dic['fetched'].set_validation(cache_obj.cacheExpirationTokenChecker())
+        # globally on the full cache. (So don't use installCacheExpirationChecker()).
+        # Expired entries are kept until they reach the maximum cache age, and are
+        # refreshed in the meantime (see fetchInspireHEPApiInfo()). Also check the version
+        # of the stored records.
+        dic['fetched'].set_validation(tokencheckers.TokenCheckerCombine(
+            tokencheckers.VersionTokenChecker(bibrecord.RECORD_VERSION),
+            cache_obj.cacheStaleExpirationTokenChecker()
+            ))
         
 
     def parse_and_store_key(self, userkey):
@@ -87,11 +139,12 @@ class InspireHEPFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
         def invenio_query(term, value):
             return term + ":" + value
 
-        def remember_key(userkey, key, p):
+        def remember_key(userkey, key, p, ref_type):
             self.user_keys_parsed[key] = {
                 'key': key,
                 'userkey': userkey,
                 'p_query': p,
+                'ref_type': ref_type,
                 }
 
         # strip "--comment" from the user's citekey
@@ -146,7 +199,7 @@ class InspireHEPFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
             # be different from the queryval.
 
             # all keys can be saved in the same way using INSPIRE
-            remember_key(userkey, key=key, p=invenio_query(ref_type, queryval))
+            remember_key(userkey, key=key, p=invenio_query(ref_type, queryval), ref_type=ref_type)
             return key
 
         return None
@@ -161,94 +214,265 @@ class InspireHEPFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
         (Sanitized keys)
 
         Only those requested entries which are not already in the cache are fetched.
+
+        Up to `INSPIREHEP_API_MAX_WORKERS` requests are sent simultaneously, over a
+        shared connection pool. Keys which are arXiv IDs, DOIs or InspireHEP bibtex keys
+        are looked up in batches of `INSPIREHEP_API_BATCH_SIZE`, with a single query
+        combining them with `or'; any key for which we can't find the corresponding
+        entry in the result of such a query is then looked up on its own. Requests which
+        time out or fail are retried a few times, waiting a little longer each time.
+
+        Entries which are in the cache but are older than the cache timeout (*stale*
+        entries) are still used, and are fetched again along with the missing entries;
+        if there are no missing entries, only up to `INSPIREHEP_API_STALE_REFRESH_MAX`
+        stale entries are fetched again. If a stale entry can't be fetched again, the
+        stale information is kept (until it reaches the maximum cache age).
+
+        Returns `True` if all requests could be performed, or `False` if we couldn't
+        connect to InspireHEP, after retrying. (Keys which InspireHEP doesn't know about
+        are reported with a warning.) No exception is raised in the latter case; rather,
+        if the information about some of the keys is missing or is stale, the output of
+        the bibolamazi file is marked as incomplete (see
+        :py:meth:`BibolamaziFile.registerIncompleteOutput()
+        <bibolamazi.core.bibolamazifile.BibolamaziFile.registerIncompleteOutput>`), so
+        that the next run isn't skipped and tries again. Otherwise, the time at which the
+        information should be refreshed is registered (see
+        :py:meth:`BibolamaziFile.registerExpiryTime()
+        <bibolamazi.core.bibolamazifile.BibolamaziFile.registerExpiryTime>`).
         """
+        keyslist = list(keyslist)
+        ok = self._fetch_inspirehep_api_info(keyslist)
+        self._register_fetch_outcome(keyslist)
+        return ok
+
+    def _register_fetch_outcome(self, keyslist):
+        # tell the bibolamazi file whether the output has all the information about the
+        # keys in `keyslist`, or when this information should be refreshed, so that later
+        # runs aren't skipped if they can improve the output
+        bibolamazifile = self.bibolamaziFile()
+        cache_entrydic = self.cacheDic()['fetched']
+        for key in keyslist:
+            if (key not in cache_entrydic or 'records' not in cache_entrydic[key]):
+                bibolamazifile.registerIncompleteOutput("missing InspireHEP information")
+            elif cache_entrydic.is_stale(key):
+                bibolamazifile.registerIncompleteOutput("stale InspireHEP information")
+            else:
+                bibolamazifile.registerExpiryTime(cache_entrydic.refresh_time(key))
+
+    def _fetch_inspirehep_api_info(self, keyslist):
+        # see fetchInspireHEPApiInfo()
 
         cache_entrydic = self.cacheDic()['fetched']
 
         missing_keys = []
+        stale_keys = []
         for key in keyslist:
-            if (key not in cache_entrydic or cache_entrydic.get(key) is None):
+            if key in missing_keys or key in stale_keys:
+                continue
+            if (key not in cache_entrydic or 'records' not in cache_entrydic[key]):
                 missing_keys.append(key)
+            elif cache_entrydic.is_stale(key):
+                stale_keys.append(key)
 
         if not missing_keys:
+            stale_keys = stale_keys[:INSPIREHEP_API_STALE_REFRESH_MAX]
+        if not missing_keys and not stale_keys:
             logger.longdebug('nothing to fetch: no missing keys')
             # nothing to fetch
             return True
 
-        logger.info("citeinspirehep: Fetching missing information from InspireHEP...")
-
-        # use a Session() so that we keep the connection alive and reuse it multiple times
-        # for the different requests
-        reqsession = requests.Session()
+        if missing_keys:
+            logger.info("citeinspirehep: Fetching missing information from InspireHEP...")
+        logger.longdebug('fetching missing id list %r, and refreshing stale id list %r',
+                         missing_keys, stale_keys)
+        # keys which we still need to get (as opposed to stale keys, for which we still
+        # have some information)
+        remaining_missing = set(missing_keys)
+        missing_set = frozenset(missing_keys)
 
-        logger.longdebug('fetching missing id list %r' %(missing_keys))
-        for key in missing_keys:
-            pk = self.user_keys_parsed[key]
-            qs = { 'p': pk['p_query'],
-                   'em': 'B', # no surrounding HTML
-                   'of': 'hx', # BibTeX output
-                   'action_search': 'search',
-                   }
-            # perform individual request
-            logger.longdebug("fetching for key=%s: %r", key, qs)
-            for tries in range(5):
-                try:
-                    exc = None
-                    r = reqsession.get('https://inspirehep.net/search', params=qs)
-                except Exception as e:
-                    # meant to catch SSLError -- we can't rely on
-                    #    ``from requests.packages.urllib3.exceptions import SSLError``
-                    # because that doesn't always exist, depending on the `requests`
-                    # version/edition/installation
-                    logger.debug("Got exception in requests(), tries=%d: %s", tries, e)
-                    exc = e
-                    continue
-                break
-            if exc is not None:
-                raise exc
-            if r.status_code != 200:
-                logger.warning("Could not fetch reference information for key `%s' (HTTP %d):\n\t%s",
-                               key, r.status_code, r.text)
-                continue
+        # `requests' is slow to import, and is only needed when we have something to fetch
+        import requests
 
-            soup = BeautifulSoup(r.text)
-            quicknotes = soup.find_all(class_='quicknote')
-            if (quicknotes):
-                logger.warning("Could not fetch reference for key `%s':\n\t%s", key,
-                               "\n".join([x.get_text() for x in quicknotes]))
-                continue
+        # errors which mean that we couldn't get an answer from InspireHEP
+        connection_errors = (requests.exceptions.RequestException, socket.error)
 
-            # extract bibtex
-            bibtex = "\n".join([x.get_text() for x in soup.find_all('pre')])
-            if not bibtex:
-                logger.warning("Could not fetch reference for key `%s': no content returned", key)
-                continue
-            
-            cache_entrydic[key]['bibtex'] = bibtex
+        # use a Session() so that we keep the connections alive and reuse them for the
+        # different requests
+        reqsession = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=INSPIREHEP_API_MAX_WORKERS)
+        reqsession.mount('https://', adapter)
+        reqsession.mount('http://', adapter)
+
+        fetch_keys = missing_keys + stale_keys
+        batchable = [ key for key in fetch_keys
+                      if self.user_keys_parsed[key]['ref_type'] in _batchable_ref_types ]
+        chunks = (fetchutil.split_chunks(batchable, INSPIREHEP_API_BATCH_SIZE) +
+                  [ [key] for key in fetch_keys if key not in batchable ])
+
+        while chunks:
+            # keys of combined queries, which we'll have to look up on their own
+            retry_keys = []
+            for (chunk, result, exc_info) in fetchutil.iter_fetch_chunks(
+                    lambda chunk: self._query_inspirehep(reqsession, chunk,
+                                                         only_stale=missing_set.isdisjoint(chunk)),
+                    chunks,
+                    max_workers=INSPIREHEP_API_MAX_WORKERS):
+
+                if exc_info is not None:
+                    if not isinstance(exc_info[1], connection_errors):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    if not remaining_missing:
+                        # we were only refreshing stale entries, keep them for now
+                        logger.debug("Can't refresh stale InspireHEP information: %s", exc_info[1])
+                        return True
+                    logger.warning("Connection Error while querying InspireHEP: %s", exc_info[1])
+                    logger.warning("InspireHEP information will not be retreived for some entries, "
+                                   "and your bibliography might be incomplete.")
+                    return False
+
+                retry_keys += self._store_query_result(chunk, result, remaining_missing)
+
+                self.cacheObject().saveCacheStore(names=[self.cacheName()])
+
+            chunks = [ [key] for key in retry_keys ]
 
         logger.longdebug("inspirehep API info: Got all references. cacheDic() is now:  %r", self.cacheDic())
         logger.longdebug("... and cacheObject().cachedic is now:  %r", self.cacheObject().cachedic)
 
         return True
 
+    def _query_inspirehep(self, reqsession, keys, only_stale=False):
+        # Query InspireHEP for the given keys, in a single request. Returns the response
+        # object. This is called from worker threads. If we're only refreshing stale
+        # entries, don't insist if the request fails.
+        max_tries = (1 if only_stale else INSPIREHEP_API_MAX_TRIES)
+        qs = { 'p': " or ".join([ self.user_keys_parsed[key]['p_query'] for key in keys ]),
+               'em': 'B', # no surrounding HTML
+               'of': 'hx', # BibTeX output
+               'action_search': 'search',
+               }
+        if len(keys) > 1:
+            # allow for a few unexpected additional matches
+            qs['rg'] = 2*len(keys)
+        logger.longdebug("fetching for keys=%r: %r", keys, qs)
+        for tries in range(max_tries):
+            if tries:
+                time.sleep(fetchutil.backoff_delay(tries-1, base_delay=INSPIREHEP_API_RETRY_BASE_DELAY))
+            try:
+                r = reqsession.get(INSPIREHEP_API_URL, params=qs, timeout=INSPIREHEP_API_TIMEOUT)
+            except Exception as e:
+                # meant to catch SSLError -- we can't rely on
+                #    ``from requests.packages.urllib3.exceptions import SSLError``
+                # because that doesn't always exist, depending on the `requests`
+                # version/edition/installation
+                if tries == max_tries-1:
+                    raise
+                logger.debug("Got exception in requests(), tries=%d: %s", tries, e)
+                continue
+            if r.status_code in _retry_status_codes and tries < max_tries-1:
+                logger.debug("Got HTTP %d, tries=%d", r.status_code, tries)
+                continue
+            return r
+
+    def _store_query_result(self, keys, r, remaining_missing):
+        # Store the entries from the response `r` to the query for `keys` in the cache.
+        # Returns the list of keys of a combined query which must be looked up on their
+        # own. Keys for which we got an answer are removed from the set
+        # `remaining_missing`.
+        cache_entrydic = self.cacheDic()['fetched']
+
+        def failed(msg, *args):
+            if len(keys) > 1:
+                logger.debug("Combined query for keys %r failed"+msg+"\n\t(will query them "
+                             "separately)", keys, *args)
+                return list(keys)
+            if keys[0] not in remaining_missing:
+                # couldn't refresh stale entry, keep it for now
+                logger.debug("Can't refresh stale InspireHEP information for key `%s'"+msg,
+                             keys[0], *args)
+                return []
+            remaining_missing.discard(keys[0])
+            logger.warning("Could not fetch reference for key `%s'"+msg, keys[0], *args)
+            return []
+
+        if r.status_code != 200:
+            return failed(" (HTTP %d):\n\t%s", r.status_code, r.text)
+
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(r.text, 'html.parser')
+        quicknotes = soup.find_all(class_='quicknote')
+        if (quicknotes):
+            return failed(":\n\t%s", "\n".join([x.get_text() for x in quicknotes]))
+
+        # extract bibtex
+        bibtex = "\n".join([x.get_text() for x in soup.find_all('pre')])
+        if not bibtex:
+            return failed(": no content returned")
+
+        # store the parsed entries, so that we don't have to parse the bibtex code again
+        # on each run
+        try:
+            records = bibrecord.bibtex_to_records(bibtex)
+        except PybtexError as e:
+            return failed(": can't parse the returned BibTeX code: %s", e)
+
+        if len(keys) == 1:
+            cache_entrydic[keys[0]]['records'] = tuple(records)
+            remaining_missing.discard(keys[0])
+            return []
+
+        retry_keys = []
+        with cache_entrydic.batch_changes():
+            for key in keys:
+                pk = self.user_keys_parsed[key]
+                matching = [ (k, rec) for (k, rec) in records if _record_matches_key(pk, k, rec) ]
+                if not matching:
+                    retry_keys.append(key)
+                    continue
+                cache_entrydic[key]['records'] = tuple(matching)
+                remaining_missing.discard(key)
+        if retry_keys:
+            logger.debug("Entries for keys %r not found in result of combined query, will "
+                         "query them separately", retry_keys)
+        return retry_keys
+
 
     def getInspireHEPInfo(self, key):
         """
         Returns a dictionary::
 
             {
-              'bibtex': <bibtex string>
+              'records': <tuple of (key, record)>
             }
 
         for the given InspireHEP key in the cache. If the information is not in the cache,
         returns `None`.
 
+        The `records` are the parsed bibtex entries returned by InspireHEP, as compact
+        records (see :py:mod:`bibrecord`); use :py:meth:`getInspireHEPEntries()` to get
+        them as pybtex `Entry` objects.
+
         Don't forget to first call :py:meth:`fetchInspireHEPApiInfo()` to retrieve the
         information in the first place.
 
         If the reference does not exist in the cache, `None` is returned.
         """
-        return self.cacheDic()['fetched'].get(key, None)
+        cache_entrydic = self.cacheDic()['fetched']
+        if (key not in cache_entrydic or 'records' not in cache_entrydic[key]):
+            return None
+        return cache_entrydic[key]
+
+    def getInspireHEPEntries(self, key):
+        """
+        Returns a list of tuples `(key, entry)` with the bibtex entries (as pybtex `Entry`
+        objects) returned by InspireHEP for the given key. If the information is not in
+        the cache, returns `None`.
+        """
+        dat = self.getInspireHEPInfo(key)
+        if dat is None:
+            return None
+        return [ (k, bibrecord.record_to_entry(rec)) for (k, rec) in dat['records'] ]
 
 
 
@@ -303,6 +527,11 @@ document name.
 If the `mydoc.aux' file is in a different directory than the bibolamazi file, you may
 specify where to look for the aux file with the option `-sSearchDirs=...'.
 
+If InspireHEP can't be reached (after retrying a few times), a warning is displayed and
+the entries which couldn't be retrieved are left out of the bibliography, but bibolamazi
+doesn't stop with an error. The bibolamazi file is then not considered as up to date, so
+the next run tries again to fetch the missing entries even if nothing else has changed.
+
 Example of recognized citations:
 
     \cite{inspire:10.1103/PhysRev.47.777}
@@ -350,6 +579,10 @@ class CiteInspireHEPFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_BIBOLAMAZIFILE;
 
+    def can_skip_unwanted_entries(self):
+        # we only add entries, for the keys which are cited
+        return True
+
     def requested_cache_accessors(self):
         return [
             InspireHEPFetchedAPIInfoCacheAccessor
@@ -396,20 +629,17 @@ class CiteInspireHEPFilter(BibFilter):
         thebibdata = bibolamazifile.bibliographyData();
 
         for (userkey, key) in used_keys_dic.iteritems():
-            # get the bibtex data
-            dat = cache_accessor.getInspireHEPInfo(key)
-
-            # parse bibtex
-            parser = inputbibtex.Parser()
-            new_bib_data = None
-            with io.StringIO(unicode(dat['bibtex'])) as stream:
-                new_bib_data = parser.parse_stream(stream);
-            
+            # get the bibtex entries, already parsed
+            new_entries = cache_accessor.getInspireHEPEntries(key)
+            if new_entries is None:
+                # couldn't fetch it, a warning was already issued
+                continue
+
             # and add them to the main list
-            if (len(new_bib_data.entries.keys()) != 1):
+            if (len(new_entries) != 1):
                 logger.warning("Got either none or more than one bibtex entry when retreiving `%s'!", userkey)
 
-            for val in new_bib_data.entries.values():
+            for (k, val) in new_entries:
                 thebibdata.add_entry(userkey, val);
 
         #
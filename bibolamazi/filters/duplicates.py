@@ -28,6 +28,7 @@ import unicodedata
 import string
 import textwrap
 import copy
+import bisect
 import logging
 
 from pybtex.database import BibliographyData, Entry, FieldDict
@@ -330,6 +331,17 @@ aliases, but this will require a little more work from your side.
 # ------------------------------------------------
 
 
+# the fields which compare_entries_same() reads directly from the entries, rather than
+# from the DuplicatesEntryInfoCacheAccessor cache (and 'crossref', which determines
+# how DuplicatesBlockingIndex treats the entry)
+_compared_fields = [ 'year', 'month', 'doi', 'volume', 'number', 'crossref' ]
+
+# if more entries than this may have changed, it is faster to look up the candidates of
+# an entry than to check all the changed entries (see
+# DuplicatesFilter.filter_bibolamazifile())
+_max_dirty_checks = 16
+
+
 class DuplicatesEntryInfoCacheAccessor(bibusercache.BibUserCacheAccessor):
     def __init__(self, **kwargs):
         super(DuplicatesEntryInfoCacheAccessor, self).__init__(
@@ -356,10 +368,15 @@ class DuplicatesEntryInfoCacheAccessor(bibusercache.BibUserCacheAccessor):
                     'note',
                     'journal',
                     'title',
-                    ])),
+                    ] +
+                # not needed for this cache, but the token then also serves as a
+                # fingerprint of the entry for DuplicatesClustersCacheAccessor
+                _compared_fields
+                )),
+            fingerprint_index=self.bibolamaziFile().entryFingerprintIndex(),
             )
 
-        self.cacheDic()['entries'].set_validation(cache_entries_validator)
+        self.cacheDic()['entries'].set_validation(cache_entries_validator, lazy=True)
 
 
     def prepare_entry_cache(self, key, a, arxivaccess):
@@ -369,7 +386,11 @@ class DuplicatesEntryInfoCacheAccessor(bibusercache.BibUserCacheAccessor):
         if key in entriescache and entriescache[key]:
             return
 
-        cache_a = entriescache[key]
+        # compute the entry's validation token only once, after setting all the fields
+        with entriescache.batch_changes():
+            self._fill_entry_cache(entriescache[key], a, arxivaccess)
+
+    def _fill_entry_cache(self, cache_a, a, arxivaccess):
 
         cache_a['pers'] = [ getlast(pers) for pers in a.persons.get('author',[]) ]
 
@@ -401,6 +422,258 @@ class DuplicatesEntryInfoCacheAccessor(bibusercache.BibUserCacheAccessor):
 
 
 
+class DuplicatesClustersCacheAccessor(bibusercache.BibUserCacheAccessor):
+    """
+    Cache accessor which remembers, between runs, which entries the duplicates filter
+    found to be duplicates of which other entries.
+
+    For each entry, we store the entry's fingerprint (see :py:meth:`entry_fingerprint()`),
+    its position in the bibliography, the candidate entries it was compared with (see
+    :py:class:`DuplicatesBlockingIndex`), and the outcome of the comparison. On the next
+    run, the outcome can be reused without even looking up the candidates if the entry
+    didn't change, and if none of the entries which could be compared with it changed
+    (see :py:meth:`DuplicatesFilter.filter_bibolamazifile()`).
+
+    The decisions are stored separately for each `duplicates` filter instance in the
+    bibolamazi file, identified by its position among the `duplicates` filters.
+    """
+    def __init__(self, **kwargs):
+        super(DuplicatesClustersCacheAccessor, self).__init__(
+            cache_name='duplicates_clusters',
+            **kwargs
+            )
+
+    def initialize(self, cache_obj, **kwargs):
+        # discard the decisions stored in a different format
+        self.cacheDic().setdefault('runs', {})
+        self.cacheDic()['runs'].set_validation(tokencheckers.VersionTokenChecker(2))
+
+
+    def entry_fingerprint(self, key):
+        """
+        Return a fingerprint of the state of the entry `key` of the bibolamazi file's
+        bibliography data which is relevant for
+        :py:meth:`DuplicatesFilter.compare_entries_same()`, or `None` if it isn't known.
+
+        This is the token computed for the entry by the
+        :py:class:`EntryFieldsTokenChecker` of the
+        :py:class:`DuplicatesEntryInfoCacheAccessor` cache, which also covers the
+        fields that `compare_entries_same()` reads directly from the entry. The entry
+        must have been prepared with
+        :py:meth:`DuplicatesEntryInfoCacheAccessor.prepare_entry_cache()`, i.e. before
+        it can be completed with the fields of a duplicate.
+        """
+        return self.bibolamaziFile().cacheAccessor(DuplicatesEntryInfoCacheAccessor) \
+                                    .cacheDic()['entries'].get_token(key)
+
+
+    def get_decisions(self, run_id):
+        """
+        Return the decisions stored at the previous run by the `duplicates` filter
+        instance `run_id`, as a dictionary `{ key: decision }`.
+        """
+        runs = self.cacheDic()['runs']
+        if run_id not in runs:
+            return {}
+        return dict(runs[run_id].iteritems())
+
+    def set_decisions(self, run_id, decisions):
+        """
+        Store the decisions of the present run, replacing any previously stored decisions
+        (which also removes those of entries which no longer exist).
+
+        Each decision is a tuple `(entry_fingerprint, position, is_used, candidates,
+        is_duplicate_of, duplicate_original_is_unused)`, where `candidates` is a tuple
+        `(newbibdata_candidates, unused_candidates)` of the keys of the entries the entry
+        was compared with.
+        """
+        self.cacheDic()['runs'][run_id] = decisions
+
+
+
+
+
+# ------------------------------------------------
+
+
+class DuplicatesBlockingIndex(object):
+    """
+    An index of entries used to restrict which entries need to be compared with
+    :py:meth:`DuplicatesFilter.compare_entries_same()`.
+
+    Entries are grouped into blocks according to the features which
+    `compare_entries_same()` checks before declaring two entries to be duplicates: the
+    number of authors, the year, the DOI, the arXiv ID and the cleaned-up title (the
+    latter are taken from the :py:class:`DuplicatesEntryInfoCacheAccessor` cache).
+
+    An entry which is not in a compatible block of a given entry can never be detected
+    as its duplicate, so it need not be compared at all. The index is exact, in the
+    sense that :py:meth:`candidates()` returns all entries which could possibly match,
+    in the order in which they were added.
+
+    Entries with a `crossref` field are always returned as candidates, because their
+    fields may be looked up in the cross-referenced entry.
+    """
+
+    def __init__(self):
+        self._seq = {}
+        self._counter = 0
+        self._features = {}
+        self._unstable = set()
+        self._blocks = dict( (name, {}) for name in ('npers', 'year', 'doi', 'arxivid', 'title') )
+
+    def features(self, entry, cache_entry):
+        """
+        Return a dictionary of the features of the given `entry`, with corresponding
+        duplicates entry info cache `cache_entry`. A value of `None` means that the
+        feature is not checked in `compare_entries_same()`.
+        """
+        year = entry.fields.get('year', None)
+        if year is not None:
+            year = year.strip()
+
+        doi = entry.fields.get('doi')
+        if not doi:
+            doi = None
+
+        arxivinfo = cache_entry['arxivinfo']
+        arxivid = None
+        if arxivinfo and 'arxivid' in arxivinfo:
+            arxivid = arxivinfo['arxivid']
+
+        title = cache_entry['title_clean']
+        if not title:
+            title = None
+
+        return {
+            'npers': len(cache_entry['pers']),
+            'year': year,
+            'doi': doi,
+            'arxivid': arxivid,
+            'title': title,
+            }
+
+    def __contains__(self, key):
+        return key in self._seq
+
+    def add(self, key, entry, cache_entry):
+        """
+        Add the entry `entry` with the given `key` to the index.
+        """
+        self._seq[key] = self._counter
+        self._counter += 1
+        self._add_features(key, entry, cache_entry)
+
+    def remove(self, key):
+        """
+        Remove the entry with the given `key` from the index.
+        """
+        del self._seq[key]
+        self._remove_features(key)
+
+    def update(self, key, entry, cache_entry):
+        """
+        Update the features of an entry already in the index, for example after its
+        fields were completed with those of a duplicate. The entry keeps its position.
+        """
+        self._remove_features(key)
+        self._add_features(key, entry, cache_entry)
+
+    def is_unstable(self, key):
+        """
+        Returns `True` if the entry `key` has a `crossref` field. Such entries are always
+        returned as candidates, and their fields may change along with the
+        cross-referenced entry.
+        """
+        return key in self._unstable
+
+    def may_match(self, key, features):
+        """
+        Returns `True` if the entry `key` in the index is a candidate for an entry with
+        the given `features` (as returned by :py:meth:`features()`), i.e., if it would
+        be returned by :py:meth:`candidates()` for that entry.
+        """
+        return key in self._unstable or self._may_match(features, self._features[key])
+
+    def _add_features(self, key, entry, cache_entry):
+        if 'crossref' in entry.fields:
+            self._unstable.add(key)
+            return
+
+        f = self.features(entry, cache_entry)
+        self._features[key] = f
+        for name, val in f.iteritems():
+            self._blocks[name].setdefault(val, set()).add(key)
+
+    def _remove_features(self, key):
+        if key in self._unstable:
+            self._unstable.remove(key)
+            return
+
+        f = self._features.pop(key)
+        for name, val in f.iteritems():
+            block = self._blocks[name][val]
+            block.discard(key)
+            if not block:
+                del self._blocks[name][val]
+
+    def _block(self, name, val):
+        return self._blocks[name].get(val, ())
+
+    def _may_match(self, fa, fb):
+        # this mirrors the order of the checks in compare_entries_same()
+        if fa['npers'] != fb['npers']:
+            return False
+        if fa['year'] is not None and fb['year'] is not None and fa['year'] != fb['year']:
+            return False
+        if fa['doi'] is not None and fb['doi'] is not None:
+            return fa['doi'] == fb['doi']
+        if fa['arxivid'] is not None and fb['arxivid'] is not None:
+            return fa['arxivid'] == fb['arxivid']
+        if fa['title'] is not None and fb['title'] is not None and fa['title'] != fb['title']:
+            return False
+        return True
+
+    def candidates(self, entry, cache_entry, features=None):
+        """
+        Return the list of keys of the entries in the index which might be duplicates
+        of `entry`, in the order in which they were added to the index. The `features`
+        of the entry may be given if they were already computed.
+        """
+        fa = features
+        if fa is None:
+            fa = self.features(entry, cache_entry)
+
+        # each of these lists of blocks contains all the entries which may possibly
+        # match; pick the smallest one.
+        choices = [ [self._block('npers', fa['npers'])] ]
+        for name in ('year', 'doi'):
+            if fa[name] is not None:
+                choices.append([self._block(name, fa[name]), self._block(name, None)])
+        shortcuts = []
+        if fa['doi'] is not None:
+            shortcuts.append(self._block('doi', fa['doi']))
+        if fa['arxivid'] is not None:
+            choices.append([self._block('arxivid', fa['arxivid']), self._block('arxivid', None)]
+                           + shortcuts)
+            shortcuts.append(self._block('arxivid', fa['arxivid']))
+        if fa['title'] is not None:
+            choices.append([self._block('title', fa['title']), self._block('title', None)]
+                           + shortcuts)
+
+        blocks = min(choices, key=lambda bl: sum(len(b) for b in bl))
+
+        keys = set(self._unstable)
+        for block in blocks:
+            for key in block:
+                if key not in keys and self._may_match(fa, self._features[key]):
+                    keys.add(key)
+
+        return sorted(keys, key=lambda k: self._seq[k])
+
+
+
+
 
     
 
@@ -481,6 +754,7 @@ class DuplicatesFilter(BibFilter):
     def requested_cache_accessors(self):
         return [
             DuplicatesEntryInfoCacheAccessor,
+            DuplicatesClustersCacheAccessor,
             arxivutil.ArxivInfoCacheAccessor,
             arxivutil.ArxivFetchedAPIInfoCacheAccessor,
             ]
@@ -681,28 +955,127 @@ class DuplicatesFilter(BibFilter):
         # into the actual new list.
         #
 
-        for (key, entry) in bibdata.entries.iteritems():
+        # Only compare entries which share compatible blocks of features (see
+        # DuplicatesBlockingIndex), instead of comparing each entry with all the entries
+        # seen so far. The index for each of `newbibdata` and `unused` must be kept in
+        # sync with the corresponding object.
+        newbibdata_index = DuplicatesBlockingIndex()
+        unused_index = DuplicatesBlockingIndex()
+
+        # The decisions taken at the previous run can be reused for those entries for
+        # which neither the entry itself nor any of the entries it could be compared with
+        # have changed, without even looking up the candidates in the indexes (see
+        # DuplicatesClustersCacheAccessor).
+        #
+        # `dirty` is the set of keys of the entries whose state in the indexes may differ
+        # from the state they had at the same point of the previous run: new, changed or
+        # moved entries, entries whose "used" status or whose decision changed, and the
+        # entries they are (or were) merged into. An entry may reuse its previous
+        # decision if it didn't change, if none of its previous candidates is dirty or was
+        # removed from the indexes, and if no dirty entry in the indexes is a candidate
+        # for it. The fields of an entry with a `crossref` field may be looked up in the
+        # cross-referenced entry, so such an entry is also dirty if the latter is.
+        clusters_cache_accessor = self.cacheAccessor(DuplicatesClustersCacheAccessor)
+        run_id = [ f for f in bibolamazifile.filters() if isinstance(f, DuplicatesFilter) ].index(self)
+        old_decisions = clusters_cache_accessor.get_decisions(run_id)
+        decisions = {}
+        num_reused = 0
+
+        dirty = set()
+        # entries which moved with respect to the other entries since the previous run
+        moved = keys_out_of_order([ (key, old_decisions[key][1]) for key in bibdata.entries
+                                    if key in old_decisions ])
+        for (okey, old_decision) in old_decisions.iteritems():
+            if old_decision[4] is not None and (okey in moved or okey not in bibdata.entries):
+                # this entry is gone or is merged at another point, so the entry it was
+                # merged into may differ from what it was at the previous run from the
+                # start (e.g. for the entries between the old and the new position)
+                dirty.add(old_decision[4])
+
+        def is_dirty(index, data, nkey):
+            if nkey in dirty:
+                return True
+            if index.is_unstable(nkey):
+                crossref = data.entries[nkey].fields['crossref']
+                return (crossref in bibdata.entries and bibdata.entries[crossref].key in dirty)
+            return False
+
+        def reusable_candidates(entry, cache_entry, old_decision):
+            # Return the candidates of the previous run if its decision for this
+            # (unchanged) entry can be reused, or None.
+            candidates = old_decision[3]
+            for (index, data, keys) in ((newbibdata_index, newbibdata, candidates[0]),
+                                        (unused_index, unused, candidates[1])):
+                for nkey in keys:
+                    if nkey not in index or is_dirty(index, data, nkey):
+                        return None
+            features = newbibdata_index.features(entry, cache_entry)
+            if len(dirty) > _max_dirty_checks:
+                # cheaper to look up the candidates and compare
+                if (tuple(newbibdata_index.candidates(entry, cache_entry, features)),
+                    tuple(unused_index.candidates(entry, cache_entry, features))) != candidates:
+                    return None
+                return candidates
+            for dkey in dirty:
+                for index in (newbibdata_index, unused_index):
+                    if dkey in index and index.may_match(dkey, features):
+                        return None
+            return candidates
+
+        for (position, (key, entry)) in enumerate(bibdata.entries.iteritems()):
             #
             # search the newbibdata object, in case this entry already exists.
             #
             #logger.longdebug('inspecting new entry %s ...', key);
-            is_duplicate_of = None
-            duplicate_original_is_unused = False
-            for (nkey, nentry) in newbibdata.entries.iteritems():
-                if self.compare_entries_same(entry, nentry, dupl_entryinfo_cache_accessor.get_entry_cache(key),
-                                             dupl_entryinfo_cache_accessor.get_entry_cache(nkey)):
-                    logger.longdebug('    ... matches existing entry %s!', nkey);
-                    is_duplicate_of = nkey;
-                    break
-            for (nkey, nentry) in unused.entries.iteritems():
-                #if nkey in unused_respawned:
-                #    continue
-                if self.compare_entries_same(entry, nentry, dupl_entryinfo_cache_accessor.get_entry_cache(key),
-                                             dupl_entryinfo_cache_accessor.get_entry_cache(nkey)):
-                    logger.longdebug('    ... matches existing entry %s!', nkey);
-                    is_duplicate_of = nkey;
-                    duplicate_original_is_unused = True
-                    break
+            cache_entry = dupl_entryinfo_cache_accessor.get_entry_cache(key)
+            fingerprint = clusters_cache_accessor.entry_fingerprint(key)
+            is_used = (used_citations is None or key in used_citations)
+
+            old_decision = old_decisions.get(key, None)
+            changed = (fingerprint is None or old_decision is None or
+                       old_decision[0] != fingerprint or key in moved)
+
+            candidates = None
+            if not changed:
+                candidates = reusable_candidates(entry, cache_entry, old_decision)
+
+            if candidates is not None:
+                # same entry, same candidates: same outcome.
+                (is_duplicate_of, duplicate_original_is_unused) = old_decision[4:6]
+                num_reused += 1
+            else:
+                candidates = (tuple(newbibdata_index.candidates(entry, cache_entry)),
+                              tuple(unused_index.candidates(entry, cache_entry)))
+                is_duplicate_of = None
+                duplicate_original_is_unused = False
+                for nkey in candidates[0]:
+                    nentry = newbibdata.entries[nkey]
+                    if self.compare_entries_same(entry, nentry, cache_entry,
+                                                 dupl_entryinfo_cache_accessor.get_entry_cache(nkey)):
+                        logger.longdebug('    ... matches existing entry %s!', nkey);
+                        is_duplicate_of = nkey;
+                        break
+                for nkey in candidates[1]:
+                    nentry = unused.entries[nkey]
+                    #if nkey in unused_respawned:
+                    #    continue
+                    if self.compare_entries_same(entry, nentry, cache_entry,
+                                                 dupl_entryinfo_cache_accessor.get_entry_cache(nkey)):
+                        logger.longdebug('    ... matches existing entry %s!', nkey);
+                        is_duplicate_of = nkey;
+                        duplicate_original_is_unused = True
+                        break
+
+            decisions[key] = (fingerprint, position, is_used, candidates, is_duplicate_of,
+                              duplicate_original_is_unused)
+
+            if (changed or old_decision[2] != is_used or
+                old_decision[4:6] != (is_duplicate_of, duplicate_original_is_unused)):
+                dirty.add(key)
+                if is_duplicate_of is not None:
+                    dirty.add(is_duplicate_of)
+                if old_decision is not None and old_decision[4] is not None:
+                    dirty.add(old_decision[4])
 
             #
             # if it's a duplicate
@@ -712,10 +1085,14 @@ class DuplicatesFilter(BibFilter):
                 if duplicate_original_is_unused:
                     self.update_entry_with_duplicate(is_duplicate_of, unused.entries[is_duplicate_of],
                                                      key, entry)
+                    unused_index.update(is_duplicate_of, unused.entries[is_duplicate_of],
+                                        dupl_entryinfo_cache_accessor.get_entry_cache(is_duplicate_of))
                 else:
                     # a duplicate of a key we have used. So update the original ...
                     self.update_entry_with_duplicate(is_duplicate_of, newbibdata.entries[is_duplicate_of],
                                                      key, entry)
+                    newbibdata_index.update(is_duplicate_of, newbibdata.entries[is_duplicate_of],
+                                            dupl_entryinfo_cache_accessor.get_entry_cache(is_duplicate_of))
                     # ... and register the alias.
                     duplicates.append(dup);
 
@@ -725,15 +1102,24 @@ class DuplicatesFilter(BibFilter):
                     # to it. Bonus: use the name with which we have referred to it, so we
                     # don't need to register any duplicate.
                     newbibdata.add_entry(key, unused.entries[is_duplicate_of])
+                    newbibdata_index.add(key, newbibdata.entries[key], cache_entry)
+                    if is_duplicate_of in dirty:
+                        dirty.add(key)
                     #unused_respawned.add(is_duplicate_of)
                     del unused.entries[is_duplicate_of]
+                    unused_index.remove(is_duplicate_of)
             else:
                 if used_citations is not None and key not in used_citations:
                     # new entry, but we don't want it. So add it to the unused list.
                     unused.add_entry(key, entry)
+                    unused_index.add(key, entry, cache_entry)
                 else:
                     # new entry and we want it. So add it to the main newbibdata list.
                     newbibdata.add_entry(key, entry)
+                    newbibdata_index.add(key, entry, cache_entry)
+
+        logger.debug("duplicates: reused %d of %d decisions from previous run", num_reused, len(decisions))
+        clusters_cache_accessor.set_decisions(run_id, decisions)
 
         # output duplicates to the duplicates file
 
@@ -741,6 +1127,9 @@ class DuplicatesFilter(BibFilter):
             # and write definitions to the dupfile
             dupfilepath = os.path.join(bibolamazifile.fdir(), self.dupfile);
             check_overwrite_dupfile(dupfilepath);
+            # we're also generating this file, so make sure the next run isn't skipped if
+            # it gets deleted or modified
+            bibolamazifile.registerDependencyFile(dupfilepath)
             dupstrlist = [];
             
             with codecs.open(dupfilepath, 'w', 'utf-8') as dupf:
@@ -872,6 +1261,35 @@ def levenshtein(a,b):
 
 
 
+def keys_out_of_order(keys_positions):
+    """
+    Given a list of pairs `(key, position)`, return the set of the keys which are not
+    part of a longest subsequence of the list with increasing positions.
+    """
+    # tails[i] is the index in keys_positions of the last element of the subsequence of
+    # length i+1 found so far which ends with the smallest position
+    tails = []
+    tail_positions = []
+    previous = [ None ] * len(keys_positions)
+    for (i, (key, pos)) in enumerate(keys_positions):
+        j = bisect.bisect_left(tail_positions, pos)
+        if j > 0:
+            previous[i] = tails[j-1]
+        if j == len(tails):
+            tails.append(i)
+            tail_positions.append(pos)
+        else:
+            tails[j] = i
+            tail_positions[j] = pos
+
+    in_order = set()
+    i = (tails[-1] if tails else None)
+    while i is not None:
+        in_order.add(keys_positions[i][0])
+        i = previous[i]
+    return set([ key for (key, pos) in keys_positions if key not in in_order ])
+
+
 def check_overwrite_dupfile(dupfilepath):
     if (not os.path.exists(dupfilepath)):
         return
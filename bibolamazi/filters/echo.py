@@ -110,6 +110,9 @@ class EchoFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_BIBOLAMAZIFILE;
 
+    def can_skip_unwanted_entries(self):
+        return True
+
     def filter_bibolamazifile(self, bibolamazifile):
 
         logger.log(self.loglevel.levelno,
@@ -26,9 +26,8 @@ logger = logging.getLogger(__name__)
 
 from pybtex.database import Person
 
-from pylatexenc import latexencode
-from pylatexenc import latexwalker
-from pylatexenc import latex2text
+# NOTE: pylatexenc's modules are slow to import, so they are only imported by the
+# functions below when the corresponding option is in use.
 
 from bibolamazi.core.bibfilter import BibFilter, BibFilterError
 from bibolamazi.core.bibfilter.argtypes import CommaStrList, ColonCommaStrDict
@@ -306,6 +305,10 @@ class FixesFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_SINGLE_ENTRY;
 
+    def can_run_in_parallel(self):
+        # we only act on the entry's fields and persons
+        return True
+
     def filter_bibentry(self, entry):
         #
         # entry is a pybtex.database.Entry object
@@ -323,8 +326,10 @@ class FixesFilter(BibFilter):
             if (self.encode_utf8_to_latex):
                 # Need non_ascii_only=True because we might have e.g. braces or other
                 # LaTeX code we want to preserve.
+                from pylatexenc import latexencode
                 x = latexencode.utf8tolatex(x, non_ascii_only=True);
             if (self.encode_latex_to_utf8):
+                from pylatexenc import latex2text
                 x = latex2text.latex2text(x);
             return x
 
@@ -359,6 +364,7 @@ class FixesFilter(BibFilter):
 
 
         def filter_entry_remove_full_braces(entry, fieldlist):
+            from pylatexenc import latexwalker
             for k,v in entry.fields.iteritems():
                 if (fieldlist is None or k in fieldlist):
                     val = v.strip();
@@ -452,6 +458,8 @@ def do_fix_space_after_escape(x):
 
     logger.longdebug("fixes filter: do_fix_space_after_escape(`%s')", x)
 
+    from pylatexenc import latexwalker
+
     if hasattr(latexwalker, 'default_macro_dict'): # pylatexenc version >= 1.0
         macro_dict = latexwalker.default_macro_dict
     else:
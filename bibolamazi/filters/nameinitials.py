@@ -26,8 +26,6 @@ logger = logging.getLogger(__name__)
 
 from pybtex.database import Person
 
-from pylatexenc import latex2text;
-
 from bibolamazi.core.butils import getbool;
 from bibolamazi.core.bibfilter import BibFilter, BibFilterError;
 
@@ -90,6 +88,10 @@ class NameInitialsFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_SINGLE_ENTRY;
 
+    def can_run_in_parallel(self):
+        # we only act on the entry's fields and persons
+        return True
+
     def filter_bibentry(self, entry):
         #
         # entry is a pybtex.database.Entry object
@@ -105,6 +107,7 @@ class NameInitialsFilter(BibFilter):
                 # BUG: FIXME: remove space after any macros
                 pstr = re.sub(r'(\\[a-zA-Z]+)\s+', r'\1{}', pstr); # replace "blah\macro blah" by "blah\macro{}blah"
                 if (self._names_to_utf8):
+                    from pylatexenc import latex2text
                     pstr = latex2text.latex2text(pstr)
                 p = Person(pstr)
                 if self._only_single_letter_firsts:
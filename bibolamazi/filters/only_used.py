@@ -96,6 +96,16 @@ class OnlyUsedFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_BIBOLAMAZIFILE;
 
+    def wanted_entry_keys(self):
+        # only the cited entries need to be loaded from the sources
+        try:
+            auxcitations = auxfile.get_aux_citations(self.jobname, self.bibolamaziFile(), self.name(),
+                                                     self.search_dirs)
+        except BibFilterError:
+            # no aux file: the error is reported when the filter is run
+            return None
+        return auxcitations.citation_set
+
 
     def filter_bibolamazifile(self, bibolamazifile):
 
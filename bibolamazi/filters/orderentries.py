@@ -99,6 +99,10 @@ class OrderEntriesFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_BIBOLAMAZIFILE;
 
+    def can_skip_unwanted_entries(self):
+        # the relative order of the remaining entries is the same
+        return True
+
     def getRunningMessage(self):
         return "%s: Processing %d entries" %(self.name(), len(self.bibolamaziFile().bibliographyData().entries))
 
@@ -101,6 +101,15 @@ class UrlNormalizeFilter(BibFilter):
     def action(self):
         return BibFilter.BIB_FILTER_SINGLE_ENTRY
 
+    def can_skip_unwanted_entries(self):
+        # prerun() only sets up the arxiv info cache
+        return True
+
+    def can_fuse_with_previous(self):
+        # prerun() only sets up the arxiv info cache, which doesn't need the entries to
+        # have been processed by the preceding filters
+        return True
+
     def prerun(self, bibolamazifile):
         arxivutil.setup_and_get_arxiv_accessor(self.bibolamaziFile())
 
@@ -0,0 +1,362 @@
+################################################################################
+#                                                                              #
+#   This file is part of the Bibolamazi Project.                               #
+#   Copyright (C) 2015 by Philippe Faist                                       #
+#   philippe.faist@bluewin.ch                                                  #
+#                                                                              #
+#   Bibolamazi is free software: you can redistribute it and/or modify         #
+#   it under the terms of the GNU General Public License as published by       #
+#   the Free Software Foundation, either version 3 of the License, or          #
+#   (at your option) any later version.                                        #
+#                                                                              #
+#   Bibolamazi is distributed in the hope that it will be useful,              #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of             #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              #
+#   GNU General Public License for more details.                               #
+#                                                                              #
+#   You should have received a copy of the GNU General Public License          #
+#   along with Bibolamazi.  If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                              #
+################################################################################
+
+"""
+A local store of arXiv metadata, imported from a bulk metadata dump, which is consulted
+before querying the arXiv API (see
+:py:meth:`~arxivutil.ArxivFetchedAPIInfoCacheAccessor.fetchArxivApiInfo`). This allows
+to use the arxiv-related filters on computers which can't access arxiv.org.
+
+The store is an SQLite database indexed by arXiv ID, so that looking up an entry doesn't
+require loading the whole dump. Its location is given by the environment variable
+``BIBOLAMAZI_ARXIV_METADATA``, and defaults to ``~/.bibolamazi/arxiv_metadata.db``. Import
+a dump with::
+
+    bibolamazi --import-arxiv-metadata arxiv-metadata-oai-snapshot.json
+
+The following dump formats are recognized (possibly gzip-compressed):
+
+  - JSON lines, one record per line, as in the arXiv metadata snapshot distributed by
+    arXiv (with keys 'id', 'title', 'authors_parsed', 'abstract', 'categories', 'doi',
+    'journal-ref', 'versions', ...);
+
+  - XML as returned by the arXiv OAI-PMH interface with ``metadataPrefix=arXiv`` (the
+    concatenation of several responses is also accepted).
+"""
+
+import os
+import os.path
+import re
+import gzip
+import json
+import sqlite3
+import email.utils
+import logging
+logger = logging.getLogger(__name__)
+
+from xml.etree import ElementTree
+
+import arxiv2bib
+
+from bibolamazi.core.butils import BibolamaziError
+
+
+# increase this if the layout of the database changes
+STORE_VERSION = 1
+
+_OAI_ARXIV = '{http://arxiv.org/OAI/arXiv/}'
+
+_rx_version = re.compile(r'v(\d+)$')
+_rx_old_style_id = re.compile(r'/(\d\d)(\d\d)\d+$')
+_rx_new_style_id = re.compile(r'^(\d\d)(\d\d)\.')
+
+
+def default_store_fname():
+    """
+    Return the file name of the arXiv metadata store, see the module documentation.
+    """
+    fname = os.environ.get('BIBOLAMAZI_ARXIV_METADATA', None)
+    if fname:
+        return fname
+    return os.path.join(os.path.expanduser('~'), '.bibolamazi', 'arxiv_metadata.db')
+
+
+def get_default_store():
+    """
+    Return an :py:class:`ArxivMetadataStore` for the store file given by
+    :py:func:`default_store_fname`, or `None` if no such file exists.
+    """
+    fname = default_store_fname()
+    if not os.path.exists(fname):
+        return None
+    return ArxivMetadataStore(fname)
+
+
+def _split_version(arxivid):
+    m = _rx_version.search(arxivid)
+    if m is None:
+        return (arxivid, None)
+    return (arxivid[:m.start()], m.group())
+
+
+def _date_from_id(arxivid):
+    # for dumps without dates, the year and month are part of the arXiv ID
+    m = _rx_old_style_id.search(arxivid) or _rx_new_style_id.search(arxivid)
+    if m is None:
+        return ''
+    yy = int(m.group(1))
+    return "%d-%s-01" %(1900+yy if yy >= 91 else 2000+yy, m.group(2))
+
+
+def _text(x):
+    return u" ".join((x or u'').split())
+
+
+
+class ArxivMetadataStore(object):
+    """
+    A local store of arXiv metadata in the SQLite database file `fname`. See the module
+    documentation.
+
+    Each record is stored as a JSON object with the keys 'id' (without version), 'version'
+    (the latest version, e.g. 'v2'), 'title', 'authors' (a list of names), 'abstract',
+    'category' (the primary category), 'doi', 'journal_ref', 'published' (the date of
+    the first version, 'YYYY-MM-DD') and 'updated'.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def _connect(self, create=False):
+        if create:
+            dirname = os.path.dirname(os.path.abspath(self.fname))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        conn = sqlite3.connect(self.fname)
+        if create:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, data TEXT)")
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                             (str(STORE_VERSION),))
+        return conn
+
+    def lookup(self, arxivids):
+        """
+        Return a dictionary `{ arxivid: record }` with the records found in the store for
+        the given arXiv IDs (with or without version). IDs which are not in the store are
+        not included in the returned dictionary.
+        """
+        bare_ids = dict( (arxivid, _split_version(arxivid)[0]) for arxivid in arxivids )
+        if not bare_ids:
+            return {}
+        conn = self._connect()
+        try:
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            if row is None or row[0] != str(STORE_VERSION):
+                logger.warning("Ignoring arXiv metadata store `%s', which is invalid or from "
+                               "another version. Please import the metadata dump again.", self.fname)
+                return {}
+            found = {}
+            wanted = list(set(bare_ids.values()))
+            # don't exceed SQLite's limit on the number of query parameters
+            for i in xrange(0, len(wanted), 500):
+                part = wanted[i:i+500]
+                for (bare_id, data) in conn.execute(
+                        "SELECT id, data FROM records WHERE id IN (%s)" %(",".join(["?"]*len(part))),
+                        part):
+                    found[bare_id] = json.loads(data)
+        finally:
+            conn.close()
+        return dict( (arxivid, found[bare_id]) for (arxivid, bare_id) in bare_ids.iteritems()
+                     if bare_id in found )
+
+    def get_references(self, arxivids):
+        """
+        Like :py:meth:`lookup`, but returns :py:class:`arxiv2bib.Reference` objects, as
+        would have been obtained from the arXiv API (see :py:func:`make_reference`).
+        """
+        return dict( (arxivid, make_reference(record, _split_version(arxivid)[1]))
+                     for (arxivid, record) in self.lookup(arxivids).iteritems() )
+
+    def import_dump(self, fname, batch_size=10000):
+        """
+        Import the records of the metadata dump file `fname` into the store (replacing any
+        records with the same IDs). Returns the number of records imported.
+
+        The dump is read incrementally, so it doesn't need to fit in memory.
+        """
+        if fname.endswith('.gz'):
+            f = gzip.open(fname, 'rb')
+        else:
+            f = open(fname, 'rb')
+        try:
+            conn = self._connect(create=True)
+            try:
+                n = 0
+                batch = []
+                for record in iter_dump_records(f):
+                    batch.append( (record['id'], json.dumps(record, separators=(',',':'))) )
+                    if len(batch) >= batch_size:
+                        n += self._insert(conn, batch)
+                        batch = []
+                        logger.info("Imported %d records ...", n)
+                n += self._insert(conn, batch)
+            finally:
+                conn.close()
+        finally:
+            f.close()
+        return n
+
+    def _insert(self, conn, batch):
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO records (id, data) VALUES (?, ?)", batch)
+        return len(batch)
+
+
+
+def iter_dump_records(f):
+    """
+    Yield the records (as described in :py:class:`ArxivMetadataStore`) in the metadata
+    dump read from the file object `f`, in any of the formats described in the module
+    documentation.
+    """
+    first = ''
+    while not first:
+        line = f.readline()
+        if not line:
+            return
+        first = line.strip()
+    if first.startswith('<'):
+        return _iter_oai_records(_prepend(line, f))
+    return _iter_json_records(_prepend(line, f))
+
+
+def _prepend(line, f):
+    yield line
+    for line in f:
+        yield line
+
+
+def _iter_json_records(lines):
+    for (lineno, line) in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            d = json.loads(line)
+        except ValueError as e:
+            raise BibolamaziError(u"Invalid arXiv metadata dump: line %d: %s" %(lineno+1, e))
+
+        (arxivid, version) = _split_version(d['id'])
+        versions = d.get('versions') or []
+        if versions:
+            version = versions[-1].get('version', version)
+        published = ''
+        if versions and versions[0].get('created'):
+            date = email.utils.parsedate(versions[0]['created'])
+            if date is not None:
+                published = "%04d-%02d-%02d" %(date[0], date[1], date[2])
+        if d.get('authors_parsed'):
+            authors = [ _text(u" ".join([n[1], n[0]] + n[2:])) for n in d['authors_parsed'] ]
+        else:
+            authors = [ _text(a) for a in re.split(r'\s+and\s+|,\s*', d.get('authors') or u'') ]
+        yield {
+            'id': arxivid,
+            'version': version or 'v1',
+            'title': _text(d.get('title')),
+            'authors': [ a for a in authors if a ],
+            'abstract': _text(d.get('abstract')),
+            'category': (d.get('categories') or u'').split(u' ')[0],
+            'doi': _text(d.get('doi')),
+            'journal_ref': _text(d.get('journal-ref')),
+            'published': published or _date_from_id(arxivid),
+            'updated': d.get('update_date') or '',
+            }
+
+
+class _LinesReader(object):
+    # file-like object reading from an iterable of lines, for ElementTree.iterparse()
+    def __init__(self, lines):
+        self._lines = lines
+        self._buf = ''
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buf)
+        (data, self._buf) = (self._buf[:size], self._buf[size:])
+        return data
+
+
+def _iter_oai_records(lines):
+    # several concatenated OAI-PMH responses (possibly with their own XML declarations)
+    # are wrapped into a single document
+    def wrapped():
+        yield '<dump>'
+        for line in lines:
+            yield re.sub(r'<\?xml[^>]*\?>', '', line)
+        yield '</dump>'
+    try:
+        for (event, elem) in ElementTree.iterparse(_LinesReader(wrapped())):
+            if elem.tag != _OAI_ARXIV + 'arXiv':
+                continue
+            def get(tag):
+                return _text(elem.findtext(_OAI_ARXIV + tag))
+            authors = []
+            for a in elem.findall(_OAI_ARXIV + 'authors/' + _OAI_ARXIV + 'author'):
+                authors.append(_text(u" ".join([ a.findtext(_OAI_ARXIV + t) or u''
+                                                 for t in ('forenames', 'keyname', 'suffix') ])))
+            arxivid = get('id')
+            yield {
+                'id': arxivid,
+                'version': '',
+                'title': get('title'),
+                'authors': [ a for a in authors if a ],
+                'abstract': get('abstract'),
+                'category': get('categories').split(u' ')[0],
+                'doi': get('doi'),
+                'journal_ref': get('journal-ref'),
+                'published': get('created') or _date_from_id(arxivid),
+                'updated': get('updated') or get('created'),
+                }
+            elem.clear()
+    except ElementTree.ParseError as e:
+        raise BibolamaziError(u"Invalid arXiv metadata dump: %s" %(e))
+
+
+
+def make_reference(record, version=None):
+    """
+    Return an :py:class:`arxiv2bib.Reference` for the given store record, as it would
+    have been returned by the arXiv API. If `version` (e.g. 'v2') is given, the
+    reference is for that version of the paper; otherwise it is for the latest version
+    known in the record.
+    """
+    atom = arxiv2bib.ATOM[1:-1]
+    arxiv = arxiv2bib.ARXIV[1:-1]
+    E = ElementTree.Element
+    Sub = ElementTree.SubElement
+
+    version = version or record.get('version') or ''
+    entry = E('{%s}entry' %(atom))
+    Sub(entry, '{%s}id' %(atom)).text = u"http://arxiv.org/abs/%s%s" %(record['id'], version)
+    Sub(entry, '{%s}updated' %(atom)).text = record.get('updated') or record.get('published') or u''
+    Sub(entry, '{%s}published' %(atom)).text = record.get('published') or u''
+    Sub(entry, '{%s}title' %(atom)).text = record.get('title') or u''
+    Sub(entry, '{%s}summary' %(atom)).text = record.get('abstract') or u''
+    for name in record.get('authors', []):
+        Sub(Sub(entry, '{%s}author' %(atom)), '{%s}name' %(atom)).text = name
+    if record.get('doi'):
+        Sub(entry, '{%s}doi' %(arxiv)).text = record['doi']
+    if record.get('journal_ref'):
+        Sub(entry, '{%s}journal_ref' %(arxiv)).text = record['journal_ref']
+    if record.get('category'):
+        Sub(entry, '{%s}primary_category' %(arxiv), term=record['category'])
+    ref = arxiv2bib.Reference(entry)
+    # arxiv2bib assumes that the id ends with a version number
+    ref.bare_id = record['id']
+    return ref
@@ -21,18 +21,65 @@
 
 import arxiv2bib
 import re
+import textwrap
+import datetime
+import socket
+import httplib
+import sqlite3
 from urllib2 import URLError, HTTPError
+from xml.etree.ElementTree import ParseError
 import logging
 logger = logging.getLogger(__name__)
 
 from bibolamazi.core.bibusercache import BibUserCacheAccessor, BibUserCacheError
+from bibolamazi.core.bibusercache import tokencheckers
 from bibolamazi.core.bibusercache.tokencheckers import EntryFieldsTokenChecker 
 from bibolamazi.core import butils
+from . import fetchutil
+from . import arxivmetadata
+from . import bibrecord
 
 
 class BibArxivApiFetchError(BibUserCacheError):
     def __init__(self, msg):
-        super(BibArxivApiFetchError).__init__('arxiv_fetched_api_info', msg)
+        super(BibArxivApiFetchError, self).__init__('arxiv_fetched_api_info', msg)
+
+
+# --- querying the arXiv API ---
+
+# The arXiv API terms of use (http://arxiv.org/help/api/tou) ask to make no more than one
+# request every three seconds, using a single connection at a time.
+ARXIV_API_CHUNK_SIZE = 100
+ARXIV_API_MAX_WORKERS = 1
+arxiv_api_rate_limiter = fetchutil.RateLimiter(3.0)
+
+# Timeout for each request to the arXiv API, in seconds. arxiv2bib makes its requests
+# without a timeout, so an unresponsive server would block the whole run. Instead, a
+# request which times out fails like any other connection error: the entries of the
+# chunk are fetched again in a later run.
+ARXIV_API_TIMEOUT = 30
+
+def _arxiv2bib_urlopen_with_timeout(url, *args, **kwargs):
+    if len(args) < 2: # (url, data, timeout)
+        kwargs.setdefault('timeout', ARXIV_API_TIMEOUT)
+    return _arxiv2bib_urlopen(url, *args, **kwargs)
+
+_arxiv2bib_urlopen = arxiv2bib.urlopen
+arxiv2bib.urlopen = _arxiv2bib_urlopen_with_timeout
+
+# IDs for which the arXiv API returned an error (e.g. withdrawn or invalid IDs) are not
+# queried again before some time, which doubles after each failure, up to a maximum
+ARXIV_API_RETRY_DELAY = datetime.timedelta(days=1)
+ARXIV_API_MAX_RETRY_DELAY = datetime.timedelta(days=64)
+
+# Entries which are older than the cache timeout are still used, and are refreshed along
+# with the next query for missing entries. If there isn't any, at most this number of
+# them are refreshed in each run, so that they don't all have to be fetched again at once
+ARXIV_API_STALE_REFRESH_MAX = ARXIV_API_CHUNK_SIZE
+
+# errors which mean that we couldn't get an answer from the arXiv API
+_arxiv_api_connection_errors = (URLError, socket.error, httplib.HTTPException, ParseError,
+                                arxiv2bib.FatalError)
 
 
 # --- code to detect arXiv info ---
@@ -278,6 +325,23 @@ def stripArXivInfoInNote(notestr):
 # ---- API info ------
 
 
+def _reference_doi(ref):
+    try:
+        doi = ref._field_text('doi', namespace=arxiv2bib.ARXIV)
+    except:
+        return None
+    if (doi):
+        return doi
+    return None
+
+def _reference_category(ref):
+    try:
+        return ref.category;
+    except AttributeError:
+        # happens for ReferenceErrorInfo, for example
+        return None
+
+
 
 class ArxivFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
     """
@@ -300,9 +364,52 @@ class ArxivFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
                      cache_obj.cacheExpirationTokenChecker().time_valid)
 
         # validate each entry with an expiration checker. Do this per entry, rather than
-        # globally on the full cache. (So don't use installCacheExpirationChecker())
-        dic['fetched'].set_validation(cache_obj.cacheExpirationTokenChecker())
-        
+        # globally on the full cache. (So don't use installCacheExpirationChecker()).
+        # Expired entries are kept until they reach the maximum cache age, and are
+        # refreshed in the meantime (see fetchArxivApiInfo()). Also check the version of
+        # the stored records, so that entries in an older format are fetched again.
+        dic['fetched'].set_validation(tokencheckers.TokenCheckerCombine(
+            tokencheckers.VersionTokenChecker(bibrecord.RECORD_VERSION),
+            cache_obj.cacheStaleExpirationTokenChecker()
+            ))
+
+        # IDs for which we got an error: { arxivid: { 'count': number of consecutive
+        # failures, 'retry_after': datetime, 'message': error message } }. Not validated
+        # by expiry, so that the retry delay keeps growing.
+        if 'failures' not in dic:
+            dic['failures'] = {}
+
+
+    def _record_failure(self, aid, ref):
+        failures = self.cacheDic()['failures']
+        count = (failures[aid]['count'] if aid in failures else 0) + 1
+        delay = min(ARXIV_API_RETRY_DELAY * 2**(count-1), ARXIV_API_MAX_RETRY_DELAY)
+        failures[aid] = {
+            'count': count,
+            'retry_after': datetime.datetime.now() + delay,
+            'message': ref.message,
+            }
+
+    def _store_references(self, refs):
+        # store the given { arxivid: reference } in the cache. Don't store the reference
+        # objects themselves, but only the parsed bibtex entry and the information we
+        # need from them, see getArxivApiInfo().
+        cache_entrydic = self.cacheDic()['fetched']
+        failures = self.cacheDic()['failures']
+        with cache_entrydic.batch_changes():
+            for (k,ref) in refs.iteritems():
+                logger.longdebug("Got reference object for id %s: %r" %(k, ref.__dict__))
+                is_error = isinstance(ref, arxiv2bib.ReferenceErrorInfo)
+                cache_entrydic[k] = {
+                    'records': tuple(bibrecord.bibtex_to_records(ref.bibtex())),
+                    'primaryclass': _reference_category(ref),
+                    'doi': _reference_doi(ref),
+                    'error': (ref.message if is_error else None),
+                    }
+                if is_error:
+                    self._record_failure(k, ref)
+                elif k in failures:
+                    del failures[k]
 
 
     def fetchArxivApiInfo(self, idlist):
@@ -319,10 +426,61 @@ class ArxivFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
         is received this function raises :py:exc:`BibArxivApiFetchError` with a meaningful
         error text.
 
-        Only those entries in `idlist` which are not already in the cache are fetched.
+        Only those entries in `idlist` which are not already in the cache are fetched. If
+        a local arXiv metadata store is available (see :py:mod:`arxivmetadata`), it is
+        consulted first, and only the entries which are not found there are queried from
+        the arXiv API.
+
+        If the arXiv API returned an error for an ID (e.g. an invalid or withdrawn ID),
+        the error information (:py:class:`arxiv2bib.ReferenceErrorInfo`) is stored in the
+        cache, and the ID is not queried again before a delay, which starts at
+        `ARXIV_API_RETRY_DELAY` and doubles after each further failure. A summary of
+        these IDs is logged.
+
+        Entries which are in the cache but are older than the cache timeout (*stale*
+        entries) are still used, and are fetched again along with the missing entries;
+        if there are no missing entries, only up to `ARXIV_API_STALE_REFRESH_MAX` stale
+        entries are fetched again. If a stale entry can't be fetched again, the stale
+        information is kept (until it reaches the maximum cache age).
+
+        If, in the end, the information about some of the IDs is missing, is an error or
+        is stale, the output of the bibolamazi file is marked as incomplete (see
+        :py:meth:`BibolamaziFile.registerIncompleteOutput()
+        <bibolamazi.core.bibolamazifile.BibolamaziFile.registerIncompleteOutput>`), so
+        that the next run isn't skipped. Otherwise, the time at which the information
+        should be refreshed is registered (see :py:meth:`BibolamaziFile.registerExpiryTime()
+        <bibolamazi.core.bibolamazifile.BibolamaziFile.registerExpiryTime>`).
+
+        Returns `False` if we couldn't connect to the arXiv API, or `True` otherwise.
 
         `idlist` can be any iterable.
         """
+        idlist = list(idlist)
+        ok = self._fetch_arxiv_api_info(idlist)
+        self._register_fetch_outcome(idlist)
+        return ok
+
+    def _register_fetch_outcome(self, idlist):
+        # tell the bibolamazi file whether the output has all the information about the
+        # IDs in `idlist`, or when this information should be refreshed, so that later
+        # runs aren't skipped if they can improve the output
+        bibolamazifile = self.bibolamaziFile()
+        cache_entrydic = self.cacheDic()['fetched']
+        failures = self.cacheDic()['failures']
+        for aid in idlist:
+            if aid in failures:
+                bibolamazifile.registerExpiryTime(failures[aid]['retry_after'])
+            if (aid not in cache_entrydic or 'records' not in cache_entrydic[aid]):
+                bibolamazifile.registerIncompleteOutput("missing arXiv API information")
+            elif cache_entrydic[aid]['error'] is not None:
+                bibolamazifile.registerIncompleteOutput("arXiv API errors")
+            elif cache_entrydic.is_stale(aid):
+                bibolamazifile.registerIncompleteOutput("stale arXiv API information")
+            else:
+                bibolamazifile.registerExpiryTime(cache_entrydic.refresh_time(aid))
+
+    def _fetch_arxiv_api_info(self, idlist):
+        # see fetchArxivApiInfo()
 
         cache_entrydic = self.cacheDic()['fetched']
         logger.longdebug("fetchArxivApiInfo(): "
@@ -334,61 +492,142 @@ class ArxivFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
         logger.longdebug("fetchArxivApiInfo(): in the cache, we have keys %r",
                          cache_entrydic.keys())
 
+        failures = self.cacheDic()['failures']
+        now = datetime.datetime.now()
+
         missing_ids = []
-        #debug_allids = []
+        stale_ids = []
+        backing_off = []
         for aid in idlist:
-            #debug_allids.append(aid)
+            if aid in failures and failures[aid]['retry_after'] > now:
+                # failed recently; don't try again yet
+                backing_off.append(aid)
+                if (aid not in cache_entrydic or 'records' not in cache_entrydic[aid]):
+                    # the error info expired from the cache
+                    self._store_references({
+                        aid: arxiv2bib.ReferenceErrorInfo(failures[aid]['message'], aid)
+                        })
+                continue
             if (aid not in cache_entrydic  or
-                cache_entrydic.get(aid) is None  or
-                isinstance(cache_entrydic.get(aid), arxiv2bib.ReferenceErrorInfo)):
+                'records' not in cache_entrydic[aid]  or
+                cache_entrydic[aid]['error'] is not None):
                 missing_ids.append(aid)
+            elif cache_entrydic.is_stale(aid) and aid not in stale_ids:
+                stale_ids.append(aid)
 
-        #logger.longdebug("fetchArxivApiInfo(): debug_allids=%r, missing_ids=%r", debug_allids, missing_ids)
+        if backing_off:
+            logger.info("Not querying the arXiv API again for %d ID(s) which failed recently:\n%s",
+                        len(backing_off),
+                        "\n".join([ "    %s: %s (%d failure(s), retrying after %s)"
+                                    %(aid, failures[aid]['message'], failures[aid]['count'],
+                                      failures[aid]['retry_after'].strftime('%Y-%m-%d %H:%M'))
+                                    for aid in sorted(backing_off) ]))
 
         if not missing_ids:
+            stale_ids = stale_ids[:ARXIV_API_STALE_REFRESH_MAX]
+        if not missing_ids and not stale_ids:
             logger.longdebug('nothing to fetch: no missing ids')
             # nothing to fetch
             return True
 
-        logger.info("Fetching missing information from the arXiv API...")
-        logger.debug('fetching missing id list %r' %(missing_ids))
+        metadata_store = arxivmetadata.get_default_store()
+        if metadata_store is not None:
+            try:
+                found = metadata_store.get_references(missing_ids + stale_ids)
+            except sqlite3.Error as e:
+                logger.warning("Can't read local arXiv metadata store `%s': %s",
+                               metadata_store.fname, e)
+                found = {}
+            logger.debug("found %d/%d missing or stale ids in local arXiv metadata store `%s'",
+                         len(found), len(missing_ids) + len(stale_ids), metadata_store.fname)
+            self._store_references(found)
+            missing_ids = [ aid for aid in missing_ids if aid not in found ]
+            stale_ids = [ aid for aid in stale_ids if aid not in found ]
+            if not missing_ids and not stale_ids:
+                return True
+
+        if missing_ids:
+            logger.info("Fetching missing information from the arXiv API...")
+        logger.debug('fetching missing id list %r, and refreshing stale id list %r',
+                     missing_ids, stale_ids)
+
+        # Fetch the information in chunks, and store each chunk in the cache (and save
+        # the cache) as soon as we get it, so that if we are interrupted, the next run
+        # only needs to fetch what is still missing.
+        num_fetched = 0
+        remaining_missing = set(missing_ids)
+        new_failures = []
         try:
-            arxivdict = arxiv2bib.arxiv2bib_dict(missing_ids)
-            logger.longdebug('got entries %r: %r' %(arxivdict.keys(), arxivdict))
-        except URLError as error:
-            if isinstance(error, HTTPError) and error.getcode() == 403:
-                raise BibArxivApiFetchError(
-                    textwrap.dedent("""\
-                    Error fetching ArXiv API Info: ** 403 Forbidden **
-
-                    This usually happens when you make many rapid fire requests in a
-                    row. If you continue to do this, arXiv.org may interpret your requests
-                    as a denial of service attack.
-
-                    For more information, see http://arxiv.org/help/robots.
-                    """))
-            else:
-                msg = (("%d: %s" %(error.code, error.reason)) if isinstance(error, HTTPError)
-                       else error.reason)
-                logger.warning("HTTP Connection Error: %s.", msg)
-                logger.warning("ArXiv API information will not be retreived, and your bibliography "
-                               "might be incomplete.")
-                return False
-                #
-                # Don't raise an error, in case the guy is running bibolamazi on his laptop on the
-                # train. In that case he might prefer some missing entries rather than a critical failure.
-                #
-                #            raise BibFilterError(
-                #                filtname,
-                #                "HTTP Connection Error: {0}".format(error.getcode())
-                #                )
-
-        for (k,ref) in arxivdict.iteritems():
-            logger.longdebug("Got reference object for id %s: %r" %(k, ref.__dict__))
-            cache_entrydic[k]['reference'] = ref
-            bibtex = ref.bibtex()
-            cache_entrydic[k]['bibtex'] = bibtex
-
+            for (chunk, arxivdict, exc_info) in fetchutil.iter_fetch_chunks(
+                    arxiv2bib.arxiv2bib_dict,
+                    fetchutil.split_chunks(missing_ids + stale_ids, ARXIV_API_CHUNK_SIZE),
+                    max_workers=ARXIV_API_MAX_WORKERS,
+                    rate_limiter=arxiv_api_rate_limiter):
+
+                if exc_info is not None:
+                    error = exc_info[1]
+                    if not isinstance(error, _arxiv_api_connection_errors):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    if isinstance(error, HTTPError) and error.getcode() == 403:
+                        raise BibArxivApiFetchError(
+                            textwrap.dedent("""\
+                            Error fetching ArXiv API Info: ** 403 Forbidden **
+
+                            This usually happens when you make many rapid fire requests in a
+                            row. If you continue to do this, arXiv.org may interpret your requests
+                            as a denial of service attack.
+
+                            For more information, see http://arxiv.org/help/robots.
+                            """))
+                    if isinstance(error, HTTPError):
+                        msg = "%d: %s" %(error.code, error.reason)
+                    elif isinstance(error, URLError):
+                        msg = error.reason
+                    else:
+                        msg = unicode(error)
+                    if not remaining_missing:
+                        # we were only refreshing stale entries, keep them for now
+                        logger.debug("Can't refresh stale arXiv API information: %s", msg)
+                        return True
+                    logger.warning("HTTP Connection Error: %s.", msg)
+                    logger.warning("ArXiv API information will not be retreived for %d entries, and your "
+                                   "bibliography might be incomplete.", len(remaining_missing))
+                    return False
+                    #
+                    # Don't raise an error, in case the guy is running bibolamazi on his laptop on the
+                    # train. In that case he might prefer some missing entries rather than a critical failure.
+                    #
+
+                logger.longdebug('got entries %r: %r' %(arxivdict.keys(), arxivdict))
+
+                for aid in chunk:
+                    if aid not in arxivdict:
+                        arxivdict[aid] = arxiv2bib.ReferenceErrorInfo("Not found", aid)
+                    if (aid not in remaining_missing and
+                        isinstance(arxivdict[aid], arxiv2bib.ReferenceErrorInfo)):
+                        # couldn't refresh stale entry, keep it for now
+                        logger.debug("Can't refresh stale arXiv API information for %s: %s",
+                                     aid, arxivdict[aid].message)
+                        del arxivdict[aid]
+                self._store_references(arxivdict)
+                new_failures += [ aid for aid in chunk
+                                  if aid in arxivdict and
+                                  isinstance(arxivdict[aid], arxiv2bib.ReferenceErrorInfo) ]
+                remaining_missing.difference_update(chunk)
+
+                self.cacheObject().saveCacheStore(names=[self.cacheName()])
+
+                num_fetched += len(chunk)
+                logger.debug("fetched arXiv API information for %d/%d ids", num_fetched,
+                             len(missing_ids) + len(stale_ids))
+        finally:
+            if new_failures:
+                logger.warning("The arXiv API returned an error for %d ID(s), which will be retried "
+                               "later:\n%s", len(new_failures),
+                               "\n".join([ "    %s: %s (retrying after %s)"
+                                           %(aid, failures[aid]['message'],
+                                             failures[aid]['retry_after'].strftime('%Y-%m-%d %H:%M'))
+                                           for aid in sorted(new_failures) ]))
 
         logger.longdebug("arxiv api info: Got all references. cacheDic() is now:  %r", self.cacheDic())
         logger.longdebug("... and cacheObject().cachedic is now:  %r", self.cacheObject().cachedic)
@@ -401,20 +640,42 @@ class ArxivFetchedAPIInfoCacheAccessor(BibUserCacheAccessor):
         Returns a dictionary::
 
             {
-              'reference':  <arxiv2bib.Reference>,
-              'bibtex': <bibtex string>
+              'records': <tuple of (key, record)>,
+              'primaryclass': <primary arXiv category, or None>,
+              'doi': <DOI, or None>,
+              'error': <error message, or None>
             }
 
         for the given arXiv id in the cache. If the information is not in the cache,
         returns `None`.
 
+        The `records` are the parsed bibtex entries generated from the arXiv API
+        information, as compact records (see :py:mod:`bibrecord`); use
+        :py:meth:`getArxivApiEntries()` to get them as pybtex `Entry` objects.
+
         Don't forget to first call :py:meth:`fetchArxivApiInfo()` to retrieve the
         information in the first place.
 
-        Note the reference part may be a :py:class:`arxiv2bib.ReferenceErrorInfo`, if
-        there was an error retreiving the reference.
+        If there was an error retreiving the reference, `error` is the error message
+        (and `records` contains an entry reporting the error).
         """
-        return self.cacheDic()['fetched'].get(arxivid, None)
+        cache_entrydic = self.cacheDic()['fetched']
+        if (arxivid not in cache_entrydic or 'records' not in cache_entrydic[arxivid]):
+            return None
+        return cache_entrydic[arxivid]
+
+    def getArxivApiEntries(self, arxivid):
+        """
+        Returns a list of tuples `(key, entry)` with the bibtex entries (as pybtex `Entry`
+        objects) generated from the arXiv API information for the given arXiv id. If the
+        information is not in the cache, returns `None`.
+
+        The entries are newly created objects, which the caller may freely modify.
+        """
+        dat = self.getArxivApiInfo(arxivid)
+        if dat is None:
+            return None
+        return [ (key, bibrecord.record_to_entry(rec)) for (key, rec) in dat['records'] ]
 
 
 
@@ -435,7 +696,9 @@ class ArxivInfoCacheAccessor(BibUserCacheAccessor):
         cache_dic['entries'].set_validation(
             EntryFieldsTokenChecker(self.bibolamaziFile().bibliographyData(),
                                     store_type=True,
-                                    fields=arxivinfo_from_bibtex_fields)
+                                    fields=arxivinfo_from_bibtex_fields,
+                                    fingerprint_index=self.bibolamaziFile().entryFingerprintIndex()),
+            lazy=True
             )
         cache_dic.setdefault('cache_built', False)
 
@@ -467,8 +730,10 @@ class ArxivInfoCacheAccessor(BibUserCacheAccessor):
 
         entrydic = self.cacheDic()['entries']
 
-        # A list if pairs (citekey, arxiv-id) of entries that still need to be completed
-        # with info from the arXiv API.
+        # A list if pairs (citekey, arxiv-id) of entries that need to be completed with
+        # info from the arXiv API. This includes the entries which were already in the
+        # cache, so that information which couldn't be fetched in an earlier run is
+        # fetched now, and so that refreshed information is used.
         needs_to_be_completed = []
 
         #
@@ -476,15 +741,15 @@ class ArxivInfoCacheAccessor(BibUserCacheAccessor):
         # using only what we have. We'll do a query to the arXiv API in a second step
         # below.
         #
-        for k,v in bibdata.entries.iteritems():
-            if (k in entrydic):
-                continue
-            arinfo = detectEntryArXivInfo(v);
-            entrydic[k] = arinfo;
-            logger.longdebug("got arXiv information for `%s': %r.", k, arinfo)
-            
-            if (entrydic[k] is not None):
-                needs_to_be_completed.append( (k, arinfo['arxivid'],) )
+        with entrydic.batch_changes():
+            for k,v in bibdata.entries.iteritems():
+                if (k not in entrydic):
+                    arinfo = detectEntryArXivInfo(v);
+                    entrydic[k] = arinfo;
+                    logger.longdebug("got arXiv information for `%s': %r.", k, arinfo)
+
+                if (entrydic[k] is not None):
+                    needs_to_be_completed.append( (k, entrydic[k]['arxivid'],) )
 
         logger.longdebug("complete_cache(): needs_to_be_completed=%r\nentrydic=%r\n",
                          needs_to_be_completed,
@@ -495,14 +760,24 @@ class ArxivInfoCacheAccessor(BibUserCacheAccessor):
         #
         arxiv_api_accessor.fetchArxivApiInfo( (x[1] for x in needs_to_be_completed), )
 
-        for (k,aid) in needs_to_be_completed:
-            api_info = arxiv_api_accessor.getArxivApiInfo(aid)
-            if (api_info is None):
-                logger.warning("Failed to fetch arXiv information for %s", aid);
-                continue
-            
-            entrydic[k]['primaryclass'] = self._reference_category(api_info['reference'])
-            entrydic[k]['doi'] = self._reference_doi(api_info['reference']);
+        with entrydic.batch_changes():
+            for (k,aid) in needs_to_be_completed:
+                api_info = arxiv_api_accessor.getArxivApiInfo(aid)
+                if (api_info is None):
+                    # no information from the arXiv API (e.g. we are offline). Don't
+                    # report what was detected in the entry itself either, as for the
+                    # entries for which the API returned an error.
+                    logger.debug("No arXiv API information for %s", aid)
+                    (primaryclass, doi) = (None, None)
+                else:
+                    (primaryclass, doi) = (api_info['primaryclass'], api_info['doi'])
+
+                # don't touch entries which don't change, so that the cache isn't
+                # needlessly saved again
+                arinfo = entrydic[k]
+                if (arinfo['primaryclass'] != primaryclass or arinfo['doi'] != doi):
+                    arinfo['primaryclass'] = primaryclass
+                    arinfo['doi'] = doi
 
 
     def getArXivInfo(self, entrykey):
@@ -521,23 +796,6 @@ class ArxivInfoCacheAccessor(BibUserCacheAccessor):
         return entrydic.get(entrykey, None)
 
 
-    def _reference_doi(self, ref):
-        try:
-            doi = ref._field_text('doi', namespace=arxiv2bib.ARXIV)
-        except:
-            return None
-        if (doi):
-            return doi
-        return None
-
-    def _reference_category(self, ref):
-        try:
-            return ref.category;
-        except AttributeError:
-            # happens for ReferenceErrorInfo, for example
-            return None
-
-
 
 
 
@@ -20,7 +20,7 @@
 ################################################################################
 
 """
-Utilities (actually for now, utility) to parse .aux files from LaTeX documents.
+Utilities to parse .aux files from LaTeX documents.
 """
 
 
@@ -34,56 +34,158 @@ from bibolamazi.core.bibfilter import BibFilter, BibFilterError;
 
 
 
-def get_all_auxfile_citations(jobname, bibolamazifile, filtername, search_dirs=None,
-                              callback=None, return_set=True):
+# matches the commands we're interested in in .aux files: citations, and inclusions of
+# other .aux files (as written e.g. for each \include'd chapter)
+_rx_aux_command = re.compile(r'\\citation\s*\{(?P<citekey>[^\}]+)\}|\\@input\s*\{(?P<input>[^\}]+)\}')
+
+# parsed .aux files, shared between all filters (and between runs, if several runs happen
+# in the same process): { realpath: (mtime, size, items) } where items is a list of
+# ('citation', citekey) or ('input', filename) in the order in which they appear.
+_parsed_aux_files = {}
+
+
+class AuxCitations(object):
     """
-    Get a list of bibtex keys that a specific LaTeX document cites, by inspecting its .aux
-    file.
+    The citations of a LaTeX document, as collected from its .aux file (and the .aux
+    files included by it). See :py:func:`get_aux_citations`.
+
+    Attributes:
+
+      - `citations`: the list of cited keys, in the order in which they appear in the
+        .aux files (following included .aux files where they are included). A key
+        appears as many times as it is cited.
+
+      - `citation_set`: the set of cited keys.
+
+      - `auxfiles`: the list of the .aux files which were read.
+    """
+    def __init__(self, citations, auxfiles):
+        self.citations = citations
+        self.citation_set = frozenset(citations)
+        self.auxfiles = auxfiles
+
+
+def _parse_aux_file(fname):
+    # Returns the list of items in the given aux file, see _parsed_aux_files. Returns
+    # `None` if the file can't be read.
+    fname = os.path.realpath(fname)
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    cached = _parsed_aux_files.get(fname)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+
+    try:
+        with open(fname, 'r') as auxf:
+            allaux = auxf.read()
+    except IOError:
+        return None
+
+    items = []
+    for m in _rx_aux_command.finditer(allaux):
+        if m.group('citekey') is not None:
+            items += [ ('citation', x.strip()) for x in m.group('citekey').split(',') ]
+        else:
+            items.append( ('input', m.group('input').strip()) )
+
+    logger.longdebug("Parsed aux file `%s'", fname)
+    _parsed_aux_files[fname] = (st.st_mtime, st.st_size, items)
+    return items
+
+
+def get_aux_citations(jobname, bibolamazifile, filtername, search_dirs=None):
+    """
+    Get the citations of a specific LaTeX document, by inspecting its .aux file. Returns
+    an :py:class:`AuxCitations` object.
 
     Look for the file ``<jobname>.aux`` in the current directory, or in the search
     directories `search_dirs` if given. Parse that file for commands of the type
     ``\citation{..}``, and collect all the arguments of such commands. These commands are
-    generated by calls to the ``\cite{}`` command in the LaTeX document.
+    generated by calls to the ``\cite{}`` command in the LaTeX document. The .aux files
+    included with ``\@input{..}`` (as generated for chapters included with
+    ``\include{}``) are parsed as well.
 
-    This effectively gives a list of entries that a particular document cites.
+    The parsed .aux files are remembered, so that several filters using the same .aux
+    files only read them once (as long as they are not modified).
+
+    All the .aux files which are looked for are registered as dependencies of the
+    bibolamazi file (see :py:meth:`BibolamaziFile.registerDependencyFile`).
 
     Note: latex/pdflatex must have run at least once on the document already.
     """
 
     logger.debug("Retrieving citations from job name `%s'" %(jobname))
 
-    citations_list = set()
-
     if (search_dirs is None):
         search_dirs = ['.', '_cleanlatexfiles']
 
-    allaux = None
+    mainaux = None
+    mainitems = None
     for maybeauxfile in (os.path.join(bibolamazifile.fdir(), searchdir, jobname+'.aux')
                          for searchdir in search_dirs):
-        try:
-            with open(maybeauxfile, 'r') as auxf:
-                allaux = auxf.read()
-        except IOError:
-            pass
+        # the result depends on this file, whether it exists or not
+        bibolamazifile.registerDependencyFile(maybeauxfile)
+        items = _parse_aux_file(maybeauxfile)
+        if items is not None:
+            (mainaux, mainitems) = (maybeauxfile, items)
 
-    if (not allaux):
+    if (mainaux is None):
         raise BibFilterError(filtername, "Can't analyze citations: can't find `%s.aux'." %(jobname))
 
-    #
-    # parse allaux for \citation{...}
-    #
-    
-    for citation in re.finditer(r'\\citation\s*\{(?P<citekey>[^\}]+)\}', allaux):
-        citekeys = (x.strip() for x in citation.group('citekey').split(','))
-        if (return_set):
-            for citekey in citekeys:
-                citations_list.add(citekey)
-        if (callback is not None):
-            for citekey in citekeys:
-                callback(citekey)
+    # included .aux files are relative to the directory in which latex was run, i.e. where
+    # the main .aux file is
+    auxdir = os.path.dirname(mainaux)
+
+    citations = []
+    auxfiles = [mainaux]
+    seen = set([os.path.realpath(mainaux)])
+
+    def collect(items):
+        for (what, val) in items:
+            if what == 'citation':
+                citations.append(val)
+                continue
+            fname = os.path.join(auxdir, val)
+            if os.path.realpath(fname) in seen:
+                continue
+            seen.add(os.path.realpath(fname))
+            bibolamazifile.registerDependencyFile(fname)
+            subitems = _parse_aux_file(fname)
+            if subitems is None:
+                # latex skips nonexisting files as well
+                logger.debug("Can't read included aux file `%s', skipping", fname)
+                continue
+            auxfiles.append(fname)
+            collect(subitems)
+
+    collect(mainitems)
+
+    return AuxCitations(citations, auxfiles)
+
+
+def get_all_auxfile_citations(jobname, bibolamazifile, filtername, search_dirs=None,
+                              callback=None, return_set=True):
+    """
+    Get a list of bibtex keys that a specific LaTeX document cites, by inspecting its .aux
+    file (and the .aux files included by it), see :py:func:`get_aux_citations`.
+
+    This effectively gives a list of entries that a particular document cites.
+
+    If `callback` is given, it is called for each citation key, in the order in which
+    they appear. If `return_set` is `True`, the set of cited keys is returned.
+
+    Note: latex/pdflatex must have run at least once on the document already.
+    """
+
+    auxcitations = get_aux_citations(jobname, bibolamazifile, filtername, search_dirs=search_dirs)
+
+    if (callback is not None):
+        for citekey in auxcitations.citations:
+            callback(citekey)
 
     if return_set:
-        return citations_list
+        return set(auxcitations.citation_set)
 
     return
-
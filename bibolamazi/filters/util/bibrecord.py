@@ -0,0 +1,88 @@
+################################################################################
+#                                                                              #
+#   This file is part of the Bibolamazi Project.                               #
+#   Copyright (C) 2015 by Philippe Faist                                       #
+#   philippe.faist@bluewin.ch                                                  #
+#                                                                              #
+#   Bibolamazi is free software: you can redistribute it and/or modify         #
+#   it under the terms of the GNU General Public License as published by       #
+#   the Free Software Foundation, either version 3 of the License, or          #
+#   (at your option) any later version.                                        #
+#                                                                              #
+#   Bibolamazi is distributed in the hope that it will be useful,              #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of             #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              #
+#   GNU General Public License for more details.                               #
+#                                                                              #
+#   You should have received a copy of the GNU General Public License          #
+#   along with Bibolamazi.  If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                              #
+################################################################################
+
+"""
+Compact records of already-parsed bibliography entries, for storing in the cache.
+
+Filters which fetch BibTeX code from online services (e.g. `citearxiv`,
+`citeinspirehep`) parse it once, when it is fetched, and store the result in the cache as
+a record made only of tuples and strings (see :py:func:`entry_to_record`). On the next
+runs, the pybtex `Entry` objects are rebuilt directly from these records (see
+:py:func:`record_to_entry`), without parsing any BibTeX code.
+"""
+
+import io
+import logging
+logger = logging.getLogger(__name__)
+
+from pybtex.database import Entry, Person
+import pybtex.database.input.bibtex as inputbibtex
+
+
+# Increase this if the format of the records changes. Store it in the cache along with
+# the records, e.g. with a `VersionTokenChecker`.
+RECORD_VERSION = 1
+
+_person_parts = ('first', 'middle', 'prelast', 'last', 'lineage')
+
+
+def entry_to_record(entry):
+    """
+    Return a compact record of the given pybtex `Entry`. The record is a tuple
+    ``(type, fields, persons)``, where `fields` is a tuple of ``(name, value)`` pairs and
+    `persons` is a tuple of ``(role, (person, ...))``, where each person is itself a
+    tuple of the lists of names of the parts first, middle, prelast, last and lineage.
+
+    The order of the fields and persons is kept. Cross-references are not followed.
+    """
+    return (
+        entry.original_type,
+        tuple([ (fld, val) for (fld, val) in entry.fields.iteritems() ]),
+        tuple([ (role, tuple([ tuple([ tuple(p.get_part(part)) for part in _person_parts ])
+                               for p in persons ]))
+                for (role, persons) in entry.persons.iteritems() ]),
+        )
+
+
+def record_to_entry(record):
+    """
+    Rebuild a pybtex `Entry` from a record returned by :py:func:`entry_to_record`.
+    """
+    (typ, fields, persons) = record
+    entry = Entry(typ, fields=fields)
+    for (role, plist) in persons:
+        for pparts in plist:
+            p = Person()
+            for (part, names) in zip(_person_parts, pparts):
+                getattr(p, '_'+part).extend(names)
+            entry.add_person(p, role)
+    return entry
+
+
+def bibtex_to_records(bibtex):
+    """
+    Parse the given BibTeX code, and return a list of ``(key, record)`` tuples for the
+    entries it contains, in order. See :py:func:`entry_to_record`.
+    """
+    parser = inputbibtex.Parser()
+    with io.StringIO(unicode(bibtex)) as stream:
+        bibdata = parser.parse_stream(stream)
+    return [ (key, entry_to_record(entry)) for (key, entry) in bibdata.entries.iteritems() ]
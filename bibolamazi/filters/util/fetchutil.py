@@ -0,0 +1,149 @@
+################################################################################
+#                                                                              #
+#   This file is part of the Bibolamazi Project.                               #
+#   Copyright (C) 2015 by Philippe Faist                                       #
+#   philippe.faist@bluewin.ch                                                  #
+#                                                                              #
+#   Bibolamazi is free software: you can redistribute it and/or modify         #
+#   it under the terms of the GNU General Public License as published by       #
+#   the Free Software Foundation, either version 3 of the License, or          #
+#   (at your option) any later version.                                        #
+#                                                                              #
+#   Bibolamazi is distributed in the hope that it will be useful,              #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of             #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              #
+#   GNU General Public License for more details.                               #
+#                                                                              #
+#   You should have received a copy of the GNU General Public License          #
+#   along with Bibolamazi.  If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                              #
+################################################################################
+
+"""
+Utilities for fetching information from online services (arXiv.org, InspireHEP) in
+chunks, with a limited number of simultaneous requests and a limited request rate.
+"""
+
+import sys
+import time
+import random
+import threading
+import Queue
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+def split_chunks(items, chunk_size):
+    """
+    Split the list `items` into lists of at most `chunk_size` items.
+    """
+    items = list(items)
+    return [ items[i:i+chunk_size] for i in xrange(0, len(items), chunk_size) ]
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    """
+    Return how long to wait (in seconds) before retrying a request which failed, where
+    `attempt` is the number of the retry (starting at zero). The delay doubles after each
+    attempt, starting at `base_delay` up to at most `max_delay`, and is randomized between
+    half and all of this value so that simultaneous clients don't retry all at once.
+    """
+    delay = min(max_delay, base_delay * 2**attempt)
+    return random.uniform(delay/2.0, delay)
+
+
+class RateLimiter(object):
+    """
+    Make sure that requests are not sent more often than once every `min_interval`
+    seconds. Call :py:meth:`wait` before each request.
+
+    The same instance may be shared between several threads (and should be shared
+    between all requests to the same service).
+    """
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_time = 0
+
+    def wait(self):
+        """
+        Wait until the next request may be sent.
+        """
+        with self._lock:
+            now = time.time()
+            t = max(now, self._next_time)
+            self._next_time = t + self.min_interval
+        if t > now:
+            logger.longdebug("RateLimiter: waiting %.1fs", t - now)
+            time.sleep(t - now)
+
+
+def iter_fetch_chunks(fetch, chunks, max_workers=1, rate_limiter=None):
+    """
+    Call `fetch(chunk)` for each of the given `chunks`, with at most `max_workers`
+    simultaneous calls (in separate threads), and yield tuples `(chunk, result,
+    exc_info)` as the calls complete. If `fetch(chunk)` raised an exception, `result` is
+    `None` and `exc_info` is the ``sys.exc_info()`` of that exception; otherwise
+    `exc_info` is `None`.
+
+    If `rate_limiter` is not `None`, then its :py:meth:`RateLimiter.wait` method is
+    called before each call to `fetch`.
+
+    The results are processed in the calling thread, so it's safe to e.g. store them in
+    the cache. If the caller stops iterating (e.g. after a fatal error), no further
+    calls to `fetch` are started; calls which are already running are left to complete
+    in the background, and their results are discarded.
+    """
+    chunks = list(chunks)
+
+    if max_workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            try:
+                result = fetch(chunk)
+            except Exception:
+                yield (chunk, None, sys.exc_info())
+                continue
+            yield (chunk, result, None)
+        return
+
+    todo = Queue.Queue()
+    for chunk in chunks:
+        todo.put(chunk)
+    done = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                chunk = todo.get_nowait()
+            except Queue.Empty:
+                return
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            if stop.is_set():
+                return
+            try:
+                done.put( (chunk, fetch(chunk), None) )
+            except Exception:
+                done.put( (chunk, None, sys.exc_info()) )
+
+    for k in range(min(max_workers, len(chunks))):
+        thread = threading.Thread(target=worker, name='fetch-worker-%d'%(k))
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for k in range(len(chunks)):
+            while True:
+                try:
+                    # use a timeout, so that the main thread may be interrupted (Ctrl-C)
+                    item = done.get(True, 0.5)
+                    break
+                except Queue.Empty:
+                    pass
+            yield item
+    finally:
+        stop.set()
@@ -41,6 +41,7 @@ if sys.hexversion < 0x02070000:
 import re
 import os.path
 import importlib
+import pkgutil
 
 
 # subfolders of 3rdparty/ which we add to sys.path
@@ -58,20 +59,24 @@ base_dir = os.path.dirname(__file__)
 # ----------------------------
 for mod in third_party:
     # this should be done in the 'bibolamazi' script only, as last resort.
-    #try:
-    importlib.import_module(mod)
-    #    continue
-    #except ImportError:
-    #    # no such package--attempt to use pre-packaged version
-    #    sys.path += [os.path.abspath(os.path.join(base_dir, '..', '3rdparty', mod))]
-    #    importlib.import_module(mod)
+    #
+    # Only check that the package can be found: importing these packages is slow, and is
+    # only done when they're actually needed. (The ImportError tells the 'bibolamazi'
+    # script to use the pre-packaged versions.)
+    if pkgutil.find_loader(mod) is None:
+        raise ImportError("No module named %s" %(mod))
 
 
+#
+# Patches for the third-party packages. They are applied when the patched module is first
+# imported, by the import hook below, so that importing bibolamazi doesn't import pybtex
+# & co. right away.
+#
+
 #
 # Patch for pybtex. Bug in pybtex/bibtex/utils.py in split_tex_string
 # (https://sourceforge.net/p/pybtex/bugs/65/)
 #
-import pybtex.bibtex.utils as _pybtex_bibtex_utils
 def _split_tex_string(string, sep=None, strip=True, filter_empty=False):
     if sep is None:
         sep = r'(?:\s|(?<!\\)~)+' ### PhF: FIX TO NOT MATCH e.g. Brand\~{a}o
@@ -103,13 +108,13 @@ def _split_tex_string(string, sep=None, strip=True, filter_empty=False):
         result = [part for part in result if part]
     return result
 #
-_pybtex_bibtex_utils.split_tex_string = _split_tex_string
+def _patch_pybtex_bibtex_utils(_pybtex_bibtex_utils):
+    _pybtex_bibtex_utils.split_tex_string = _split_tex_string
 
 #
 # Patch for pybtex. Add __delitem__ to a OrderedCaseInsensitiveDict so that we can erase
 # fields in entry.fields
 #
-import pybtex.utils as _pybtex_utils
 def _OrderedCaseInsensitiveDict_delitem(self, key):
     # find item
     key_match = [k for k in self.order if k.lower() == key.lower()]
@@ -119,9 +124,64 @@ def _OrderedCaseInsensitiveDict_delitem(self, key):
     # now we have the key with the right case
     key_ok = key_match[0]
     self.order.remove(key_ok)
+    import pybtex.utils as _pybtex_utils
     super(_pybtex_utils.OrderedCaseInsensitiveDict, self).__delitem__(key_ok)
-    
-_pybtex_utils.OrderedCaseInsensitiveDict.__delitem__ = _OrderedCaseInsensitiveDict_delitem;
+#
+def _patch_pybtex_utils(_pybtex_utils):
+    _pybtex_utils.OrderedCaseInsensitiveDict.__delitem__ = _OrderedCaseInsensitiveDict_delitem
+
+#
+# Patch for pybtex. Use a faster tokenizer in the BibTeX parser. See
+# bibolamazi.core.bibtexscanner, which installs its iterator in pybtex's parser module
+# when it is loaded.
+#
+def _patch_pybtex_input_bibtex(_pybtex_input_bibtex):
+    if 'bibolamazi.core.bibtexscanner' in sys.modules:
+        # bibtexscanner is being loaded, and is importing pybtex's parser to subclass its
+        # iterator. It installs its own iterator once it is defined.
+        return
+    from .core import bibtexscanner as _bibtexscanner
+
+
+#
+# The import hook which applies the patches above
+#
+_patches = {
+    'pybtex.bibtex.utils': _patch_pybtex_bibtex_utils,
+    'pybtex.utils': _patch_pybtex_utils,
+    'pybtex.database.input.bibtex': _patch_pybtex_input_bibtex,
+}
+
+class _PatchingImporter(object):
+    """
+    A `sys.meta_path` import hook (see PEP 302) which applies our patch to a third-party
+    module as soon as it is imported, before any other module gets to use it.
+    """
+    def __init__(self):
+        self._loading = set()
+
+    def find_module(self, fullname, path=None):
+        if fullname in _patches and fullname not in self._loading:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        # let the normal import mechanism find & load the module, then patch it
+        self._loading.add(fullname)
+        try:
+            module = importlib.import_module(fullname)
+        finally:
+            self._loading.discard(fullname)
+        _patches[fullname](module)
+        return module
+
+for _modname in list(_patches):
+    if _modname in sys.modules:
+        # already imported (e.g. by the user of our library), patch it right away
+        _patches.pop(_modname)(sys.modules[_modname])
+sys.meta_path.insert(0, _PatchingImporter())
 
 
 # add the LONGDEBUG level, and set our custom logger class
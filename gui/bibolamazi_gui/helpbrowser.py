@@ -107,7 +107,7 @@ class HelpBrowser(QWidget):
             fbutton = QPushButton('%s' % (filt), self)
             fbutton.setProperty('helppath', 'filters/%s' %(filt))
             fbutton.setProperty('bibolamaziHelpButtonType', 'filter')
-            fbutton.setToolTip(filters_factory.get_filter_class(filt).getHelpDescription())
+            fbutton.setToolTip(filters_factory.get_filter_description(filt))
             self.ui.lytHomeButtons.addWidget(fbutton, offsetlineno + int(n / ncols), n % ncols)
             n += 1
 
@@ -217,7 +217,7 @@ class HelpBrowser(QWidget):
             tb.setText(filters_factory.format_filter_help(filtname))
 
             tb.setProperty('HelpTabTitle', '%s filter' %(filtname))
-            tb.setProperty('HelpTabToolTip', filters_factory.get_filter_class(filtname).getHelpDescription())
+            tb.setProperty('HelpTabToolTip', filters_factory.get_filter_description(filtname))
             return tb
 
         if (pathitems[0] == 'general'):
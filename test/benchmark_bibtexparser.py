@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the BibTeX tokenizer (see bibolamazi.core.bibtexscanner).
+
+Generates a large synthetic BibTeX database (50000 entries by default) and parses it
+with both pybtex's original BibTeXEntryIterator and bibolamazi's FastBibTeXEntryIterator,
+reporting the timings. The results (and any errors, with their line numbers and
+context) of both tokenizers are also checked to be identical, on the synthetic database
+as well as on all the files in test/srcbib/.
+
+Usage:  python benchmark_bibtexparser.py [-n NUM_ENTRIES] [--seed SEED]
+"""
+
+import sys
+import os
+import os.path
+import gc
+import glob
+import time
+import hashlib
+import random
+import argparse
+
+rootdir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path += [rootdir, os.path.join(rootdir, '3rdparty', 'pybtex')]
+
+import bibolamazi.init
+from bibolamazi.core import butils
+from bibolamazi.core.bibtexscanner import FastBibTeXEntryIterator
+import pybtex.database.input.bibtex as pybtex_input_bibtex
+from pybtex.database.input.bibtex import month_names
+from pybtex.utils import CaseInsensitiveDict
+
+OrigBibTeXEntryIterator = FastBibTeXEntryIterator.__bases__[0]
+
+
+_words = ("quantum entropy thermodynamic {M}axwell demon {\\'E}tude work extraction "
+          "single-shot information {B}ell inequality channel capacity $\\epsilon$ "
+          "smooth min-entropy {\\\"o}ffentlich resource theory").split()
+_names = ["Renner, Renato", "Faist, Philippe", "del Rio, L{\\'\\i}dia", "Oppenheim, J.",
+          "{\\AA}berg, Johan", "Brand{\\~a}o, Fernando G. S. L.", "von Neumann, John",
+          "Dupuis, Fr{\\'e}d{\\'e}ric"]
+
+def generate_bibtex(num, seed):
+    rnd = random.Random(seed)
+    out = [u"@preamble{\"\\newcommand{\\noop}[1]{}\"}\n",
+           u"@string{PRL = \"Physical Review Letters\"}\n",
+           u"@string(NJP = {New Journal of Physics})\n\n"]
+    for i in xrange(num):
+        nl = u"\r\n" if (i % 7 == 0) else u"\n"
+        title = u" ".join(rnd.choice(_words) for _ in range(rnd.randint(3, 12)))
+        authors = u" and ".join(rnd.sample(_names, rnd.randint(1, 4)))
+        fields = [
+            (u"title", u"{" + title + u"}"),
+            (u"author", u"\"" + authors + u"\""),
+            (u"year", unicode(rnd.randint(1950, 2015))),
+            (u"journal", rnd.choice([u"PRL", u"NJP", u"{Nature}", u"\"Phys. Rev. A\""])),
+            (u"month", rnd.choice([u"jan", u"feb", u"{March}", u"\"apr\" # \"il\""])),
+            (u"abstract", u"{" + (nl + u"  ").join(rnd.choice(_words) for _ in range(rnd.randint(0, 40)))
+             + u" {nested {braces} here}}"),
+            (u"note", u"\"Some \" # PRL # \" note with a {\"}quote\""),
+            (u"pages", u"{%d--%d}" % (i, i+10)),
+            ]
+        if i % 11 == 0:
+            fields.append((u"crossref", u"{key%d}" % (i // 2)))
+        rnd.shuffle(fields)
+        if i % 13 == 0:
+            out.append(u"% a comment line" + nl)
+        if i % 17 == 0:
+            out.append(u"@comment{ignored " + unicode(i) + u"}" + nl)
+        (op, cl) = (u"(", u")") if (i % 19 == 0) else (u"{", u"}")
+        out.append(u"@" + rnd.choice([u"article", u"Article", u"misc", u"INPROCEEDINGS"]) + op
+                   + u"key%d," % (i) + nl
+                   + (u"," + nl).join(u"  %s = %s" % (k, v) for (k, v) in fields)
+                   + rnd.choice([u"", u","]) + nl + cl + nl + nl)
+    return u"".join(out)
+
+
+def run_iterator(klass, text):
+    results = []
+    errors = []
+    def handle_error(error):
+        errors.append((error.__class__.__name__, unicode(error), error.lineno, error.get_context()))
+    # the original class refers to itself by its module-level name, which bibolamazi.init
+    # replaced by the fast iterator
+    pybtex_input_bibtex.BibTeXEntryIterator = klass
+    try:
+        it = klass(text, handle_error=handle_error, macros=CaseInsensitiveDict(month_names))
+        for x in it:
+            results.append(x)
+    finally:
+        pybtex_input_bibtex.BibTeXEntryIterator = FastBibTeXEntryIterator
+    return (results, errors)
+
+
+def timed_run_iterator(klass, text):
+    """
+    Returns (time, num_commands, num_errors, digest_of_results). Only a digest of the
+    results is kept, so that the results of one run don't slow down the garbage
+    collector during the next run.
+    """
+    gc.collect()
+    t0 = time.time()
+    (results, errors) = run_iterator(klass, text)
+    t = time.time() - t0
+    return (t, len(results), len(errors), hashlib.md5(repr((results, errors))).hexdigest())
+
+
+def compare(text, label, quiet=False):
+    (t_orig, ncmds, nerrs, digest_orig) = timed_run_iterator(OrigBibTeXEntryIterator, text)
+    (t_fast, ncmds_fast, nerrs_fast, digest_fast) = timed_run_iterator(FastBibTeXEntryIterator, text)
+    same = (digest_orig == digest_fast)
+    if not quiet or not same:
+        print "%-40s %6d commands, %2d errors: original %7.3fs, fast %7.3fs (x%.1f)  %s" % (
+            label, ncmds, nerrs, t_orig, t_fast, t_orig/max(t_fast, 1e-6),
+            "identical" if same else "** RESULTS DIFFER **")
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BibTeX tokenizer.")
+    parser.add_argument('-n', '--num-entries', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    ok = True
+
+    for fn in sorted(glob.glob(os.path.join(rootdir, 'test', 'srcbib', '*.bib'))):
+        with open(fn, 'r') as f:
+            text = butils.guess_encoding_decode(f.read())
+        ok = compare(text, os.path.basename(fn)) and ok
+        # also check that errors in truncated/damaged files are reported identically
+        rnd = random.Random(args.seed)
+        for k in range(20):
+            cut = rnd.randint(0, len(text))
+            ok = compare(text[:cut], "%s (truncated)" % (os.path.basename(fn)), quiet=True) and ok
+            ok = compare(text[:cut] + rnd.choice([u"}", u"{", u"\"", u"@", u",", u"#"]) + text[cut:],
+                         "%s (damaged)" % (os.path.basename(fn)), quiet=True) and ok
+
+    text = generate_bibtex(args.num_entries, args.seed)
+    ok = compare(text, "synthetic, %d entries (%.1f MB)" % (args.num_entries, len(text)/1.0e6)) and ok
+
+    if not ok:
+        print "ERROR: the tokenizers gave different results."
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
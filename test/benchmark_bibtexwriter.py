@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the BibTeX writer (see bibolamazi.core.bibtexwriter).
+
+Parses a large synthetic BibTeX database (50000 entries by default, see
+benchmark_bibtexparser.py) and writes it out with both pybtex's original Writer and
+bibolamazi's FastBibTeXWriter, reporting the timings. The outputs of both writers are
+also checked to be byte-for-byte identical, on the synthetic database as well as on all
+the files in test/srcbib/, and both writers are checked to reject the same values with
+unbalanced braces.
+
+Usage:  python benchmark_bibtexwriter.py [-n NUM_ENTRIES] [--seed SEED]
+"""
+
+import sys
+import os
+import os.path
+import io
+import gc
+import glob
+import time
+import codecs
+import random
+import argparse
+
+rootdir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path += [rootdir, os.path.join(rootdir, '3rdparty', 'pybtex')]
+
+import bibolamazi.init
+from bibolamazi.core import butils
+from bibolamazi.core.bibtexwriter import FastBibTeXWriter
+import pybtex.database.input.bibtex as pybtex_input_bibtex
+from pybtex.database.output.bibtex import Writer
+from pybtex.bibtex.exceptions import BibTeXError
+
+from benchmark_bibtexparser import generate_bibtex
+
+
+def parse(text):
+    bib_data = pybtex_input_bibtex.Parser().parse_stream(io.StringIO(text))
+    for entry in bib_data.entries.itervalues():
+        # as done by BibolamaziFile.saveToFile()
+        entry.original_type = entry.type
+    return bib_data
+
+
+def timed_write(klass, bib_data):
+    """
+    Returns (time, output), where output is the utf-8 encoded output, written through a
+    codecs stream writer as in BibolamaziFile.saveToFile().
+    """
+    gc.collect()
+    out = io.BytesIO()
+    stream = codecs.getwriter('utf-8')(out)
+    t0 = time.time()
+    klass().write_stream(bib_data, stream)
+    t = time.time() - t0
+    return (t, out.getvalue())
+
+
+def compare(bib_data, label):
+    (t_orig, out_orig) = timed_write(Writer, bib_data)
+    (t_fast, out_fast) = timed_write(FastBibTeXWriter, bib_data)
+    same = (out_orig == out_fast)
+    print "%-40s %6d entries: original %7.3fs, fast %7.3fs (x%.1f)  %s" % (
+        label, len(bib_data.entries), t_orig, t_fast, t_orig/max(t_fast, 1e-6),
+        "identical" if same else "** OUTPUT DIFFERS **")
+    return same
+
+
+def check_braces_result(writer, s):
+    try:
+        writer.check_braces(s)
+    except BibTeXError as e:
+        return unicode(e)
+    return None
+
+
+def compare_check_braces(seed, num=200000):
+    rnd = random.Random(seed)
+    (orig, fast) = (Writer(), FastBibTeXWriter())
+    for k in xrange(num):
+        s = u"".join(rnd.choice(u"{}\\a ") for _ in range(rnd.randint(0, 12)))
+        if check_braces_result(orig, s) != check_braces_result(fast, s):
+            print "check_braces(%r): original: %r, fast: %r" % (
+                s, check_braces_result(orig, s), check_braces_result(fast, s))
+            return False
+    print "check_braces: same results on %d random strings" % (num)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BibTeX writer.")
+    parser.add_argument('-n', '--num-entries', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    ok = compare_check_braces(args.seed)
+
+    for fn in sorted(glob.glob(os.path.join(rootdir, 'test', 'srcbib', '*.bib'))):
+        with open(fn, 'r') as f:
+            text = butils.guess_encoding_decode(f.read())
+        try:
+            bib_data = parse(text)
+        except Exception as e:
+            print "%-40s skipped, can't parse it: %s" % (os.path.basename(fn), e)
+            continue
+        ok = compare(bib_data, os.path.basename(fn)) and ok
+
+    bib_data = parse(generate_bibtex(args.num_entries, args.seed))
+    ok = compare(bib_data, "synthetic, %d entries" % (args.num_entries)) and ok
+
+    if not ok:
+        print "ERROR: the writers gave different results."
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
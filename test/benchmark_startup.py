@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the startup cost of the `bibolamazi` command-line program.
+
+Runs ``bibolamazi --version``, ``bibolamazi --list-filters`` and bibolamazi on a minimal
+bibolamazi file (with a single small source and the `orderentries` filter), once forcing
+the file to be updated and once when it is already up to date, in separate processes.
+Reports for each the wall time and the time spent importing each module, similar to what
+``python3 -X importtime`` shows. Modules from the packages which are
+known to be slow to import (pybtex, pylatexenc, arxiv2bib, requests, bs4) are flagged.
+
+The results may be saved to a JSON file with ``--save`` and compared to the results of
+an earlier run with ``--compare``, so that regressions in startup cost are visible.
+
+Usage:  python benchmark_startup.py [--repeat N] [--top N] [--tree]
+                                    [--save FILE] [--compare FILE]
+"""
+
+import sys
+import os
+import os.path
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+import argparse
+
+rootdir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+bibolamazi_script = os.path.join(rootdir, 'bin', 'bibolamazi')
+
+HEAVY_PACKAGES = ('pybtex', 'pylatexenc', 'arxiv2bib', 'requests', 'bs4')
+
+MINIMAL_CONFIG = u"""\
+
+%%%-BIB-OLA-MAZI-BEGIN-%%%
+%
+% src: source.bib
+% filter: orderentries
+%
+%%%-BIB-OLA-MAZI-END-%%%
+"""
+
+MINIMAL_SOURCE = u"""\
+@article{Doe2015,
+  author = {Doe, John and M{\\"u}ller, Anna},
+  title = {A minimal example},
+  journal = {Phys. Rev. A},
+  year = {2015},
+}
+@book{Smith1990,
+  author = {Smith, A.},
+  title = {Another example},
+  year = {1990},
+}
+"""
+
+SCENARIOS = [
+    ('version', ['--version']),
+    ('list-filters', ['--list-filters']),
+    ('minimal-run', ['--force', 'minimal.bibolamazi.bib']),
+    ('up-to-date-run', ['minimal.bibolamazi.bib']),
+    ]
+
+
+# ------------------------------------------------------------------------------
+# In the child process: time the imports while running bibolamazi
+# ------------------------------------------------------------------------------
+
+def run_child(outfname, args):
+    import __builtin__
+
+    orig_import = __builtin__.__import__
+    timings = []
+    # time spent in nested imports, for each of the imports in progress
+    stack = []
+
+    def module_label(name, globals):
+        # resolve implicit relative imports (python 2) for display
+        if globals:
+            pkg = globals.get('__package__')
+            if not pkg:
+                pkg = globals.get('__name__', '')
+                if '__path__' not in globals:
+                    pkg = pkg.rpartition('.')[0]
+            if pkg and sys.modules.get(pkg+'.'+name) is not None:
+                return pkg+'.'+name
+        return name
+
+    def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        nmodules = len(sys.modules)
+        stack.append(0.0)
+        t0 = time.time()
+        try:
+            return orig_import(name, globals, locals, fromlist, level)
+        finally:
+            dt = time.time() - t0
+            nested = stack.pop()
+            if stack:
+                stack[-1] += dt
+            if len(sys.modules) != nmodules:
+                # this import actually loaded some module(s)
+                timings.append((module_label(name, globals), dt - nested, dt, len(stack)))
+
+    __builtin__.__import__ = timed_import
+
+    sys.argv = [bibolamazi_script] + args
+    t0 = time.time()
+    try:
+        execfile(bibolamazi_script, {'__name__': '__main__', '__file__': bibolamazi_script})
+    except SystemExit:
+        pass
+    total = time.time() - t0
+
+    __builtin__.__import__ = orig_import
+
+    with open(outfname, 'w') as f:
+        json.dump({'total': total, 'imports': timings}, f)
+
+
+# ------------------------------------------------------------------------------
+# In the main process
+# ------------------------------------------------------------------------------
+
+def run_scenario(args, workdir, env, repeat):
+    """
+    Run bibolamazi with the given `args` `repeat` times, and return the results of the
+    fastest run.
+    """
+    best = None
+    outfname = os.path.join(workdir, 'importtimes.json')
+    with open(os.devnull, 'w') as devnull:
+        for k in range(repeat):
+            t0 = time.time()
+            subprocess.check_call([sys.executable, os.path.realpath(__file__), '--child', outfname, '--']
+                                  + args,
+                                  cwd=workdir, env=env, stdout=devnull, stderr=devnull)
+            wall = time.time() - t0
+            with open(outfname) as f:
+                result = json.load(f)
+            result['wall'] = wall
+            if best is None or wall < best['wall']:
+                best = result
+    return best
+
+
+def is_heavy(modname):
+    return modname.split('.')[0] in HEAVY_PACKAGES
+
+
+def report(name, result, top, tree):
+    imports = result['imports']
+    heavy = sorted(set(m.split('.')[0] for (m, s, c, d) in imports if is_heavy(m)))
+    print "=== %s: %.0f ms wall time, %.0f ms in bibolamazi, %.0f ms importing (%d modules)" %(
+        name, 1000*result['wall'], 1000*result['total'],
+        1000*sum(s for (m, s, c, d) in imports), len(imports))
+    print "    heavy packages imported: %s" %(", ".join(heavy) if heavy else "none")
+    if tree:
+        print "    import time: self [ms] | cumulative | imported module"
+        for (m, s, c, d) in imports:
+            print "    %8.1f | %8.1f | %s%s%s" %(1000*s, 1000*c, "  "*d, m, " *" if is_heavy(m) else "")
+    else:
+        print "    slowest imports: cumulative [ms] | self | module"
+        for (m, s, c, d) in sorted(imports, key=lambda x: -x[2])[:top]:
+            print "    %8.1f | %8.1f | %s%s%s" %(1000*c, 1000*s, "  "*d, m, " *" if is_heavy(m) else "")
+    print
+
+
+def compare(results, baseline):
+    print "=== Comparison with the saved results"
+    for (name, args) in SCENARIOS:
+        if name not in baseline or name not in results:
+            continue
+        (new, old) = (results[name], baseline[name])
+        print "  %-14s wall %6.0f ms -> %6.0f ms (%+.0f ms);  %3d -> %3d modules" %(
+            name, 1000*old['wall'], 1000*new['wall'], 1000*(new['wall']-old['wall']),
+            len(old['imports']), len(new['imports']))
+        newmods = set(m for (m, s, c, d) in new['imports']) - set(m for (m, s, c, d) in old['imports'])
+        heavynew = sorted(m for m in newmods if is_heavy(m))
+        if heavynew:
+            print "      now importing: %s" %(", ".join(heavynew))
+    print
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        return run_child(sys.argv[2], sys.argv[4:])
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="run each scenario this many times, and keep the fastest run")
+    parser.add_argument('--top', type=int, default=15,
+                        help="number of slowest imports to display for each scenario")
+    parser.add_argument('--tree', action='store_true',
+                        help="display all imports, in the order they happen")
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="compare with the results saved in this JSON file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bibolamazi_startup_')
+    try:
+        with open(os.path.join(workdir, 'minimal.bibolamazi.bib'), 'w') as f:
+            f.write(MINIMAL_CONFIG.encode('utf-8'))
+        with open(os.path.join(workdir, 'source.bib'), 'w') as f:
+            f.write(MINIMAL_SOURCE.encode('utf-8'))
+
+        env = dict(os.environ)
+        # use a fresh filter registry; it's filled by the first run of each scenario
+        env['BIBOLAMAZI_FILTER_REGISTRY'] = os.path.join(workdir, 'filter_registry.json')
+
+        results = {}
+        for (name, scenargs) in SCENARIOS:
+            # warm up (filter registry, cache files, OS file cache)
+            run_scenario(scenargs, workdir, env, 1)
+            results[name] = run_scenario(scenargs, workdir, env, args.repeat)
+            report(name, results[name], args.top, args.tree)
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print "Results saved to %s" %(args.save)
+
+
+if __name__ == '__main__':
+    main()
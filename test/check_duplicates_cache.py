@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+Check that the `duplicates` filter gives the same result when it reuses the decisions
+stored in the cache at the previous run, as when it compares all the entries again.
+
+Generates a random bibliography with many duplicates (including entries which refer to
+proceedings with `crossref`) and a random list of cited entries, and modifies it step by
+step: editing, adding, removing and reordering entries, citing or no longer citing
+entries, and editing the proceedings. After each step, bibolamazi is run with the
+`duplicates` filter, once in a directory in which the cache is kept from one step to the
+next, and once with ``--no-cache``. The output bibliographies and the duplicates files
+must be identical. Two configurations of the filter are checked, one with
+``-sKeepOnlyUsedInJobname`` and one with all entries.
+
+The arXiv information of the entries is looked up in a local arXiv metadata store
+generated for the purpose, so that the arXiv API isn't queried.
+
+Usage:  python check_duplicates_cache.py [--seed N] [--steps N] [--keep]
+"""
+
+import sys
+import os
+import os.path
+import re
+import json
+import random
+import shutil
+import tempfile
+import subprocess
+import argparse
+
+rootdir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+bibolamazi_script = os.path.join(rootdir, 'bin', 'bibolamazi')
+
+
+CONFIGS = [
+    ('used', "% filter: duplicates -sDupfile=dup_used.tex -sKeepOnlyUsedInJobname=job\n"),
+    ('all', "% filter: duplicates -sDupfile=dup_all.tex -dWarn\n"),
+    ]
+
+CONFIG_TEMPLATE = """\
+
+%%%%%%-BIB-OLA-MAZI-BEGIN-%%%%%%
+%%
+%% src: source.bib
+%s%%
+%%%%%%-BIB-OLA-MAZI-END-%%%%%%
+"""
+
+# small pools of values, so that many entries turn out to be duplicates
+AUTHORS = ["Smith, A.", "Smith, A. and Doe, J.", "Doe, J. and Li, W. and Berg, J.",
+           "Koenig, K.", "Konig, K.", "Doe, J.", "Li, W. and Smith, A."]
+ARXIV_IDS = ["1201.%04d" % i for i in range(6)]
+FIELDS = {
+    'year': ["2000", "2001", "2002", None],
+    'month': ["jan", "feb", None],
+    'doi': ["10.1000/a%d" % i for i in range(6)] + [None]*6,
+    'eprint': ARXIV_IDS + [None]*6,
+    'journal': ["Phys. Rev. A", "Nature", "PNAS", None],
+    'volume': ["1", "2", None],
+    'number': ["3", None],
+    'title': ["Quantum things %d" % i for i in range(12)],
+    'pages': ["1--2", "5", None],
+    'note': ["some note", None, None],
+    }
+
+NUM_ENTRIES = 150
+NUM_PROCEEDINGS = 3
+
+
+class RandomBibliography(object):
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.num_keys = 0
+        # list of (key, fields), where fields['type'] is the entry type
+        self.entries = [ (self.new_key(), self.random_entry()) for k in range(NUM_ENTRIES) ]
+        procs = []
+        for p in range(NUM_PROCEEDINGS):
+            procs.append(("proc%d" % p, {'type': 'proceedings', 'title': "Proceedings %d" % p,
+                                         'author': "Editor, E.",
+                                         'year': rnd.choice(["2000", "2001"])}))
+            for c in range(2):
+                e = self.random_entry()
+                e['type'] = 'inproceedings'
+                e['crossref'] = "proc%d" % p
+                e.pop('year', None)
+                self.entries.append((self.new_key(), e))
+        rnd.shuffle(self.entries)
+        # the cross-referenced entries must come after the entries which refer to them
+        self.entries += procs
+        self.cited = set(k for (k, e) in self.entries if rnd.random() < 0.5)
+
+    def new_key(self):
+        self.num_keys += 1
+        return "k%04d" % self.num_keys
+
+    def random_entry(self):
+        e = { 'type': self.rnd.choice(['article', 'article', 'unpublished']),
+              'author': self.rnd.choice(AUTHORS) }
+        for (fld, values) in FIELDS.iteritems():
+            val = self.rnd.choice(values)
+            if val is not None:
+                e[fld] = val
+        return e
+
+    def _regular(self):
+        # indices of the entries which aren't proceedings
+        return [ i for (i, (k, e)) in enumerate(self.entries) if e['type'] != 'proceedings' ]
+
+    def edit(self):
+        i = self.rnd.choice(self._regular())
+        (key, e) = (self.entries[i][0], dict(self.entries[i][1]))
+        fld = self.rnd.choice(FIELDS.keys() + ['author'])
+        val = self.rnd.choice(AUTHORS if fld == 'author' else FIELDS[fld])
+        if val is None:
+            e.pop(fld, None)
+        else:
+            e[fld] = val
+        self.entries[i] = (key, e)
+        return "edit %s.%s" % (key, fld)
+
+    def add(self):
+        key = self.new_key()
+        self.entries.insert(self.rnd.choice(self._regular()), (key, self.random_entry()))
+        return "add %s" % (key)
+
+    def remove(self):
+        (key, e) = self.entries.pop(self.rnd.choice(self._regular()))
+        self.cited.discard(key)
+        return "remove %s" % (key)
+
+    def reorder(self):
+        (key, e) = self.entries.pop(self.rnd.choice(self._regular()))
+        self.entries.insert(self.rnd.choice(self._regular()), (key, e))
+        return "move %s" % (key)
+
+    def cite(self):
+        key = self.rnd.choice(self.entries)[0]
+        if key in self.cited:
+            self.cited.discard(key)
+            return "uncite %s" % (key)
+        self.cited.add(key)
+        return "cite %s" % (key)
+
+    def edit_proceedings(self):
+        i = self.rnd.choice([ i for (i, (k, e)) in enumerate(self.entries)
+                              if e['type'] == 'proceedings' ])
+        e = dict(self.entries[i][1])
+        e['year'] = self.rnd.choice(["2000", "2001", "2002"])
+        self.entries[i] = (self.entries[i][0], e)
+        return "edit %s.year" % (self.entries[i][0])
+
+    def write(self, dirname):
+        with open(os.path.join(dirname, 'source.bib'), 'w') as f:
+            for (key, e) in self.entries:
+                f.write("@%s{%s,\n" % (e['type'], key))
+                for fld in sorted(e):
+                    if fld != 'type':
+                        f.write("  %s = {%s},\n" % (fld, e[fld]))
+                f.write("}\n\n")
+        with open(os.path.join(dirname, 'job.aux'), 'w') as f:
+            for key in sorted(self.cited):
+                f.write("\\citation{%s}\n" % (key))
+
+
+def write_arxiv_metadata(fname):
+    with open(fname, 'w') as f:
+        for (i, arxivid) in enumerate(ARXIV_IDS):
+            f.write(json.dumps({
+                'id': arxivid,
+                'title': "Quantum things %d" % (i),
+                'authors_parsed': [["Smith", "A.", ""]],
+                'categories': "quant-ph",
+                'doi': "10.1000/a%d" % (i) if i % 2 else None,
+                'journal-ref': None,
+                'versions': [{'version': 'v1', 'created': "Mon, 2 Jan 2012 00:00:00 GMT"}],
+                }) + "\n")
+
+
+def run_bibolamazi(dirname, cfgname, env, args):
+    """
+    Run bibolamazi on the bibolamazi file for the configuration `cfgname` in the directory
+    `dirname`, and return the output bibliography, the duplicates file and the number of
+    decisions which were reused (or `None`).
+    """
+    bibolamazifname = os.path.join(dirname, cfgname+'.bibolamazi.bib')
+    p = subprocess.Popen([sys.executable, bibolamazi_script, '--force', '-v'] + args
+                         + [bibolamazifname],
+                         cwd=dirname, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    if p.returncode != 0:
+        print output
+        raise RuntimeError("bibolamazi failed with exit code %d" % (p.returncode))
+    m = re.search(r'reused (\d+) of (\d+) decisions', output)
+    with open(bibolamazifname) as f:
+        result = re.sub(r'generated by BIBOLAMAZI.*', '', f.read())
+    with open(os.path.join(dirname, 'dup_%s.tex' % (cfgname))) as f:
+        result += f.read()
+    return (result, int(m.group(1)) if m else None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1, help="seed of the random generator")
+    parser.add_argument('--steps', type=int, default=40,
+                        help="number of times the bibliography is modified")
+    parser.add_argument('--keep', action='store_true',
+                        help="don't remove the temporary directory at the end")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    bib = RandomBibliography(rnd)
+    modifications = [bib.edit, bib.add, bib.remove, bib.reorder, bib.cite, bib.edit_proceedings]
+
+    workdir = tempfile.mkdtemp(prefix='bibolamazi_duplicates_cache_')
+    cacheddir = os.path.join(workdir, 'cached')
+    uncacheddir = os.path.join(workdir, 'uncached')
+
+    num_failures = 0
+    try:
+        env = dict(os.environ)
+        env['BIBOLAMAZI_ARXIV_METADATA'] = os.path.join(workdir, 'arxiv_metadata.db')
+        env['BIBOLAMAZI_FILTER_REGISTRY'] = os.path.join(workdir, 'filter_registry.json')
+        write_arxiv_metadata(os.path.join(workdir, 'arxiv_metadata.json'))
+        subprocess.check_call([sys.executable, bibolamazi_script, '--import-arxiv-metadata',
+                               os.path.join(workdir, 'arxiv_metadata.json')],
+                              env=env, stdout=open(os.devnull, 'w'))
+
+        for dirname in (cacheddir, uncacheddir):
+            os.mkdir(dirname)
+            for (cfgname, cfg) in CONFIGS:
+                with open(os.path.join(dirname, cfgname+'.bibolamazi.bib'), 'w') as f:
+                    f.write(CONFIG_TEMPLATE % (cfg))
+
+        for step in range(args.steps+1):
+            if step == 0:
+                what = "initial bibliography"
+            else:
+                # make sure that each kind of modification is exercised regularly
+                what = "; ".join([ modifications[step % len(modifications)]() ] +
+                                 [ rnd.choice(modifications)() for k in range(rnd.randint(0, 2)) ])
+            bib.write(cacheddir)
+            bib.write(uncacheddir)
+
+            reused = []
+            for (cfgname, cfg) in CONFIGS:
+                (cached, num_reused) = run_bibolamazi(cacheddir, cfgname, env, [])
+                (uncached, dummy) = run_bibolamazi(uncacheddir, cfgname, env, ['--no-cache'])
+                reused.append("%s: %s reused" % (cfgname, num_reused))
+                if cached != uncached:
+                    num_failures += 1
+                    print "MISMATCH in configuration `%s' after: %s" % (cfgname, what)
+
+            print "step %2d: %-60s [%s]" % (step, what, ", ".join(reused))
+
+    finally:
+        if args.keep:
+            print "Files kept in %s" % (workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    if num_failures:
+        print "FAILED: %d mismatches" % (num_failures)
+        sys.exit(1)
+    print "OK: the cached and uncached runs gave the same results"
+
+
+if __name__ == '__main__':
+    main()
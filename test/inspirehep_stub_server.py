@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+A local HTTP server imitating the InspireHEP search API, to test the `citeinspirehep`
+filter without querying inspirehep.net.
+
+The server answers queries of the form ``/search?p=<query>&of=hx`` with made-up bibtex
+entries, in the same format as InspireHEP. The query may combine several terms with
+``or``; terms of the form ``eprint:<arxiv-id>``, ``doi:<doi>``, ``texkey:"<key>"`` and
+``j:<journal,volume,page>`` are understood. A term containing ``notfound`` doesn't match
+anything.
+
+Usage:  python inspirehep_stub_server.py [--port PORT] [--latency SECONDS]
+                                          [--fail-rate FRACTION]
+
+Then run bibolamazi with the environment variable
+``BIBOLAMAZI_INSPIREHEP_URL=http://localhost:PORT/search``. The number of requests
+received is printed when the server is stopped (Ctrl-C).
+"""
+
+import re
+import time
+import random
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    latency = 0
+    fail_rate = 0
+    num_requests = 0
+    lock = threading.Lock()
+
+
+def make_entry(term):
+    (qtype, val) = term.split(':', 1)
+    val = val.strip('"')
+    # a distinct texkey for each term, which is a valid BibTeX key
+    texkey = val if qtype == 'texkey' else 'Stub:%s:%s' %(
+        qtype, re.sub(r'[^A-Za-z0-9]', lambda m: '_%02x' %(ord(m.group())), val))
+    fields = [
+        ('author', 'Doe, John and M{\\"u}ller, Anna'),
+        ('title', '{Made-up paper for %s}' %(val)),
+        ('year', '2015'),
+        ]
+    if qtype == 'eprint':
+        fields.append(('eprint', val))
+        fields.append(('archivePrefix', 'arXiv'))
+    if qtype == 'doi':
+        fields.append(('doi', val))
+    if qtype == 'j':
+        fields.append(('journal', val.split(',')[0]))
+    return "@article{%s,\n%s\n}" %(texkey, ",\n".join([ '      %s = "%s"' %(f, v)
+                                                        for (f, v) in fields ]))
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.num_requests += 1
+        time.sleep(self.server.latency)
+        if random.random() < self.server.fail_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        url = urlparse.urlparse(self.path)
+        qs = urlparse.parse_qs(url.query)
+        terms = [ t.strip() for t in re.split(r'\s+or\s+', qs.get('p', [''])[0]) if t.strip() ]
+        entries = [ make_entry(t) for t in terms if ':' in t and 'notfound' not in t ]
+        entries = entries[:int(qs.get('rg', ['25'])[0])]
+        if entries:
+            body = "<pre>\n%s\n</pre>" %("\n\n".join(entries))
+        else:
+            body = '<div class="quicknote">Search term <em>%s</em> did not match any record.</div>' %(
+                qs.get('p', [''])[0])
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help="time to wait before answering each request, in seconds")
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help="fraction of requests to answer with a 503 error")
+    args = parser.parse_args()
+
+    server = StubServer(('localhost', args.port), StubHandler)
+    server.latency = args.latency
+    server.fail_rate = args.fail_rate
+    print "Serving on http://localhost:%d/search" %(args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "%d requests received" %(server.num_requests)
+
+
+if __name__ == '__main__':
+    main()